@@ -0,0 +1,169 @@
+"""
+Account creation helpers: account numbers and uniqueness conflicts.
+
+``find_conflicts`` checks every unique registration field with one query
+before anything is hashed or written. A registration that races another one
+past that check still fails on a unique constraint; ``conflict_field`` maps
+the violated constraint back to the field by name, using the constraint
+names introspected from the database.
+
+With sharded accounts (see ``api/shards.py``) the user fields are checked on
+``default`` and the profile fields with one query per shard.
+"""
+import random
+import re
+import string
+import threading
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+
+from .models import UserProfile, Transaction
+from .shards import is_sharded, shard_aliases
+
+ACCOUNT_NUMBER_LENGTH = 10
+
+CONFLICT_MESSAGES = {
+    'username': 'This username is already taken',
+    'email': 'This email address is already registered',
+    'phone': 'This phone number is already registered',
+    'bvn': 'This BVN is already registered with another account',
+    'nin': 'This NIN is already registered with another account',
+    'account_number': 'Account number already exists',
+    'reference': 'Transaction reference already exists',
+}
+UNKNOWN_CONFLICT = 'This information is already registered. Please use different details.'
+
+# Field -> lookup on User for the registration pre-check
+_REGISTRATION_LOOKUPS = {
+    'username': 'username',
+    'email': 'email__iexact',
+    'phone': 'profile__phone',
+    'bvn': 'profile__bvn',
+    'nin': 'profile__nin',
+    'account_number': 'profile__account_number',
+}
+
+# Unique columns whose constraint violations are reported as conflicts
+_UNIQUE_COLUMNS = (
+    (User, 'username'),
+    (UserProfile, 'bvn'),
+    (UserProfile, 'nin'),
+    (UserProfile, 'account_number'),
+    (Transaction, 'reference'),
+)
+
+_constraint_fields = None
+_constraint_fields_lock = threading.Lock()
+
+
+def derive_account_number(phone):
+    """
+    Account number for a new customer: the phone number without its leading
+    zero, or random digits when there is no phone number. Random numbers are
+    not checked for uniqueness here; the caller has to handle a clash.
+    """
+    if phone and phone.startswith('0'):
+        return phone[1:]
+    if phone:
+        return phone
+    return ''.join(random.choices(string.digits, k=ACCOUNT_NUMBER_LENGTH))
+
+
+def find_conflicts(username, email, phone, bvn, nin, account_number):
+    """
+    ``{field: message}`` for every value another customer already has, in
+    ``CONFLICT_MESSAGES`` order, from a single query (one per shard when
+    sharded). Blank emails and phone numbers aren't unique and are not checked.
+    """
+    wanted = {'username': username, 'bvn': bvn, 'nin': nin, 'account_number': account_number}
+    if email:
+        wanted['email'] = email
+    if phone:
+        wanted['phone'] = phone
+
+    taken = set()
+    for existing in (_sharded_rows(wanted) if is_sharded() else _rows(wanted)):
+        for field, value in wanted.items():
+            if field not in existing:
+                continue
+            if field == 'email':
+                if (existing['email'] or '').lower() == value.lower():
+                    taken.add(field)
+            elif existing[field] == value:
+                taken.add(field)
+    return {field: message for field, message in CONFLICT_MESSAGES.items() if field in taken}
+
+
+def _values(queryset, lookups, wanted):
+    """Dicts of the ``lookups`` columns for rows matching any wanted value"""
+    condition = Q()
+    for field, value in wanted.items():
+        if field in lookups:
+            condition |= Q(**{lookups[field]: value})
+    if not condition:
+        return []
+    columns = [lookup.split('__iexact')[0] for lookup in lookups.values()]
+    return [dict(zip(lookups, row)) for row in queryset.filter(condition).values_list(*columns)]
+
+
+def _rows(wanted):
+    return _values(User.objects.all(), _REGISTRATION_LOOKUPS, wanted)
+
+
+def _sharded_rows(wanted):
+    rows = _values(User.objects.all(), {'username': 'username', 'email': 'email__iexact'}, wanted)
+    profile_lookups = {
+        field: lookup.split('__', 1)[1]
+        for field, lookup in _REGISTRATION_LOOKUPS.items() if lookup.startswith('profile__')
+    }
+    for alias in shard_aliases():
+        rows.extend(_values(UserProfile.objects.using(alias), profile_lookups, wanted))
+    return rows
+
+
+def _load_constraint_fields():
+    """Constraint name -> field for the columns in ``_UNIQUE_COLUMNS``"""
+    mapping = {}
+    with connection.cursor() as cursor:
+        for model, field_name in _UNIQUE_COLUMNS:
+            table = model._meta.db_table
+            column = model._meta.get_field(field_name).column
+            for name, info in connection.introspection.get_constraints(cursor, table).items():
+                if info['unique'] and not info['primary_key'] and info['columns'] == [column]:
+                    mapping[name] = field_name
+            # SQLite names the column rather than the constraint
+            mapping[f'{table}.{column}'] = field_name
+    return mapping
+
+
+def violated_constraint(error):
+    """The unique constraint an IntegrityError names, or None"""
+    diag = getattr(error.__cause__, 'diag', None)
+    if getattr(diag, 'constraint_name', None):
+        return diag.constraint_name  # PostgreSQL (psycopg)
+    message = str(error)
+    match = (
+        re.search(r'UNIQUE constraint failed: ([\w.]+)', message)  # SQLite
+        or re.search(r"for key '([^']+)'", message)  # MySQL
+    )
+    return match.group(1) if match else None
+
+
+def conflict_field(error):
+    """The field whose unique constraint ``error`` violated, or 'unknown'"""
+    global _constraint_fields
+    if _constraint_fields is None:
+        with _constraint_fields_lock:
+            if _constraint_fields is None:
+                _constraint_fields = _load_constraint_fields()
+    name = violated_constraint(error)
+    if name is None:
+        return 'unknown'
+    # MySQL 8 prefixes the index name with the table
+    return _constraint_fields.get(name) or _constraint_fields.get(name.rsplit('.', 1)[-1], 'unknown')
+
+
+def conflict_message(field):
+    return CONFLICT_MESSAGES.get(field, UNKNOWN_CONFLICT)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserProfile, Transaction, Card, Message
+from .models import UserProfile, Transaction, DailyBalanceSnapshot, OutboxEvent, Card, Message
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -14,6 +14,19 @@ class TransactionAdmin(admin.ModelAdmin):
     list_filter = ('type', 'status', 'created_at')
     date_hierarchy = 'created_at'
 
+@admin.register(DailyBalanceSnapshot)
+class DailyBalanceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('user', 'date', 'opening_balance', 'closing_balance', 'transaction_count')
+    search_fields = ('user__username',)
+    date_hierarchy = 'date'
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('topic', 'status', 'attempts', 'available_at', 'created_at', 'processed_at')
+    search_fields = ('topic', 'last_error')
+    list_filter = ('status', 'topic')
+    date_hierarchy = 'created_at'
+
 @admin.register(Card)
 class CardAdmin(admin.ModelAdmin):
     list_display = ('user', 'card_brand', 'card_type', 'card_number', 'status', 'expiry_date')
@@ -0,0 +1,128 @@
+"""
+Native async versions of the read-only endpoints, for ASGI deployments.
+
+DRF views are sync-only, so under ASGI every request to them is pushed through
+``sync_to_async``. These views return the same responses as their DRF
+counterparts but authenticate, query and paginate with Django's async ORM.
+They are routed in place of the DRF views when ``ASYNC_READ_VIEWS = True``
+(see ``api/urls.py``).
+"""
+from functools import wraps
+
+from django.http import HttpResponse
+from rest_framework.exceptions import APIException, AuthenticationFailed
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .conditional import alist_validators, conditional_response, set_validators
+from .authentication import aresolve_token, token_from_header
+from .models import UserProfile, Transaction, Message
+from .pagination import KeysetPagination
+from .serializers import TransactionSerializer, MessageSerializer, transaction_rows, message_rows
+
+_renderer = JSONRenderer()
+
+
+def render(data, status=200, headers=None):
+    """Render like DRF's JSONRenderer so both code paths return identical bytes"""
+    return HttpResponse(_renderer.render(data), status=status,
+                        content_type='application/json', headers=headers)
+
+
+async def aauthenticate(request):
+    """
+    Resolve the user for ``Authorization: Token <key>`` (through the token
+    cache) or a session.
+
+    Returns ``(user, error_detail)``; an invalid token is an error even when a
+    session is present, matching DRF's TokenAuthentication.
+    """
+    try:
+        key = token_from_header(request)
+        if key:
+            return (await aresolve_token(key))[0], None
+    except AuthenticationFailed as exc:
+        return None, exc.detail
+
+    user = await request.auser() if hasattr(request, 'auser') else None
+    if user is not None and user.is_authenticated:
+        return user, None
+    return None, 'Authentication credentials were not provided.'
+
+
+def async_api_view(view):
+    """Allow GET only and require an authenticated user, answering like DRF does"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return render({'detail': f'Method "{request.method}" not allowed.'}, status=405,
+                          headers={'Allow': 'GET'})
+
+        user, error = await aauthenticate(request)
+        if user is None:
+            return render({'detail': error}, status=401, headers={'WWW-Authenticate': 'Token'})
+
+        request.user = user
+        try:
+            return await view(request, *args, **kwargs)
+        except APIException as exc:
+            return render({'detail': exc.detail}, status=exc.status_code)
+    return wrapper
+
+
+@async_api_view
+async def verify_account(request, account_number):
+    """Verify if an account number exists and return the account holder's name"""
+    try:
+        profile = await UserProfile.objects.select_related('user').afind(account_number=account_number)
+    except UserProfile.DoesNotExist:
+        profile = None
+    if profile is None:
+        return render({
+            'exists': False,
+            'message': 'Account not found'
+        }, status=404)
+
+    return render({
+        'exists': True,
+        'name': f"{profile.user.first_name} {profile.user.last_name}".strip() or profile.user.username,
+        'bank': 'Secure Cipher Bank'
+    })
+
+
+def list_view(model, row_serializer):
+    """Keyset-paginated list of the user's rows, like the DRF viewsets' list()"""
+    @async_api_view
+    async def view(request):
+        queryset = model.objects.for_user(request.user)
+        etag, last_modified = await alist_validators(queryset, request)
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        paginator = KeysetPagination()
+        drf_request = Request(request)
+        page = await paginator.apaginate_queryset(queryset.values(*row_serializer.columns), drf_request)
+        data = row_serializer.serialize(page)
+        return set_validators(render(paginator.get_paginated_data(data)), etag, last_modified)
+    return view
+
+
+def detail_view(model, serializer_class):
+    """A single row owned by the user, like the DRF viewsets' retrieve()"""
+    @async_api_view
+    async def view(request, pk):
+        try:
+            instance = await model.objects.for_user(request.user).filter(pk=pk).afirst()
+        except (TypeError, ValueError):
+            instance = None
+        if instance is None:
+            return render({'detail': 'Not found.'}, status=404)
+        return render(serializer_class(instance).data)
+    return view
+
+
+transaction_list = list_view(Transaction, transaction_rows)
+transaction_detail = detail_view(Transaction, TransactionSerializer)
+message_list = list_view(Message, message_rows)
+message_detail = detail_view(Message, MessageSerializer)
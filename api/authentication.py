@@ -0,0 +1,251 @@
+"""
+Token authentication backed by a per-process cache.
+
+DRF's TokenAuthentication joins Token and User on every request, and the
+signature middleware and views then load the UserProfile again. Here a token
+key maps to its (user, token, profile) for ``AUTH_TOKEN_CACHE_TTL`` seconds,
+so a warm request authenticates without touching the database, and the
+profile is attached to the user so ``request.user.profile`` is loaded at most
+once per request whichever way the user was authenticated.
+
+Every hit hands out copies of the cached instances, so a request can modify
+its user or profile without affecting other requests. ``account_balance``
+and ``public_key`` are deferred and always read fresh from the database when
+accessed, so a rotated or revoked signing key takes effect in every worker
+at once. Other profile fields can be up to a TTL old in other worker
+processes after a change; this process's entries are dropped by
+``invalidate_user()``, which the profile-writing views and ``logout_user``
+call.
+
+A deleted token (logout) or a deactivated user must stop working in every
+worker at once, so revocations go through the Django cache
+(``AUTH_TOKEN_REVOCATION_CACHE``, default ``default``): ``revoke_token()``
+writes a new generation for the token key there, and a cached entry is only
+used while the generation it was loaded under is still current. Use a cache
+shared by all workers (e.g. Redis or Memcached); with the per-process
+``LocMemCache`` a revocation reaches other workers only when their entry
+expires, after up to ``AUTH_TOKEN_CACHE_TTL`` seconds.
+
+With sharded accounts (see ``api/shards.py``) the profile can't be joined to
+the token; a miss loads it from the user's shard with a second query.
+"""
+import copy
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework import HTTP_HEADER_ENCODING
+from rest_framework.authentication import TokenAuthentication, SessionAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .lru import LRUCache
+from .models import UserProfile
+from .shards import is_sharded
+
+
+class TokenCache(LRUCache):
+    """
+    Size-bounded LRU of token key -> (user, token, profile) with a TTL. Each
+    entry remembers the revocation generation it was loaded under.
+    """
+
+    def __init__(self, max_size=10000, ttl=30):
+        super().__init__(max_size, ttl)
+
+    def get(self, key, generation=None):
+        """Return fresh copies of ``(user, token, profile)``, or None"""
+        entry = super().get(key, matches=lambda entry: entry[3] == generation)
+        if entry is None:
+            return None
+        user, token, profile, _ = entry
+        return attach_profile(copy.copy(user), copy.copy(token), copy.copy(profile))
+
+    def set(self, key, user, token, profile, generation=None):
+        # Keep private copies; the caller's instances belong to its request
+        super().set(key, (*attach_profile(copy.copy(user), copy.copy(token), copy.copy(profile)), generation))
+
+    def invalidate_user(self, user_id):
+        """Drop every cached token of ``user_id``"""
+        self.invalidate_where(lambda entry: entry[0].pk == user_id)
+
+
+token_cache = TokenCache(
+    max_size=getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 30),
+)
+
+
+def attach_profile(user, token, profile):
+    """Link the copies so ``user.profile`` and ``token.user`` need no query"""
+    token._state.fields_cache['user'] = user
+    if profile is not None:
+        user._state.fields_cache['profile'] = profile
+        profile._state.fields_cache['user'] = user
+    return user, token, profile
+
+
+# Never served from the cache: they load on access
+FRESH_PROFILE_FIELDS = ('account_balance', 'public_key')
+
+
+def _token_queryset():
+    if is_sharded():
+        return Token.objects.select_related('user')
+    return Token.objects.select_related('user__profile').defer(
+        *(f'user__profile__{field}' for field in FRESH_PROFILE_FIELDS)
+    )
+
+
+def _sharded_profile(user):
+    return UserProfile.objects.for_user(user).defer(*FRESH_PROFILE_FIELDS)
+
+
+def _memoize_profile(user, profile):
+    if profile is not None:
+        user._state.fields_cache['profile'] = profile
+    return profile
+
+
+def _profile_of(user):
+    if is_sharded():
+        return _memoize_profile(user, _sharded_profile(user).first())
+    try:
+        return user.profile
+    except UserProfile.DoesNotExist:
+        return None
+
+
+async def _aprofile_of(user):
+    if is_sharded():
+        return _memoize_profile(user, await _sharded_profile(user).afirst())
+    return _profile_of(user)
+
+
+def _check_user(user):
+    if not user.is_active:
+        raise AuthenticationFailed('User inactive or deleted.')
+
+
+def _revocations():
+    return caches[getattr(settings, 'AUTH_TOKEN_REVOCATION_CACHE', 'default')]
+
+
+def _revocation_key(key):
+    return f'auth-token-generation:{key}'
+
+
+def revoke_token(key):
+    """Stop every worker's cached copy of token ``key`` from being used"""
+    token_cache.invalidate(key)
+    # Outlives every entry loaded before the revocation
+    ttl = token_cache.ttl
+    _revocations().set(_revocation_key(key), uuid.uuid4().hex, timeout=None if ttl is None else max(1, 2 * ttl))
+
+
+@receiver(post_delete, sender=Token)
+def _token_deleted(sender, instance, **kwargs):
+    revoke_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, **kwargs):
+    if not instance.is_active:
+        for key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+            revoke_token(key)
+
+
+def resolve_token(key):
+    """Return the ``(user, token)`` for a token key; raises AuthenticationFailed"""
+    # Read before the database, so a revocation racing the load still wins
+    generation = _revocations().get(_revocation_key(key))
+    cached = token_cache.get(key, generation)
+    if cached is None:
+        try:
+            token = _token_queryset().get(key=key)
+        except Token.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+        _check_user(token.user)
+        token_cache.set(key, token.user, token, _profile_of(token.user), generation)
+        return token.user, token
+    user, token, _ = cached
+    _check_user(user)
+    return user, token
+
+
+async def aresolve_token(key):
+    """Async version of resolve_token"""
+    generation = await _revocations().aget(_revocation_key(key))
+    cached = token_cache.get(key, generation)
+    if cached is None:
+        try:
+            token = await _token_queryset().aget(key=key)
+        except Token.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+        _check_user(token.user)
+        token_cache.set(key, token.user, token, await _aprofile_of(token.user), generation)
+        return token.user, token
+    user, token, _ = cached
+    _check_user(user)
+    return user, token
+
+
+def token_from_header(request):
+    """
+    The key from ``Authorization: Token <key>``; None if there is no token
+    header. Raises AuthenticationFailed for a malformed one, like DRF.
+    """
+    auth = request.META.get('HTTP_AUTHORIZATION', b'')
+    if isinstance(auth, str):
+        auth = auth.encode(HTTP_HEADER_ENCODING)
+    auth = auth.split()
+    if not auth or auth[0].lower() != TokenAuthentication.keyword.lower().encode():
+        return None
+    if len(auth) != 2:
+        raise AuthenticationFailed('Invalid token header.')
+    try:
+        return auth[1].decode()
+    except UnicodeError:
+        raise AuthenticationFailed('Invalid token header. Token string should not contain invalid characters.')
+
+
+def request_user(request):
+    """
+    The user making ``request``, for middleware. DRF authenticates tokens only
+    when the view runs, so a token is resolved here (through the token cache)
+    first; a bad token gives None.
+    """
+    try:
+        key = token_from_header(request)
+        if key:
+            return resolve_token(key)[0]
+    except AuthenticationFailed:
+        return None
+    return getattr(request, 'user', None)
+
+
+async def arequest_user(request):
+    """Async version of request_user"""
+    try:
+        key = token_from_header(request)
+        if key:
+            return (await aresolve_token(key))[0]
+    except AuthenticationFailed:
+        return None
+    if hasattr(request, 'auser'):
+        return await request.auser()
+    return getattr(request, 'user', None)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that resolves tokens through ``token_cache``"""
+
+    def authenticate_credentials(self, key):
+        return resolve_token(key)
+
+
+# Used by the API views in place of DRF's default authentication classes
+API_AUTHENTICATION_CLASSES = [CachedTokenAuthentication, SessionAuthentication]
@@ -0,0 +1,84 @@
+"""
+Conditional GET for the endpoints the mobile app polls.
+
+The validators for a list come from one aggregate query over the rows it
+pages through: ``max(updated_at)`` catches edits, ``max(id)`` inserts and the
+count deletions. They are hashed with the user, the full path (cursor and
+page size) and the Accept header into a strong ``ETag``. A request whose
+``If-None-Match`` matches is answered ``304 Not Modified`` before the page
+is fetched or serialized.
+
+``Last-Modified`` is only sent where ``max(updated_at)`` moves on every
+change, i.e. the single-row profile; deleting a transaction or message
+leaves it unchanged, so those lists are validated by ETag alone.
+Balance updates bypass ``auto_now`` and set ``UserProfile.updated_at``
+themselves (see ``api/transfers.py``). A hot account's credits only touch its
+``BalanceSlot`` rows, so the profile list also takes ``max(updated_at)`` of
+the slots (``related_latest``). Editing the user's name or email touches
+neither, so the profile list also hashes those columns (``related_values``).
+"""
+import calendar
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def _aggregates(related_latest=None, related_values=()):
+    aggregates = {'latest': Max('updated_at'), 'last_id': Max('id'), 'count': Count('id')}
+    if related_latest:
+        # The join repeats each row once per related row
+        aggregates.update(count=Count('id', distinct=True), related_latest=Max(related_latest))
+    for index, field in enumerate(related_values):
+        # Exact for a single-row list; over several rows only the max would count
+        aggregates[f'related_value_{index}'] = Max(field)
+    return aggregates
+
+
+def _validators(request, stats, last_modified, related_values=()):
+    latest = max(filter(None, (stats['latest'], stats.get('related_latest'))), default=None)
+    raw = '|'.join((
+        str(request.user.pk),
+        request.get_full_path(),
+        request.META.get('HTTP_ACCEPT', ''),
+        str(stats['count']),
+        str(stats['last_id']),
+        latest.isoformat() if latest else '',
+        # repr() keeps '|' inside a value from running into the next one
+        *(repr(stats[f'related_value_{index}']) for index in range(len(related_values))),
+    ))
+    etag = '"%s"' % hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+    if last_modified and latest is not None:
+        return etag, calendar.timegm(latest.utctimetuple())
+    return etag, None
+
+
+def list_validators(queryset, request, last_modified=False, related_latest=None, related_values=()):
+    """
+    ``(etag, last_modified)`` for a list over ``queryset``; the timestamp only
+    if asked for. ``related_latest`` names another timestamp to take the max
+    of, and ``related_values`` columns of a single-row list whose values go
+    into the ETag.
+    """
+    stats = queryset.order_by().aggregate(**_aggregates(related_latest, related_values))
+    return _validators(request, stats, last_modified, related_values)
+
+
+async def alist_validators(queryset, request, last_modified=False, related_latest=None, related_values=()):
+    stats = await queryset.order_by().aaggregate(**_aggregates(related_latest, related_values))
+    return _validators(request, stats, last_modified, related_values)
+
+
+def conditional_response(request, etag, last_modified):
+    """A 304 (or 412) response when the request's preconditions say so, else None"""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    return set_validators(response, etag, last_modified) if response is not None else None
+
+
+def set_validators(response, etag, last_modified):
+    if 200 <= response.status_code < 300 or response.status_code == 304:
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
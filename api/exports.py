@@ -0,0 +1,99 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Transaction
+
+# Same columns as TransactionSerializer, minus the owner
+EXPORT_FIELDS = (
+    'id', 'type', 'amount', 'currency', 'description',
+    'recipient_name', 'recipient_account', 'recipient_bank',
+    'status', 'reference', 'balance_after', 'category',
+    'created_at', 'updated_at',
+)
+
+
+class Echo:
+    """File-like object whose write() just hands the line back, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def _parse_bound(value, end=False):
+    """Parse a YYYY-MM-DD date or ISO datetime; whole dates cover the full day"""
+    try:
+        day = parse_date(value)
+        moment = None if day else parse_datetime(value)
+    except ValueError:
+        day = moment = None
+    if day:
+        moment = datetime.combine(day + timedelta(days=1) if end else day, time.min)
+    elif moment is None:
+        raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD or an ISO datetime")
+    if settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def parse_date_range(params):
+    """Return (start, end) bounds from ``start``/``end`` query params; either may be None"""
+    start = params.get('start')
+    end = params.get('end')
+    start = _parse_bound(start) if start else None
+    end = _parse_bound(end, end=True) if end else None
+    if start and end and start >= end:
+        raise ValueError('start must be before end')
+    return start, end
+
+
+def export_queryset(user, start=None, end=None):
+    queryset = Transaction.objects.for_user(user)
+    if start:
+        queryset = queryset.filter(created_at__gte=start)
+    if end:
+        queryset = queryset.filter(created_at__lt=end)
+    return queryset.order_by('created_at', 'id').values_list(*EXPORT_FIELDS)
+
+
+def _format_datetime(value):
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _rows(queryset):
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+    created_at = EXPORT_FIELDS.index('created_at')
+    updated_at = EXPORT_FIELDS.index('updated_at')
+    for row in queryset.iterator(chunk_size=chunk_size):
+        row = list(row)
+        row[created_at] = _format_datetime(row[created_at])
+        row[updated_at] = _format_datetime(row[updated_at])
+        yield row
+
+
+def iter_csv(queryset):
+    """Yield the export as CSV lines, header first"""
+    writer = csv.writer(Echo())
+    # The header goes out before the query has even run
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in _rows(queryset):
+        yield writer.writerow(row)
+
+
+def iter_ndjson(queryset):
+    """Yield the export as one JSON object per line"""
+    for row in _rows(queryset):
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', iter_csv),
+    'ndjson': ('application/x-ndjson', iter_ndjson),
+}
@@ -0,0 +1,257 @@
+"""
+Encrypted request gateway.
+
+A client fetches the middleware's current ECDH public key and its ``key_id``
+from ``/api/middleware/public-key/`` and opens a session by POSTing to
+``/api/secure/gateway/``:
+
+    {"key_id": <id>, "ephemeral_public_key": <base64 DER or PEM>, "iv": <b64>, "ciphertext": <b64>}
+
+``key_id`` may name any key that hasn't expired yet (see ``api/key_ring.py``);
+without it the current key is used.
+
+The shared secret of the client's ephemeral key and the middleware ECDH key is
+run through HKDF-SHA256 to give an AES-256-GCM session key. The key is cached
+under a random session id, so follow-up requests only send
+
+    {"session_id": <id>, "iv": <b64>, "ciphertext": <b64>}
+
+and skip the key exchange and derivation. The plaintext is the request to
+forward, ``{"method", "path", "data", "headers"}``; it is run through the full
+middleware stack (signature checks included) and the reply comes back as
+``{"session_id", "key_id", "iv", "ciphertext", "signature"}``, where the
+ciphertext holds ``{"status", "content_type", "body"}`` and the signature is
+the ``key_id`` ECDSA key's signature over ``iv + ciphertext``.
+
+An unknown or expired session id gets a 401 and the client starts over with a
+new ephemeral key. Sessions live in process memory, so behind several workers
+a follow-up can land on a worker that hasn't seen the session and is answered
+the same way.
+"""
+import base64
+import json
+import os
+import secrets
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import WSGIRequest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from .key_ring import key_ring
+from .lru import LRUCache
+
+HKDF_INFO = b'securecipher-gateway-session'
+SESSION_KEY_BYTES = 32
+NONCE_BYTES = 12
+
+
+class GatewayError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class SessionKeyCache(LRUCache):
+    """
+    Process-wide, size-bounded LRU of gateway session ciphers with a TTL.
+
+    Each entry remembers the id of the middleware key it was negotiated with,
+    and expires ``ttl`` seconds after the handshake that created it, however
+    often it is used.
+    """
+
+    def __init__(self, max_size=10000, ttl=900):
+        super().__init__(max_size, ttl)
+
+    def create(self, key, key_id):
+        """Store a new session key; returns ``(session_id, cipher)``"""
+        session_id = secrets.token_urlsafe(24)
+        cipher = AESGCM(key)
+        self.set(session_id, (cipher, key_id))
+        return session_id, cipher
+
+    def get(self, session_id):
+        """Return ``(cipher, key_id)`` for the session, or None if unknown or expired"""
+        return super().get(session_id)
+
+
+session_cache = SessionKeyCache(
+    max_size=getattr(settings, 'GATEWAY_SESSION_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'GATEWAY_SESSION_TTL', 900),
+)
+
+
+def load_client_public_key(value):
+    """Parse the client's ephemeral public key (PEM, or base64 DER like UserProfile.public_key)"""
+    try:
+        if value.lstrip().startswith('-----BEGIN'):
+            return serialization.load_pem_public_key(value.encode('ascii'))
+        return serialization.load_der_public_key(base64.b64decode(value))
+    except (ValueError, TypeError, UnicodeError):
+        raise GatewayError('Invalid ephemeral public key')
+
+
+def derive_session_key(ecdh_private_key, client_public_key):
+    """ECDH with the client's ephemeral key, stretched to an AES-256 key with HKDF"""
+    if not isinstance(client_public_key, ec.EllipticCurvePublicKey) or \
+            client_public_key.curve.name != ecdh_private_key.curve.name:
+        raise GatewayError(f'Ephemeral key must be on curve {ecdh_private_key.curve.name}')
+    shared_secret = ecdh_private_key.exchange(ec.ECDH(), client_public_key)
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=SESSION_KEY_BYTES,
+        salt=None,
+        info=HKDF_INFO,
+    ).derive(shared_secret)
+
+
+def _b64_field(envelope, name):
+    try:
+        return base64.b64decode(envelope[name], validate=True)
+    except (KeyError, TypeError, ValueError):
+        raise GatewayError(f'Missing or invalid {name}')
+
+
+def handshake_key(key_id):
+    """The middleware key a handshake names, or the current one"""
+    if not key_id:
+        return key_ring.current()
+    keys = key_ring.get(key_id)
+    if keys is None:
+        raise GatewayError('Unknown or expired key_id')
+    return keys
+
+
+def open_envelope(envelope):
+    """Return (session_id, key_id, cipher, decrypted request dict) for an incoming envelope"""
+    if not isinstance(envelope, dict):
+        raise GatewayError('Expected a JSON object')
+
+    session_id = envelope.get('session_id')
+    if session_id:
+        session = session_cache.get(session_id)
+        if session is None:
+            raise GatewayError('Session expired', status_code=401)
+        cipher, key_id = session
+    elif envelope.get('ephemeral_public_key'):
+        keys = handshake_key(envelope.get('key_id'))
+        client_key = load_client_public_key(envelope['ephemeral_public_key'])
+        key = derive_session_key(keys.ecdh_private_key, client_key)
+        key_id = keys.key_id
+        session_id, cipher = session_cache.create(key, key_id)
+    else:
+        raise GatewayError('Either session_id or ephemeral_public_key is required')
+
+    iv = _b64_field(envelope, 'iv')
+    ciphertext = _b64_field(envelope, 'ciphertext')
+    try:
+        inner = json.loads(cipher.decrypt(iv, ciphertext, None))
+    except (InvalidTag, ValueError):
+        raise GatewayError('Unable to decrypt payload')
+    if not isinstance(inner, dict):
+        raise GatewayError('Decrypted payload must be a JSON object')
+    return session_id, key_id, cipher, inner
+
+
+def seal(session_id, key_id, cipher, payload):
+    """
+    Encrypt ``payload`` for the client and sign the ciphertext with the
+    session's middleware key (the current key once that one has expired)
+    """
+    keys = key_ring.get(key_id) or key_ring.current()
+    iv = os.urandom(NONCE_BYTES)
+    ciphertext = cipher.encrypt(iv, json.dumps(payload).encode('utf-8'), None)
+    signature = keys.ecdsa_private_key.sign(iv + ciphertext, ec.ECDSA(hashes.SHA384()))
+    return {
+        'session_id': session_id,
+        'key_id': keys.key_id,
+        'iv': base64.b64encode(iv).decode('ascii'),
+        'ciphertext': base64.b64encode(ciphertext).decode('ascii'),
+        'signature': base64.b64encode(signature).decode('ascii'),
+    }
+
+
+_handler = None
+_handler_lock = threading.Lock()
+
+
+def get_handler():
+    """A request handler with the project's middleware loaded, for forwarded requests"""
+    global _handler
+    if _handler is None:
+        with _handler_lock:
+            if _handler is None:
+                handler = BaseHandler()
+                handler.load_middleware()
+                _handler = handler
+    return _handler
+
+
+def build_request(outer, inner):
+    """Turn a decrypted ``{"method", "path", "data", "headers"}`` into a WSGIRequest"""
+    method = str(inner.get('method') or 'GET').upper()
+    path = inner.get('path')
+    if not isinstance(path, str) or not path.startswith('/'):
+        raise GatewayError('Invalid path')
+    url = urlsplit(path)
+    if url.path == outer.path:
+        raise GatewayError('Gateway requests cannot be nested')
+
+    data = inner.get('data')
+    body = b'' if data is None else json.dumps(data).encode('utf-8')
+
+    # Server details come from the outer request; client headers only from the envelope
+    environ = {
+        name: value for name, value in outer.META.items()
+        if not name.startswith('HTTP_') and name not in ('CONTENT_TYPE', 'CONTENT_LENGTH')
+    }
+    environ.setdefault('wsgi.url_scheme', outer.scheme)
+    if 'HTTP_HOST' in outer.META:
+        environ['HTTP_HOST'] = outer.META['HTTP_HOST']
+    headers = inner.get('headers') or {}
+    if not isinstance(headers, dict):
+        raise GatewayError('headers must be an object')
+    for name, value in headers.items():
+        environ['HTTP_' + str(name).upper().replace('-', '_')] = str(value)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+    })
+    return WSGIRequest(environ)
+
+
+def forward(outer, inner):
+    """Run the decrypted request through the middleware stack and describe the response"""
+    response = get_handler().get_response(build_request(outer, inner))
+    # No response.close(): it sends request_finished, which would close the
+    # database connections the outer request is still using
+    if response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+
+    content_type = response.get('Content-Type', '')
+    body = content.decode(response.charset or 'utf-8')
+    if content_type.startswith('application/json') and body:
+        body = json.loads(body)
+    return {'status': response.status_code, 'content_type': content_type, 'body': body}
+
+
+def handle_envelope(outer, envelope):
+    """Decrypt, forward and re-encrypt one gateway request"""
+    session_id, key_id, cipher, inner = open_envelope(envelope)
+    return seal(session_id, key_id, cipher, forward(outer, inner))
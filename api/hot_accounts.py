@@ -0,0 +1,123 @@
+"""
+Sharded balance counters for hot accounts.
+
+Every credit updates the recipient's ``UserProfile`` row, so when thousands
+of customers pay one merchant at once their transfers queue on that row's
+lock. An account with ``balance_slots = K`` (see ``set_balance_slots``) takes
+each credit into one of K ``BalanceSlot`` rows picked at random instead, and
+transfers to it don't lock its profile: up to K credits run in parallel.
+``roll_up()`` (``python manage.py roll_up_balances``) folds the slots back
+into ``account_balance`` every few seconds.
+
+The balance shown to the customer and written to ``balance_after`` is
+``account_balance`` plus the slots (``UserProfile.balance``). It is read
+without locking the account, so under concurrent credits a hot account's
+``balance_after`` values are not strictly in ledger order. Debits only
+spend rolled-up money, since the debit guard checks ``account_balance``.
+A hot account's credits reach its daily snapshot at the roll-up, booked on
+the day of the roll-up.
+"""
+import random
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import BalanceSlot, UserProfile
+from .shards import account_db
+from .snapshots import ledger_date, record_day
+
+
+def credit_slot(profile_id, slots, amount, using=None, count=1):
+    """
+    Add ``amount`` (``count`` credits) to one of the account's ``slots`` slot
+    rows, chosen at random. Returns False if that slot no longer exists (the
+    account's slots were just reduced); credit the balance directly instead.
+    """
+    return BalanceSlot.objects.db_manager(using).filter(
+        profile_id=profile_id, slot=random.randrange(slots)
+    ).update(amount=F('amount') + amount, credits=F('credits') + count, updated_at=timezone.now()) == 1
+
+
+def pending_credits(profile_ids, using=None):
+    """Credits waiting in the slots of ``profile_ids``: ``{profile_id: total}``"""
+    return dict(
+        BalanceSlot.objects.db_manager(using).filter(profile_id__in=set(profile_ids))
+        .values('profile_id').annotate(total=Sum('amount')).values_list('profile_id', 'total')
+    )
+
+
+def roll_up(profile_id, using=None):
+    """
+    Fold an account's slots into its balance and daily snapshot. Returns the
+    number of credits folded in.
+    """
+    with transaction.atomic(using=using):
+        profile = (
+            UserProfile.objects.db_manager(using).select_for_update()
+            .only('id', 'user_id', 'account_balance').get(pk=profile_id)
+        )
+        slots = list(
+            BalanceSlot.objects.db_manager(using).select_for_update()
+            .filter(profile_id=profile_id, credits__gt=0)
+        )
+        if not slots:
+            return 0
+        total = sum(slot.amount for slot in slots)
+        count = sum(slot.credits for slot in slots)
+        now = timezone.now()
+
+        BalanceSlot.objects.db_manager(using).filter(pk__in=[slot.pk for slot in slots]).update(
+            amount=0, credits=0, updated_at=now
+        )
+        UserProfile.objects.db_manager(using).filter(pk=profile_id).update(
+            account_balance=F('account_balance') + total, updated_at=now
+        )
+        # Credits landing in other slots meanwhile wait for the next roll-up
+        record_day(
+            profile.user_id, ledger_date(now), profile.account_balance, profile.account_balance + total, count,
+            using=using,
+        )
+    return count
+
+
+def roll_up_all(using=None):
+    """Roll up every account with pending credits; returns ``(accounts, credits)``"""
+    profile_ids = (
+        BalanceSlot.objects.db_manager(using).filter(credits__gt=0)
+        .values_list('profile_id', flat=True).distinct()
+    )
+    accounts = credits = 0
+    for profile_id in list(profile_ids):
+        folded = roll_up(profile_id, using=using)
+        if folded:
+            accounts += 1
+            credits += folded
+    return accounts, credits
+
+
+def set_balance_slots(profile, slots):
+    """Spread ``profile``'s credits over ``slots`` slot rows, or stop with 0"""
+    using = account_db(profile.user_id)
+    with transaction.atomic(using=using):
+        UserProfile.objects.db_manager(using).filter(pk=profile.pk).update(
+            balance_slots=slots, updated_at=timezone.now()
+        )
+        # Credits already headed for a slot wait for this transaction, then
+        # find it rolled up or gone and credit the balance directly
+        list(
+            BalanceSlot.objects.db_manager(using).select_for_update()
+            .filter(profile_id=profile.pk).values_list('pk', flat=True)
+        )
+        removed = BalanceSlot.objects.db_manager(using).filter(profile_id=profile.pk, slot__gte=slots)
+        # Only empty slots are dropped: with 0 slots the balance ignores them
+        while True:
+            roll_up(profile.pk, using=using)
+            removed.filter(credits=0).delete()
+            if not removed.exists():
+                break
+        BalanceSlot.objects.db_manager(using).bulk_create(
+            [BalanceSlot(profile_id=profile.pk, slot=slot) for slot in range(slots)],
+            ignore_conflicts=True,
+        )
+    profile.balance_slots = slots
@@ -0,0 +1,238 @@
+"""
+Idempotency-Key support for transfers.
+
+A client retrying ``POST /api/transactions/transfer/`` (or a batch) sends the
+same ``Idempotency-Key`` header on every attempt. The first attempt to reach
+the view is processed as usual and its response stored in an
+``IdempotencyRecord``, unique on (user, key). Later attempts get that response
+back, marked ``Idempotent-Replayed: true``, without signature verification
+and without touching balances. Reusing a key for a different request is a 422.
+
+The record is inserted as the first statement of a database transaction that
+also covers the view, and the response is saved before that transaction
+commits. A record therefore only ever becomes visible together with the
+transfer it describes, and a concurrent duplicate in another worker blocks on
+the unique index until the first attempt commits (it then replays the stored
+response) or rolls back (it then goes ahead itself). A duplicate in the same
+worker waits on an in-process event, up to ``IDEMPOTENCY_WAIT_TIMEOUT``
+seconds, instead of holding a database connection.
+
+With sharded accounts (``api/shards.py``) the transfer commits on the
+sender's shard, which a transaction on ``default`` can't cover, and a
+transfer between shards must not run inside one at all. There the record is
+claimed in a transaction of its own before the view runs and filled in
+afterwards; a duplicate arriving meanwhile gets a 409. If the worker dies in
+between, the key stays claimed and its retries get 409s too, so that a
+transfer that may have gone through is never repeated.
+
+Only responses produced by the view are stored, and not 401, 403 or 5xx
+responses: none of those changed anything (a transfer between shards that
+answers 503 was reversed), and the client may retry them under the same key
+once the problem is fixed. A transfer between shards left pending answers
+202 and is stored like any completed transfer.
+
+Stored responses are also kept in a per-process cache
+(``IDEMPOTENCY_CACHE_SIZE`` entries for ``IDEMPOTENCY_CACHE_TTL`` seconds),
+so a repeat usually costs no query at all.
+
+Install ``api.idempotency.IdempotencyMiddleware`` after
+``AuthenticationMiddleware`` and before ``CryptographicSignatureMiddleware``.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import namedtuple
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import transaction, IntegrityError, OperationalError
+from django.http import HttpResponse, JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from .authentication import request_user
+from .lru import LRUCache
+from .models import IdempotencyRecord
+from .shards import is_sharded
+
+MAX_KEY_LENGTH = 255
+
+StoredResponse = namedtuple('StoredResponse', 'request_hash status content_type body')
+
+
+class ResponseCache(LRUCache):
+    """Size-bounded LRU of (user id, key) -> StoredResponse with a TTL"""
+
+    def __init__(self, max_size=10000, ttl=300):
+        super().__init__(max_size, ttl)
+
+
+response_cache = ResponseCache(
+    max_size=getattr(settings, 'IDEMPOTENCY_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'IDEMPOTENCY_CACHE_TTL', 300),
+)
+
+
+def request_hash(request):
+    """Fingerprint of what a request asks for; signature headers are left out"""
+    digest = hashlib.sha256()
+    digest.update(f'{request.method}\n{request.path}\n'.encode('utf-8'))
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _stored(record):
+    return StoredResponse(
+        record.request_hash, record.response_status,
+        record.response_content_type, bytes(record.response_body),
+    )
+
+
+class IdempotencyMiddleware(MiddlewareMixin):
+    """Replays the stored response for a repeated Idempotency-Key"""
+
+    IDEMPOTENT_ENDPOINTS = [
+        '/api/transactions/transfer/',  # Includes transfer/batch/
+    ]
+
+    IDEMPOTENT_METHODS = ['POST']
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self._methods = frozenset(self.IDEMPOTENT_METHODS)
+        self._paths = re.compile('|'.join(re.escape(endpoint) for endpoint in self.IDEMPOTENT_ENDPOINTS))
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def __call__(self, request):
+        if self._idempotency_key(request) is None:
+            return self.get_response(request)
+        return self._handle(request, self.get_response)
+
+    async def __acall__(self, request):
+        if self._idempotency_key(request) is None:
+            return await self.get_response(request)
+        # The transaction has to span the view, so run on the thread the sync views use
+        return await sync_to_async(self._handle, thread_sensitive=True)(
+            request, async_to_sync(self.get_response)
+        )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Only reached once every middleware, signature checks included, let the request through
+        request.idempotency_view_called = True
+        return None
+
+    def _idempotency_key(self, request):
+        if request.method not in self._methods or self._paths.match(request.path) is None:
+            return None
+        return request.META.get('HTTP_IDEMPOTENCY_KEY') or None
+
+    def _handle(self, request, get_response):
+        key = self._idempotency_key(request)
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({
+                'error': 'Invalid Idempotency-Key',
+                'details': f'Keys are at most {MAX_KEY_LENGTH} characters'
+            }, status=400)
+
+        user = request_user(request)
+        if user is None or not user.is_authenticated:
+            # Nothing to scope the key to; the request is rejected further in anyway
+            return get_response(request)
+
+        fingerprint = request_hash(request)
+        cache_key = (user.pk, key)
+        deadline = time.monotonic() + getattr(settings, 'IDEMPOTENCY_WAIT_TIMEOUT', 30)
+        while True:
+            stored = response_cache.get(cache_key)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+            with self._inflight_lock:
+                done = self._inflight.get(cache_key)
+                if done is None:
+                    self._inflight[cache_key] = threading.Event()
+                    break
+            # Another thread of this worker has the key; its response lands in the cache
+            if not done.wait(max(0, deadline - time.monotonic())):
+                return self._in_progress()
+
+        try:
+            return self._execute(request, get_response, user, key, fingerprint, cache_key)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(cache_key).set()
+
+    def _execute(self, request, get_response, user, key, fingerprint, cache_key):
+        if is_sharded():
+            return self._execute_claimed(request, get_response, user, key, fingerprint, cache_key)
+        try:
+            with transaction.atomic():
+                # Blocks a concurrent duplicate in another worker until this commits
+                record = IdempotencyRecord.objects.create(user_id=user.pk, key=key, request_hash=fingerprint)
+                response = get_response(request)
+                if not self._storable(request, response):
+                    transaction.set_rollback(True)
+                    return response
+                record.response_status = response.status_code
+                record.response_content_type = response.get('Content-Type', '')
+                record.response_body = response.content
+                record.save(update_fields=['response_status', 'response_content_type', 'response_body'])
+        except IntegrityError:
+            return self._replay_existing(user, key, fingerprint, cache_key)
+        except OperationalError:
+            # e.g. SQLite giving up on the lock the first attempt holds
+            return self._in_progress()
+        response_cache.set(cache_key, _stored(record))
+        return response
+
+    def _execute_claimed(self, request, get_response, user, key, fingerprint, cache_key):
+        """_execute() without a transaction around the view, for sharded accounts"""
+        try:
+            record = IdempotencyRecord.objects.create(user_id=user.pk, key=key, request_hash=fingerprint)
+        except IntegrityError:
+            return self._replay_existing(user, key, fingerprint, cache_key)
+        except OperationalError:
+            return self._in_progress()
+        response = get_response(request)
+        if not self._storable(request, response):
+            record.delete()
+            return response
+        record.response_status = response.status_code
+        record.response_content_type = response.get('Content-Type', '')
+        record.response_body = response.content
+        record.save(update_fields=['response_status', 'response_content_type', 'response_body'])
+        response_cache.set(cache_key, _stored(record))
+        return response
+
+    def _replay_existing(self, user, key, fingerprint, cache_key):
+        record = IdempotencyRecord.objects.filter(user_id=user.pk, key=key).first()
+        if record is None or record.response_status is None:
+            # Rolled back meanwhile, or claimed and still running
+            return self._in_progress()
+        stored = _stored(record)
+        response_cache.set(cache_key, stored)
+        return self._replay(stored, fingerprint)
+
+    def _storable(self, request, response):
+        return (
+            getattr(request, 'idempotency_view_called', False)
+            and not response.streaming
+            and response.status_code < 500
+            and response.status_code not in (401, 403)
+        )
+
+    def _replay(self, stored, fingerprint):
+        if stored.request_hash != fingerprint:
+            return JsonResponse({
+                'error': 'Idempotency-Key reused',
+                'details': 'This key was already used for a different request'
+            }, status=422)
+        response = HttpResponse(stored.body, status=stored.status, content_type=stored.content_type)
+        response['Idempotent-Replayed'] = 'true'
+        return response
+
+    def _in_progress(self):
+        return JsonResponse({
+            'error': 'Request in progress',
+            'details': 'A request with this Idempotency-Key is still being processed'
+        }, status=409)
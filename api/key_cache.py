@@ -0,0 +1,46 @@
+import base64
+import hashlib
+
+from django.conf import settings
+from cryptography.hazmat.primitives import serialization
+
+from .lru import LRUCache
+
+
+def key_fingerprint(public_key_b64):
+    """Return a short, stable fingerprint of a stored (base64 DER) public key"""
+    return hashlib.sha256(public_key_b64.encode('utf-8')).digest()[:16]
+
+
+class PublicKeyCache(LRUCache):
+    """
+    Process-wide, size-bounded LRU of parsed user public keys.
+
+    Entries are keyed by user id and remember the fingerprint of the stored key
+    they were parsed from, so a key changed by another process is detected on
+    the next lookup and re-parsed instead of being served stale.
+    """
+
+    def __init__(self, max_size=1024):
+        super().__init__(max_size)
+
+    def get(self, user_id, public_key_b64):
+        """Return the parsed public key for ``user_id``, loading it on a miss"""
+        fingerprint = key_fingerprint(public_key_b64)
+        entry = super().get(user_id, matches=lambda entry: entry[0] == fingerprint)
+        if entry is not None:
+            return entry[1]
+
+        # Parse outside the lock so a slow load doesn't block other requests
+        public_key = serialization.load_der_public_key(base64.b64decode(public_key_b64))
+        self.set(user_id, (fingerprint, public_key))
+        return public_key
+
+    def invalidate(self, user_id):
+        """Drop the cached key for ``user_id`` (e.g. after the key was changed)"""
+        super().invalidate(user_id)
+
+
+public_key_cache = PublicKeyCache(
+    max_size=getattr(settings, 'SIGNATURE_KEY_CACHE_SIZE', 1024)
+)
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from .models import MiddlewareKey
+
+logger = logging.getLogger(__name__)
+
+# A MiddlewareKey row with its private keys already deserialized
+ParsedKey = namedtuple(
+    'ParsedKey',
+    'key_id ecdsa_private_key ecdsa_public_pem ecdh_private_key ecdh_public_pem '
+    'is_active expires_at created_at updated_at',
+)
+
+
+def _pem(private_key):
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode('ascii')
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode('ascii')
+    return private_pem, public_pem
+
+
+def generate_middleware_key():
+    """Create and store a fresh, active P-384 ECDSA/ECDH key pair"""
+    ecdsa_private, ecdsa_public = _pem(ec.generate_private_key(ec.SECP384R1()))
+    ecdh_private, ecdh_public = _pem(ec.generate_private_key(ec.SECP384R1()))
+    return MiddlewareKey.objects.create(
+        ecdsa_private_key=ecdsa_private,
+        ecdsa_public_key=ecdsa_public,
+        ecdh_private_key=ecdh_private,
+        ecdh_public_key=ecdh_public,
+    )
+
+
+def parse_key(record):
+    return ParsedKey(
+        key_id=record.key_id,
+        ecdsa_private_key=serialization.load_pem_private_key(
+            record.ecdsa_private_key.encode('ascii'), password=None),
+        ecdsa_public_pem=record.ecdsa_public_key,
+        ecdh_private_key=serialization.load_pem_private_key(
+            record.ecdh_private_key.encode('ascii'), password=None),
+        ecdh_public_pem=record.ecdh_public_key,
+        is_active=record.is_active,
+        expires_at=record.expires_at,
+        created_at=record.created_at,
+        updated_at=record.updated_at,
+    )
+
+
+def is_valid(key, now):
+    return key.expires_at is None or key.expires_at > now
+
+
+class MiddlewareKeyRing:
+    """
+    Process-wide view of the MiddlewareKey table, indexed by key id.
+
+    Keys are parsed once and kept in memory. At most every ``poll_interval``
+    seconds the ring reads a cheap version stamp (row count and newest
+    ``updated_at``); only when that changes does it fetch the key ids and
+    parse the rows that are new or were modified. A rotation done by
+    another process is therefore picked up within one interval, without a
+    restart and without a query per request.
+
+    Several keys can be valid at once: the newest active key is the one
+    offered to clients, while retired keys keep working until they expire.
+    """
+
+    def __init__(self, poll_interval=30):
+        self.poll_interval = poll_interval
+        self._keys = {}
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _version_stamp(self):
+        stamp = MiddlewareKey.objects.aggregate(count=Count('id'), latest=Max('updated_at'))
+        return stamp['count'], stamp['latest']
+
+    def refresh(self, force=False):
+        """Reload changed keys if the table's version stamp moved"""
+        checked_at = self._checked_at
+        if not force and checked_at is not None and time.monotonic() - checked_at < self.poll_interval:
+            return
+
+        # Once loaded, let a single thread poll while the others keep using the current keys
+        if not self._lock.acquire(blocking=force or checked_at is None):
+            return
+        try:
+            if not force and self._checked_at is not None and self._checked_at != checked_at:
+                return
+            version = self._version_stamp()
+            self._checked_at = time.monotonic()
+            if version == self._version:
+                return
+
+            known = self._keys
+            current = dict(MiddlewareKey.objects.values_list('key_id', 'updated_at'))
+            changed = [
+                key_id for key_id, updated_at in current.items()
+                if key_id not in known or known[key_id].updated_at != updated_at
+            ]
+            keys = {key_id: known[key_id] for key_id in current if key_id not in changed}
+            for record in MiddlewareKey.objects.filter(key_id__in=changed):
+                keys[record.key_id] = parse_key(record)
+
+            self._keys = keys
+            self._version = version
+            if changed:
+                logger.info(f"Loaded middleware keys: {', '.join(changed)}")
+        finally:
+            self._lock.release()
+
+    def current(self):
+        """The newest active, unexpired key; one is generated if there is none"""
+        self.refresh()
+        key = self._newest_active()
+        if key is None:
+            logger.warning("No active middleware key found, generating one")
+            generate_middleware_key()
+            self.refresh(force=True)
+            key = self._newest_active()
+        return key
+
+    def get(self, key_id):
+        """The key with ``key_id`` if it is still valid (active or retiring), else None"""
+        self.refresh()
+        key = self._keys.get(key_id)
+        if key is not None and is_valid(key, timezone.now()):
+            return key
+        return None
+
+    def valid_keys(self):
+        """All keys that are still accepted, newest first"""
+        self.refresh()
+        now = timezone.now()
+        keys = [key for key in self._keys.values() if is_valid(key, now)]
+        return sorted(keys, key=lambda key: key.created_at, reverse=True)
+
+    def _newest_active(self):
+        now = timezone.now()
+        active = [key for key in self._keys.values() if key.is_active and is_valid(key, now)]
+        return max(active, key=lambda key: key.created_at, default=None)
+
+    def reset(self):
+        """Forget all loaded keys; the next lookup reloads them"""
+        with self._lock:
+            self._keys = {}
+            self._version = None
+            self._checked_at = None
+
+
+key_ring = MiddlewareKeyRing(
+    poll_interval=getattr(settings, 'MIDDLEWARE_KEY_POLL_INTERVAL', 30)
+)
@@ -0,0 +1,368 @@
+import base64
+import http.client
+import itertools
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api.models import UserProfile, Message, OutboxEvent
+from api.transfers import INTERNAL_BANK_NAME
+
+SCENARIOS = (
+    'register', 'login', 'transfer', 'verify_account',
+    'profiles', 'transactions', 'messages', 'cards',
+)
+PASSWORD = 'bench-password-123'
+
+
+def allowed_host():
+    """A host name the request validation accepts, for the test client"""
+    for pattern in settings.ALLOWED_HOSTS:
+        if pattern == '*':
+            return 'testserver'
+        return pattern.lstrip('.')
+    return 'localhost'  # What DEBUG allows when ALLOWED_HOSTS is empty
+
+
+class InProcessTarget:
+    """Requests through the Django test client, counting queries per request"""
+
+    def __init__(self):
+        self.client = Client(SERVER_NAME=allowed_host())
+
+    def request(self, method, path, data=None, headers=None):
+        extra = {f"HTTP_{name.upper().replace('-', '_')}": value for name, value in (headers or {}).items()}
+        with CaptureQueriesContext(connection) as queries:
+            if method == 'GET':
+                response = self.client.get(path, **extra)
+            else:
+                response = self.client.generic(method, path, json.dumps(data), 'application/json', **extra)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return response.status_code, len(queries)
+
+
+class HttpTarget:
+    """Requests over a keep-alive HTTP connection; query counts are unknown"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+
+    def request(self, method, path, data=None, headers=None):
+        body = None if data is None else json.dumps(data)
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        for retry in (False, True):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                response.read()
+                if response.will_close:
+                    self.connection.close()
+                    self.connection = None
+                return response.status, None
+            except (ConnectionError, http.client.HTTPException):
+                # The server dropped an idle keep-alive connection; reconnect once
+                self.connection.close()
+                self.connection = None
+                if retry:
+                    raise
+
+
+class Command(BaseCommand):
+    help = (
+        "Latency and throughput benchmark for the main API endpoints: registration, "
+        "login, signed transfers, account verification and the list endpoints. Runs "
+        "in-process through the Django test client (reporting DB queries per request) "
+        "or against a running server with --url, or starts a local gunicorn with "
+        "--gunicorn. Seeds its own accounts and removes them afterwards. Use --output "
+        "to save the results as JSON and --baseline to fail on regressions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated subset of: {', '.join(SCENARIOS)}")
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=1, help='Client threads')
+        parser.add_argument('--users', type=int, default=20, help='Seeded accounts')
+        parser.add_argument('--url', help='Benchmark a running server at this base URL')
+        parser.add_argument('--gunicorn', action='store_true', help='Start a local gunicorn to benchmark')
+        parser.add_argument('--gunicorn-workers', type=int, default=4)
+        parser.add_argument('--port', type=int, default=8765, help='Port for --gunicorn')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a previous --output file')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed relative p95 increase / throughput drop against --baseline')
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+        if options['url'] and options['gunicorn']:
+            raise CommandError('Use either --url or --gunicorn')
+
+        run_id = uuid.uuid4().hex[:8]
+        server = None
+        if options['gunicorn']:
+            server = self._start_gunicorn(options['gunicorn_workers'], options['port'])
+            base_url = f"http://127.0.0.1:{options['port']}"
+        else:
+            base_url = options['url']
+        mode = 'http' if base_url else 'in-process'
+
+        try:
+            accounts = self._seed(run_id, options['users'])
+            local = threading.local()
+
+            def target():
+                if not hasattr(local, 'target'):
+                    local.target = HttpTarget(base_url) if base_url else InProcessTarget()
+                return local.target
+
+            self.stdout.write(
+                f"Mode: {mode}, engine: {connection.vendor}, requests/scenario={options['requests']}, "
+                f"concurrency={options['concurrency']}"
+            )
+            self.stdout.write(
+                f"{'scenario':<15} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8} {'errors':>7}   (ms)"
+            )
+            results = {}
+            for name in scenarios:
+                results[name] = self._run(
+                    self._scenario(name, run_id, accounts), target,
+                    options['requests'], options['warmup'], options['concurrency'],
+                )
+                self._print(name, results[name])
+        finally:
+            if server is not None:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=30)
+            bench_users = User.objects.filter(username__startswith=f'bench-api-{run_id}-')
+            # Undelivered notifications would point at the deleted accounts
+            OutboxEvent.objects.filter(payload__sender_id__in=list(bench_users.values_list('pk', flat=True))).delete()
+            bench_users.delete()
+
+        report = {
+            'mode': mode,
+            'engine': connection.vendor,
+            'created_at': timezone.now().isoformat(),
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'scenarios': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['baseline']:
+            self._compare(report, options['baseline'], options['threshold'])
+
+    def _seed(self, run_id, count):
+        """Accounts with signing keys and tokens; returns [(user, token key, private key)]"""
+        accounts = []
+        for i in range(count):
+            private_key = ec.generate_private_key(ec.SECP384R1())
+            public_der = private_key.public_key().public_bytes(
+                serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+            )
+            user = User.objects.create_user(username=f'bench-api-{run_id}-{i}', password=PASSWORD)
+            UserProfile.objects.create(
+                user=user,
+                account_number=f'7{run_id[:5]}{i:04d}',
+                bvn=f'bench-api-{run_id}-bvn-{i}',
+                nin=f'bench-api-{run_id}-nin-{i}',
+                account_balance=Decimal('1000000.00'),
+                public_key=base64.b64encode(public_der).decode('ascii'),
+            )
+            Message.objects.bulk_create([
+                Message(user=user, title=f'Bench {n}', content='Benchmark message', type='notification')
+                for n in range(20)
+            ])
+            accounts.append((user, Token.objects.create(user=user).key, private_key))
+        return accounts
+
+    def _scenario(self, name, run_id, accounts):
+        """A function of the request number returning (method, path, data, headers)"""
+        def auth(n):
+            user, key, private_key = accounts[n % len(accounts)]
+            return user, {'Authorization': f'Token {key}'}, private_key
+
+        if name == 'register':
+            def make(n):
+                tag = f'{run_id}-r{n}'
+                return 'POST', '/api/auth/register/', {
+                    'username': f'bench-api-{tag}', 'email': f'{tag}@bench.invalid',
+                    'password': PASSWORD, 'phone': f'06{int(run_id[:6], 16) % 10**6:06d}{n:04d}',
+                    'bvn': f'bvn-{tag}', 'nin': f'nin-{tag}',
+                }, {}
+        elif name == 'login':
+            def make(n):
+                user = accounts[n % len(accounts)][0]
+                return 'POST', '/api/auth/login/', {'username': user.username, 'password': PASSWORD}, {}
+        elif name == 'transfer':
+            path = '/api/transactions/transfer/'
+
+            def make(n):
+                user, headers, private_key = auth(n)
+                payee = accounts[(n + 1) % len(accounts)][0]
+                data = {
+                    'recipient_account': payee.profile.account_number,
+                    'recipient_bank': INTERNAL_BANK_NAME,
+                    'amount': '1.00',
+                }
+                headers.update(self._sign(private_key, user, 'POST', path, data))
+                return 'POST', path, data, headers
+        elif name == 'verify_account':
+            def make(n):
+                payee = accounts[(n + 1) % len(accounts)][0]
+                return 'GET', f'/api/transactions/verify-account/{payee.profile.account_number}/', None, auth(n)[1]
+        else:
+            path = f'/api/{name}/'
+
+            def make(n):
+                return 'GET', path, None, auth(n)[1]
+        return make
+
+    def _sign(self, private_key, user, method, path, data):
+        """X-Signature/X-Timestamp headers, built the way the mobile client does"""
+        timestamp = str(int(time.time() * 1000))
+        message = json.dumps({
+            'method': method, 'path': path, 'data': data,
+            'timestamp': timestamp, 'user_id': str(user.id),
+        }, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        signature = private_key.sign(message, ec.ECDSA(hashes.SHA384()))
+        return {'X-Signature': base64.b64encode(signature).decode('ascii'), 'X-Timestamp': timestamp}
+
+    def _run(self, make, target, requests, warmup, concurrency):
+        counter = itertools.count()
+        lock = threading.Lock()
+        samples, queries, errors = [], [], [0]
+
+        def one(measured):
+            method, path, data, headers = make(next(counter))
+            started = time.perf_counter()
+            status, query_count = target().request(method, path, data, headers)
+            elapsed = (time.perf_counter() - started) * 1000
+            if measured:
+                with lock:
+                    samples.append(elapsed)
+                    if query_count is not None:
+                        queries.append(query_count)
+                    if status >= 400:
+                        errors[0] += 1
+
+        def worker(count, measured):
+            for _ in range(count):
+                one(measured)
+
+        def pooled_worker(count, measured):
+            try:
+                worker(count, measured)
+            finally:
+                connection.close()  # Each pool thread opened its own
+
+        def run_all(total, measured):
+            if concurrency == 1:
+                return worker(total, measured)
+            shares = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for future in [pool.submit(pooled_worker, share, measured) for share in shares]:
+                    future.result()
+
+        run_all(warmup, False)
+        started = time.perf_counter()
+        run_all(requests, True)
+        elapsed = time.perf_counter() - started
+
+        cuts = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+        return {
+            'requests': len(samples),
+            'errors': errors[0],
+            'throughput': len(samples) / elapsed if elapsed else 0.0,
+            'mean_ms': statistics.fmean(samples),
+            'p50_ms': cuts[49],
+            'p95_ms': cuts[94],
+            'p99_ms': cuts[98],
+            'queries_per_request': statistics.fmean(queries) if queries else None,
+        }
+
+    def _print(self, name, result):
+        queries = '-' if result['queries_per_request'] is None else f"{result['queries_per_request']:.1f}"
+        self.stdout.write(
+            f"{name:<15} {result['throughput']:>8.1f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+            f"{result['p99_ms']:>8.2f} {queries:>8} {result['errors']:>7}"
+        )
+
+    def _compare(self, report, baseline_path, threshold):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if (baseline['mode'], baseline['concurrency']) != (report['mode'], report['concurrency']):
+            raise CommandError(
+                f"Baseline was recorded {baseline['mode']} with concurrency {baseline['concurrency']}; "
+                f"rerun it the same way to compare"
+            )
+        baseline = baseline['scenarios']
+        regressions = []
+        for name, result in report['scenarios'].items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                regressions.append(f"{name}: p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms")
+            if result['throughput'] < before['throughput'] * (1 - threshold):
+                regressions.append(f"{name}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f} req/s")
+            if (result['queries_per_request'] is not None and before.get('queries_per_request') is not None
+                    and result['queries_per_request'] > before['queries_per_request']):
+                regressions.append(
+                    f"{name}: queries/request {before['queries_per_request']:.1f} -> {result['queries_per_request']:.1f}"
+                )
+        if regressions:
+            raise CommandError('Regression against baseline:\n  ' + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS(f'No regressions beyond {threshold:.0%} against {baseline_path}'))
+
+    def _start_gunicorn(self, workers, port):
+        """Serve this project's WSGI app with the current settings until the benchmark ends"""
+        wsgi = getattr(settings, 'WSGI_APPLICATION', None) or 'secure_cipher_bank.wsgi.application'
+        wsgi = wsgi.rsplit('.', 1)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', f'{wsgi[0]}:{wsgi[1]}', '-w', str(workers), '-b', f'127.0.0.1:{port}'],
+            env=os.environ.copy(),
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError('gunicorn exited during startup')
+            try:
+                http.client.HTTPConnection('127.0.0.1', port, timeout=1).request('GET', '/')
+                return server
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('gunicorn did not start within 30 seconds')
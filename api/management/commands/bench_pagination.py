@@ -0,0 +1,135 @@
+import statistics
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.models import UserProfile, Transaction
+from api.pagination import KeysetPagination
+from api.views import TransactionViewSet
+
+BENCH_USERNAME = 'bench-pagination'
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare keyset and offset pagination latency on the transaction list at "
+        "increasing page depths, plus the full list view latency with keyset "
+        "paging. Seeds a bench user with --rows transactions on first run and "
+        "reuses them afterwards (pass --drop to remove them)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000)
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--depths', default='1,10,100,1000,5000',
+                            help='Comma-separated page numbers to measure')
+        parser.add_argument('--repeats', type=int, default=20)
+        parser.add_argument('--chunk-size', type=int, default=10_000)
+        parser.add_argument('--drop', action='store_true', help='Delete the seeded rows and exit')
+
+    def handle(self, *args, **options):
+        if options['drop']:
+            User.objects.filter(username=BENCH_USERNAME).delete()
+            self.stdout.write('Benchmark data removed')
+            return
+
+        user = self._seed(options['rows'], options['chunk_size'])
+        page_size = options['page_size']
+        depths = [int(d) for d in options['depths'].split(',')]
+        total = Transaction.objects.filter(user=user).count()
+
+        view = TransactionViewSet.as_view({'get': 'list'})
+        factory = APIRequestFactory()
+        queryset = Transaction.objects.filter(user=user).order_by('-created_at', '-id')
+        paginator = KeysetPagination()
+
+        self.stdout.write(f"Engine: {connection.vendor}, rows={total}, page_size={page_size}")
+        self.stdout.write(
+            f"{'page':>8} {'keyset query':>13} {'offset query':>13} "
+            f"{'view p50':>9} {'view p95':>9}   (ms)"
+        )
+
+        for depth in depths:
+            offset = (depth - 1) * page_size
+            if offset >= total:
+                self.stdout.write(f"{depth:>8} (beyond end of data)")
+                continue
+
+            params = {'page_size': page_size}
+            if offset:
+                # Position the cursor on the last row of the previous page
+                anchor = queryset.only('id', 'created_at')[offset - 1]
+                params['cursor'] = paginator.encode_cursor(anchor, reverse=False)
+
+            def keyset_query():
+                paginator.paginate_queryset(queryset, Request(factory.get('/api/transactions/', params)))
+
+            def offset_query():
+                list(queryset[offset:offset + page_size])
+
+            def full_view():
+                request = factory.get('/api/transactions/', params)
+                force_authenticate(request, user=user)
+                view(request).render()
+
+            keyset = self._time(keyset_query, options['repeats'])
+            offset_only = self._time(offset_query, options['repeats'])
+            full = self._time(full_view, options['repeats'])
+            self.stdout.write(
+                f"{depth:>8} {statistics.median(keyset):>13.2f} {statistics.median(offset_only):>13.2f} "
+                f"{statistics.median(full):>9.2f} {self._p95(full):>9.2f}"
+            )
+
+    def _seed(self, rows, chunk_size):
+        user, _ = User.objects.get_or_create(username=BENCH_USERNAME)
+        UserProfile.objects.get_or_create(
+            user=user,
+            defaults={
+                'account_number': '9990000000',
+                'bvn': 'bench-pagination-bvn',
+                'nin': 'bench-pagination-nin',
+            },
+        )
+
+        existing = Transaction.objects.filter(user=user).count()
+        if existing >= rows:
+            return user
+
+        self.stdout.write(f"Seeding {rows - existing} transactions...")
+        started = time.perf_counter()
+        for start in range(existing, rows, chunk_size):
+            batch = [
+                Transaction(
+                    user=user,
+                    type='transfer',
+                    amount=Decimal('1.00'),
+                    description='bench',
+                    recipient_account='0000000000',
+                    status='completed',
+                    reference=f'BENCH-PAGE-{n}',
+                    balance_after=Decimal('0.00'),
+                )
+                for n in range(start, min(start + chunk_size, rows))
+            ]
+            with transaction.atomic():
+                Transaction.objects.bulk_create(batch)
+        self.stdout.write(f"Seeded in {time.perf_counter() - started:.1f}s")
+        return user
+
+    def _time(self, func, repeats):
+        func()  # warm up
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        return samples
+
+    def _p95(self, samples):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
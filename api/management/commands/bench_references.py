@@ -0,0 +1,59 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.references import new_reference
+
+
+def generate(count):
+    """Worker: issue ``count`` references in this process and time it"""
+    started = time.perf_counter()
+    references = [new_reference() for _ in range(count)]
+    return references, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = (
+        "Throughput benchmark for the transaction reference generator: forks "
+        "--processes workers that each issue their share of --count references, "
+        "then checks that every reference is unique and that each process issued "
+        "its references in increasing order."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='Worker processes')
+        parser.add_argument('--count', type=int, default=1000000, help='Total references to generate')
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        per_process = max(1, options['count'] // processes)
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            raise CommandError('This benchmark needs the fork start method')
+
+        self.stdout.write(f"processes={processes}, references/process={per_process}")
+        started = time.perf_counter()
+        with context.Pool(processes) as pool:
+            results = pool.map(generate, [per_process] * processes)
+        elapsed = time.perf_counter() - started
+
+        seen = set()
+        total = 0
+        for references, _ in results:
+            if references != sorted(references):
+                raise CommandError('References were not issued in increasing order')
+            seen.update(references)
+            total += len(references)
+        collisions = total - len(seen)
+
+        busiest = max(worker_elapsed for _, worker_elapsed in results)
+        self.stdout.write(
+            f"generated={total} collisions={collisions} elapsed={elapsed:.3f}s "
+            f"throughput={total / busiest:,.0f} refs/sec "
+            f"({per_process / busiest:,.0f} refs/sec per process)"
+        )
+        if collisions:
+            raise CommandError(f'{collisions} duplicate reference(s) generated')
+        self.stdout.write(self.style.SUCCESS('No collisions'))
@@ -0,0 +1,112 @@
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+
+from api.models import UserProfile, Transaction, Message
+from api.serializers import TransactionSerializer, MessageSerializer, transaction_rows, message_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the ModelSerializer and .values() read paths of the transaction "
+        "and message lists: fetch a page of --rows rows, serialize it and render it "
+        "to JSON. Reports p50/p95 per path and the speedup, and fails if the two "
+        "paths render different bytes. Creates its own account and removes it "
+        "afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=500, help='Rows per page')
+        parser.add_argument('--repeats', type=int, default=50)
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark account')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        run_id = uuid.uuid4().hex[:8]
+        user = self._seed(run_id, rows)
+        renderer = JSONRenderer()
+
+        self.stdout.write(f"Engine: {connection.vendor}, rows={rows}, repeats={options['repeats']}")
+        self.stdout.write(f"{'list':>13} {'model p50':>10} {'model p95':>10} {'values p50':>11} {'values p95':>11} {'speedup':>8}   (ms)")
+        try:
+            for label, model, serializer_class, row_serializer in (
+                ('transactions', Transaction, TransactionSerializer, transaction_rows),
+                ('messages', Message, MessageSerializer, message_rows),
+            ):
+                queryset = model.objects.filter(user=user).order_by('-created_at', '-id')
+
+                def model_path():
+                    return renderer.render(serializer_class(list(queryset[:rows]), many=True).data)
+
+                def values_path():
+                    page = list(queryset.values(*row_serializer.columns)[:rows])
+                    return renderer.render(row_serializer.serialize(page))
+
+                if model_path() != values_path():
+                    raise CommandError(f'The {label} read paths render different output')
+                model_times = self._time(model_path, options['repeats'])
+                values_times = self._time(values_path, options['repeats'])
+                self.stdout.write(
+                    f"{label:>13} {statistics.median(model_times):>10.2f} {self._p95(model_times):>10.2f} "
+                    f"{statistics.median(values_times):>11.2f} {self._p95(values_times):>11.2f} "
+                    f"{statistics.median(model_times) / statistics.median(values_times):>7.1f}x"
+                )
+            self.stdout.write(self.style.SUCCESS('Both read paths render identical output'))
+        finally:
+            if not options['keep']:
+                user.delete()
+
+    def _seed(self, run_id, rows):
+        user = User.objects.create_user(username=f'bench-{run_id}-serializers')
+        UserProfile.objects.create(
+            user=user,
+            account_number=f'9{run_id}9',
+            bvn=f'bench-{run_id}-bvn',
+            nin=f'bench-{run_id}-nin',
+        )
+        Transaction.objects.bulk_create([
+            Transaction(
+                user=user,
+                type='debit' if n % 2 else 'credit',
+                amount=Decimal(n % 100_000) / 100,
+                description=f'bench {n}',
+                recipient_name='Bench Recipient',
+                recipient_account='0000000000',
+                recipient_bank='Secure Cipher Bank',
+                status='completed',
+                reference=f'BENCH-{run_id}-{n}',
+                balance_after=Decimal(n * 37) / 100,
+                category='transfer',
+            )
+            for n in range(rows)
+        ])
+        Message.objects.bulk_create([
+            Message(
+                user=user,
+                title=f'Bench message {n}',
+                content='Benchmark notification',
+                type='notification',
+                read=n % 3 == 0,
+            )
+            for n in range(rows)
+        ])
+        return user
+
+    def _time(self, func, repeats):
+        func()  # warm up
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        return samples
+
+    def _p95(self, samples):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
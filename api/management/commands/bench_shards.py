@@ -0,0 +1,162 @@
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, OperationalError
+from django.db.models import Sum
+from django.test.utils import override_settings
+
+from api.models import UserProfile, TransferSaga
+from api.shards import delete_users, mirror_users, shard_for_user
+from api.transfers import transfer_funds, TransferError, INTERNAL_BANK_NAME
+
+
+def send(shards, routers, user_id, neighbours, everyone, plan, seed):
+    """One sender's transfers, in a worker process; returns its outcome counts"""
+    rng = random.Random(seed)
+    amount = Decimal(plan['amount'])
+    counts = {'ok': 0, 'rejected': 0, 'errors': 0}
+    with override_settings(ACCOUNT_SHARDS=shards, DATABASE_ROUTERS=routers):
+        user = User.objects.select_related('profile').using(shard_for_user(user_id)).get(pk=user_id)
+        for _ in range(plan['transfers']):
+            account = rng.choice(neighbours if rng.random() < plan['locality'] else everyone)
+            try:
+                transfer_funds(user, account, INTERNAL_BANK_NAME, amount, description='bench')
+                counts['ok'] += 1
+            except TransferError:
+                counts['rejected'] += 1
+            except OperationalError:
+                # e.g. SQLite "database is locked" under heavy contention
+                counts['errors'] += 1
+    connections.close_all()
+    return counts
+
+
+class Command(BaseCommand):
+    help = (
+        "Transfer throughput as accounts are spread over more shards: for 1..N of the "
+        "given database aliases, concurrent sender processes pay random accounts and the run "
+        "reports transfers/sec, the share that crossed shards, and checks that money "
+        "was conserved and no transfer was left pending. Every alias must be migrated. "
+        "Creates its own accounts and removes them afterwards. On SQLite give each "
+        "alias its own file and OPTIONS['transaction_mode'] = 'IMMEDIATE'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--aliases', nargs='+',
+                            help='Shard aliases in DATABASES (default: ACCOUNT_SHARDS)')
+        parser.add_argument('--senders', type=int, default=8, help='Concurrent sender processes')
+        parser.add_argument('--transfers', type=int, default=50, help='Transfers per sender')
+        parser.add_argument('--accounts', type=int, default=32, help='Accounts paid at random')
+        parser.add_argument('--locality', type=float, default=0.0,
+                            help="Share of transfers paying an account on the sender's own shard; "
+                                 "the rest pick any account")
+        parser.add_argument('--amount', default='1.00', help='Amount per transfer')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark accounts')
+
+    def handle(self, *args, **options):
+        aliases = options['aliases'] or list(getattr(settings, 'ACCOUNT_SHARDS', None) or ['default'])
+        unknown = [alias for alias in aliases if alias not in connections.settings]
+        if unknown:
+            raise CommandError(f"Not in DATABASES: {', '.join(unknown)}")
+
+        self.stdout.write(
+            f"senders={options['senders']} transfers/sender={options['transfers']} "
+            f"accounts={options['accounts']} locality={options['locality']:.0%}"
+        )
+        self.stdout.write(f"{'shards':>6} {'completed':>9} {'errors':>6} {'cross-shard':>11} {'transfers/s':>11}")
+        routers = ['api.shards.ShardRouter', *[r for r in settings.DATABASE_ROUTERS if r != 'api.shards.ShardRouter']]
+        for count in range(1, len(aliases) + 1):
+            with override_settings(ACCOUNT_SHARDS=aliases[:count], DATABASE_ROUTERS=routers):
+                self._run(count, options)
+        self.stdout.write(self.style.SUCCESS('Money conserved and no transfer left pending'))
+
+    def _run(self, count, options):
+        run_id = uuid.uuid4().hex[:8]
+        amount = Decimal(options['amount'])
+        sender_ids, payees = self._create_accounts(run_id, options, amount * options['transfers'])
+        user_ids = sender_ids + [profile.user_id for profile in payees]
+        total_before = self._total_balance(user_ids)
+
+        by_shard = {}
+        for payee in payees:
+            by_shard.setdefault(shard_for_user(payee.user_id), []).append(payee.account_number)
+        everyone = [payee.account_number for payee in payees]
+
+        # One process per sender, so the senders don't share an interpreter lock
+        connections.close_all()
+        plan = {key: options[key] for key in ('transfers', 'amount', 'locality')}
+        results = {'ok': 0, 'rejected': 0, 'errors': 0}
+        with ProcessPoolExecutor(max_workers=len(sender_ids), initializer=django.setup) as pool:
+            list(pool.map(time.sleep, [0.1] * len(sender_ids)))  # start the workers
+            started = time.perf_counter()
+            runs = [
+                pool.submit(
+                    send, list(settings.ACCOUNT_SHARDS), list(settings.DATABASE_ROUTERS), user_id,
+                    by_shard.get(shard_for_user(user_id)) or everyone, everyone, plan, seed,
+                )
+                for seed, user_id in enumerate(sender_ids)
+            ]
+            for run in runs:
+                for key, value in run.result().items():
+                    results[key] += value
+            elapsed = time.perf_counter() - started
+
+        try:
+            sagas = self._sagas(user_ids)
+            crossed = sagas.get('completed', 0)
+            self.stdout.write(
+                f"{count:>6} {results['ok']:>9} {results['errors'] + results['rejected']:>6} "
+                f"{crossed / max(results['ok'], 1):>10.0%} {results['ok'] / elapsed:>11.1f}"
+            )
+            if sagas.get('pending'):
+                raise CommandError(f"{sagas['pending']} transfer(s) left pending")
+            total_after = self._total_balance(user_ids)
+            if total_after != total_before:
+                raise CommandError(f'Money not conserved: {total_before} -> {total_after}')
+        finally:
+            if not options['keep']:
+                for alias in settings.ACCOUNT_SHARDS:
+                    TransferSaga.objects.using(alias).filter(sender_id__in=user_ids).delete()
+                delete_users(user_ids)
+
+    def _create_accounts(self, run_id, options, opening_balance):
+        users = [
+            User.objects.create_user(username=f'bench-{run_id}-{n}')
+            for n in range(max(options['senders'], options['accounts']))
+        ]
+        mirror_users(users)
+        profiles = UserProfile.objects.bulk_create([
+            UserProfile(
+                user=user,
+                account_number=f'9{run_id}{n:04d}',
+                bvn=f'bench-{run_id}-bvn-{n}',
+                nin=f'bench-{run_id}-nin-{n}',
+                account_balance=opening_balance,
+            )
+            for n, user in enumerate(users)
+        ])
+        return [user.pk for user in users[:options['senders']]], profiles[:options['accounts']]
+
+    def _total_balance(self, user_ids):
+        return sum(
+            UserProfile.objects.using(alias).filter(user_id__in=user_ids)
+            .aggregate(total=Sum('account_balance'))['total'] or Decimal('0.00')
+            for alias in settings.ACCOUNT_SHARDS
+        )
+
+    def _sagas(self, user_ids):
+        """Debit-leg saga states of this run across the shards: ``{state: count}``"""
+        states = {}
+        for alias in settings.ACCOUNT_SHARDS:
+            for state in TransferSaga.objects.using(alias).filter(
+                sender_id__in=user_ids, leg='debit'
+            ).values_list('state', flat=True):
+                states[state] = states.get(state, 0) + 1
+        return states
@@ -0,0 +1,149 @@
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, close_old_connections, OperationalError
+from django.db.models import Sum
+
+from api.hot_accounts import roll_up, set_balance_slots
+from api.models import UserProfile, Transaction
+from api.transfers import transfer_funds, TransferError, INTERNAL_BANK_NAME
+
+
+class Command(BaseCommand):
+    help = (
+        "Contention benchmark for the transfer engine: N concurrent senders all "
+        "pay one recipient. Reports transfers/sec and checks for lost updates. "
+        "With --slots the run is repeated with the recipient as a hot account of "
+        "each number of balance slots (0 is a normal account). SQLite serializes "
+        "all writers anyway, so the scaling with slots shows on PostgreSQL or MySQL. "
+        "Creates its own "
+        "accounts and removes them afterwards. On SQLite, set "
+        "OPTIONS['transaction_mode'] = 'IMMEDIATE' or most writers will fail with "
+        "'database is locked' instead of queueing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--senders', type=int, default=8, help='Concurrent sender threads')
+        parser.add_argument('--transfers', type=int, default=50, help='Transfers per sender')
+        parser.add_argument('--amount', default='1.00', help='Amount per transfer')
+        parser.add_argument('--slots', type=int, nargs='+', default=[0],
+                            help="Recipient balance slots per run, e.g. 0 1 2 4 8 16")
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark accounts')
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Engine: {connection.vendor}, senders={options['senders']}, transfers/sender={options['transfers']}"
+        )
+        for slots in options['slots']:
+            self._run(slots, options)
+
+    def _run(self, slots, options):
+        senders = options['senders']
+        per_sender = options['transfers']
+        amount = Decimal(options['amount'])
+        run_id = uuid.uuid4().hex[:8]
+
+        sender_users, recipient_profile = self._create_accounts(run_id, senders, amount * per_sender)
+        if slots:
+            set_balance_slots(recipient_profile, slots)
+        profile_ids = [u.profile.pk for u in sender_users] + [recipient_profile.pk]
+        total_before = self._total_balance(profile_ids)
+
+        results = {'ok': 0, 'rejected': 0, 'errors': 0}
+        results_lock = threading.Lock()
+        start_barrier = threading.Barrier(senders)
+
+        def run_sender(user):
+            ok = rejected = errors = 0
+            try:
+                start_barrier.wait()
+                for _ in range(per_sender):
+                    try:
+                        transfer_funds(
+                            user,
+                            recipient_account=recipient_profile.account_number,
+                            recipient_bank=INTERNAL_BANK_NAME,
+                            amount=amount,
+                            description='bench',
+                        )
+                        ok += 1
+                    except TransferError:
+                        rejected += 1
+                    except OperationalError:
+                        # e.g. SQLite "database is locked" under heavy contention
+                        errors += 1
+            finally:
+                connection.close()
+                with results_lock:
+                    results['ok'] += ok
+                    results['rejected'] += rejected
+                    results['errors'] += errors
+
+        threads = [threading.Thread(target=run_sender, args=(user,)) for user in sender_users]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        close_old_connections()
+
+        roll_up(recipient_profile.pk)
+        recipient_profile.refresh_from_db()
+        expected_recipient = Decimal('0.00') + amount * results['ok']
+        credit_rows = Transaction.objects.filter(
+            user_id=recipient_profile.user_id, type='credit'
+        ).count()
+        total_after = self._total_balance(profile_ids)
+
+        self.stdout.write(
+            f"slots={slots} completed={results['ok']} rejected={results['rejected']} "
+            f"errors={results['errors']} elapsed={elapsed:.3f}s "
+            f"throughput={results['ok'] / elapsed:.1f} transfers/sec"
+        )
+        self.stdout.write(
+            f"recipient balance={recipient_profile.account_balance} expected={expected_recipient} "
+            f"credit rows={credit_rows}"
+        )
+
+        try:
+            if recipient_profile.account_balance != expected_recipient or credit_rows != results['ok']:
+                raise CommandError('Lost update detected: recipient balance does not match completed transfers')
+            if total_after != total_before:
+                raise CommandError(f'Money not conserved: {total_before} -> {total_after}')
+            self.stdout.write(self.style.SUCCESS('No lost updates'))
+        finally:
+            if not options['keep']:
+                User.objects.filter(username__startswith=f'bench-{run_id}-').delete()
+
+    def _create_accounts(self, run_id, senders, opening_balance):
+        sender_users = []
+        for i in range(senders):
+            user = User.objects.create_user(username=f'bench-{run_id}-sender-{i}')
+            UserProfile.objects.create(
+                user=user,
+                account_number=f'9{run_id}{i:04d}',
+                bvn=f'bench-{run_id}-bvn-{i}',
+                nin=f'bench-{run_id}-nin-{i}',
+                account_balance=opening_balance,
+            )
+            sender_users.append(User.objects.select_related('profile').get(pk=user.pk))
+
+        recipient = User.objects.create_user(username=f'bench-{run_id}-recipient')
+        recipient_profile = UserProfile.objects.create(
+            user=recipient,
+            account_number=f'8{run_id}0000',
+            bvn=f'bench-{run_id}-bvn-r',
+            nin=f'bench-{run_id}-nin-r',
+            account_balance=Decimal('0.00'),
+        )
+        return sender_users, recipient_profile
+
+    def _total_balance(self, profile_ids):
+        return UserProfile.objects.filter(pk__in=profile_ids).aggregate(
+            total=Sum('account_balance')
+        )['total']
@@ -0,0 +1,307 @@
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction, DataError, IntegrityError
+from django.utils.dateparse import parse_date
+from rest_framework.authtoken.models import Token
+
+from api.accounts import derive_account_number
+from api.models import UserProfile
+from api.shards import account_dbs, mirror_users, shard_aliases
+
+REQUIRED_COLUMNS = ('username', 'password', 'bvn', 'nin')
+OPTIONAL_COLUMNS = (
+    'email', 'first_name', 'last_name', 'phone', 'date_of_birth',
+    'address', 'occupation', 'account_balance',
+)
+# Values that must be unique across the file and the database: field -> (model, label)
+UNIQUE_FIELDS = {
+    'username': (User, 'Username'),
+    'bvn': (UserProfile, 'BVN'),
+    'nin': (UserProfile, 'NIN'),
+    'phone': (UserProfile, 'Phone number'),
+    'account_number': (UserProfile, 'Account number'),
+}
+# Text columns checked against their field's max_length
+TEXT_FIELDS = {
+    'username': User, 'email': User, 'first_name': User, 'last_name': User,
+    'phone': UserProfile, 'bvn': UserProfile, 'nin': UserProfile, 'occupation': UserProfile,
+}
+BALANCE_FIELD = UserProfile._meta.get_field('account_balance')
+validate_username = UnicodeUsernameValidator()
+
+
+def parse_balance(value):
+    """``value`` as a balance the account_balance column can hold, or None"""
+    try:
+        balance = Decimal(value)
+        if not balance.is_finite() or balance < 0:
+            return None
+        quantized = balance.quantize(Decimal(1).scaleb(-BALANCE_FIELD.decimal_places))
+    except InvalidOperation:
+        return None
+    if quantized != balance or len(quantized.as_tuple().digits) > BALANCE_FIELD.max_digits:
+        return None
+    return quantized
+
+
+class Command(BaseCommand):
+    help = (
+        "Import customers from a CSV file (username, password, bvn and nin columns "
+        "required; email, first_name, last_name, phone, date_of_birth, address, "
+        "occupation and account_balance optional). Each customer gets a user, a "
+        "profile and an API token, as with registration. The file is read in "
+        "chunks: uniqueness is checked in bulk against the database and the rest of "
+        "the file, passwords are hashed on a process pool and rows are inserted with "
+        "bulk_create, one transaction per chunk. Rejected rows are reported and "
+        "skipped; the rest of the file is still imported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="CSV file, or '-' for standard input")
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per bulk insert')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Password hashing processes (1 hashes inline)')
+        parser.add_argument('--opening-balance', default='0.00',
+                            help='Balance for rows without an account_balance column value')
+        parser.add_argument('--rejects', help='Write rejected rows, with the reason, to this CSV file')
+
+    def handle(self, *args, **options):
+        self.opening_balance = parse_balance(options['opening_balance'])
+        if self.opening_balance is None:
+            raise CommandError(
+                f'--opening-balance must be a non-negative amount with at most '
+                f'{BALANCE_FIELD.decimal_places} decimal places'
+            )
+        self.seen = {field: set() for field in UNIQUE_FIELDS}
+        self.imported = 0
+        self.rejected = 0
+        self.rejects_file = self.rejects_writer = None
+
+        source = sys.stdin if options['file'] == '-' else open(options['file'], newline='', encoding='utf-8-sig')
+        started = time.perf_counter()
+        try:
+            reader = csv.DictReader(source)
+            missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or ())]
+            if missing:
+                raise CommandError(f"Missing column(s): {', '.join(missing)}")
+            if options['rejects']:
+                self.rejects_file = open(options['rejects'], 'w', newline='', encoding='utf-8')
+                self.rejects_writer = csv.writer(self.rejects_file)
+                # Never copy passwords into the rejects file
+                self.fieldnames = [name for name in reader.fieldnames if name != 'password']
+                self.rejects_writer.writerow(['line', 'reason', *self.fieldnames])
+
+            pool = None
+            if options['workers'] > 1:
+                # Workers set Django up themselves in case they are spawned, not forked
+                pool = ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup)
+            try:
+                self._import(reader, options['chunk_size'], pool, options['workers'])
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if self.rejects_file is not None:
+                self.rejects_file.close()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.imported} customer(s), rejected {self.rejected}, "
+            f"in {elapsed:.1f}s ({self.imported / elapsed if elapsed else 0:.0f} rows/sec)"
+        ))
+
+    def _import(self, reader, chunk_size, pool, workers):
+        rows = ((line, row) for line, row in enumerate(reader, start=2))
+        pending = None
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            accepted = self._validate(chunk)
+            passwords = [row['password'] for row in accepted]
+            if pool is None:
+                hashes = map(make_password, passwords)
+            else:
+                # Submitted now, so this chunk hashes while the previous one is inserted
+                hashes = pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4)))
+            if pending is not None:
+                self._insert(*pending)
+            pending = (accepted, hashes)
+        if pending is not None:
+            self._insert(*pending)
+
+    def _validate(self, chunk):
+        """Clean a chunk of rows; returns the accepted ones and reports the rest"""
+        candidates = []
+        for line, raw in chunk:
+            row = {key: (value or '').strip() for key, value in raw.items() if key is not None}
+            error = self._clean(row)
+            if error:
+                self._reject(line, raw, error)
+            else:
+                candidates.append((line, raw, row))
+
+        taken = self._taken_in_database([row for _, _, row in candidates])
+        accepted = []
+        for line, raw, row in candidates:
+            error = self._conflict(row, taken)
+            if error:
+                self._reject(line, raw, error)
+                continue
+            for field in UNIQUE_FIELDS:
+                if row[field]:
+                    self.seen[field].add(row[field])
+            row['line'] = line
+            row['raw'] = raw
+            accepted.append(row)
+        return accepted
+
+    def _clean(self, row):
+        for column in REQUIRED_COLUMNS:
+            if not row.get(column):
+                return f'Missing {column}'
+        for column in OPTIONAL_COLUMNS:
+            row.setdefault(column, '')
+        for column, model in TEXT_FIELDS.items():
+            max_length = model._meta.get_field(column).max_length
+            if len(row[column]) > max_length:
+                return f'{column} is longer than {max_length} characters'
+        try:
+            validate_username(row['username'])
+        except ValidationError:
+            return 'Invalid username'
+
+        if row['date_of_birth']:
+            try:
+                row['date_of_birth'] = parse_date(row['date_of_birth'])
+            except ValueError:
+                row['date_of_birth'] = None
+            if row['date_of_birth'] is None:
+                return 'Invalid date_of_birth (expected YYYY-MM-DD)'
+        else:
+            row['date_of_birth'] = None
+
+        if row['account_balance']:
+            row['account_balance'] = parse_balance(row['account_balance'])
+            if row['account_balance'] is None:
+                return 'Invalid account_balance'
+        else:
+            row['account_balance'] = self.opening_balance
+
+        row['account_number'] = derive_account_number(row['phone'])
+        return None
+
+    def _taken_in_database(self, rows):
+        """Values of each unique field already in the database, one query per field"""
+        taken = {}
+        for field, (model, _) in UNIQUE_FIELDS.items():
+            values = {row[field] for row in rows if row[field]}
+            taken[field] = set()
+            if not values:
+                continue
+            # Profiles are spread over the shards; users all live on default
+            for using in (account_dbs() if model is UserProfile else [None]):
+                taken[field].update(
+                    model.objects.db_manager(using).filter(**{f'{field}__in': values}).values_list(field, flat=True)
+                )
+        return taken
+
+    def _conflict(self, row, taken):
+        for field, (_, label) in UNIQUE_FIELDS.items():
+            value = row[field]
+            if not value:
+                continue
+            if field == 'account_number' and not row['phone']:
+                # A random number; draw again instead of rejecting the customer
+                while value in taken[field] or value in self.seen[field] or \
+                        UserProfile.objects.only('id').scatter(account_number=value):
+                    value = row[field] = derive_account_number('')
+                continue
+            if value in taken[field]:
+                return f'{label} is already registered'
+            if value in self.seen[field]:
+                return f'Duplicate {label.lower()} in file'
+        return None
+
+    def _insert(self, rows, hashes):
+        for row, password in zip(rows, hashes):
+            row['password'] = password
+        try:
+            with self._atomic():
+                self._bulk_create(rows)
+            self.imported += len(rows)
+        except (IntegrityError, DataError):
+            # Someone registered a clashing customer since the check, or a value
+            # doesn't fit its column; isolate the rows
+            for row in rows:
+                try:
+                    with self._atomic():
+                        self._bulk_create([row])
+                    self.imported += 1
+                except IntegrityError:
+                    self._reject(row['line'], row['raw'], 'Conflicts with an existing customer')
+                except DataError:
+                    self._reject(row['line'], row['raw'], 'Value out of range for its column')
+
+    def _atomic(self):
+        """A transaction on default and on every shard, committed together"""
+        stack = ExitStack()
+        for alias in dict.fromkeys([DEFAULT_DB_ALIAS, *shard_aliases()]):
+            stack.enter_context(transaction.atomic(using=alias))
+        return stack
+
+    def _bulk_create(self, rows):
+        users = User.objects.bulk_create([
+            User(
+                username=row['username'],
+                email=row['email'],
+                first_name=row['first_name'],
+                last_name=row['last_name'],
+                password=row['password'],
+            )
+            for row in rows
+        ])
+        if any(user.pk is None for user in users):
+            # Databases that can't return ids from a bulk insert (e.g. MySQL)
+            ids = dict(User.objects.filter(username__in=[u.username for u in users]).values_list('username', 'pk'))
+            for user in users:
+                user.pk = ids[user.username]
+
+        mirror_users(users)
+        UserProfile.objects.bulk_create([
+            UserProfile(
+                user=user,
+                phone=row['phone'],
+                bvn=row['bvn'],
+                nin=row['nin'],
+                account_number=row['account_number'],
+                date_of_birth=row['date_of_birth'],
+                address=row['address'],
+                occupation=row['occupation'],
+                account_balance=row['account_balance'],
+            )
+            for user, row in zip(users, rows)
+        ])
+        Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+
+    def _reject(self, line, raw, reason):
+        self.rejected += 1
+        if self.rejects_writer is not None:
+            self.rejects_writer.writerow([line, reason, *(raw.get(name, '') for name in self.fieldnames)])
+        else:
+            self.stderr.write(f"line {line}: {reason}")
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive a running server with many concurrent keep-alive connections and "
+        "report throughput and p50/p99 latency. Pass several --target label=url "
+        "to compare deployments, e.g. WSGI (gunicorn secure_cipher_bank.wsgi) on "
+        "one port against ASGI (gunicorn -k uvicorn.workers.UvicornWorker "
+        "secure_cipher_bank.asgi with ASYNC_READ_VIEWS = True) on another. Raise "
+        "the open-file limit (ulimit -n) above --concurrency first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True,
+                            help='label=http://host:port/api/transactions/ (repeatable)')
+        parser.add_argument('--token', help='API token sent as "Authorization: Token <key>"')
+        parser.add_argument('--concurrency', type=int, default=1000)
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds per target')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Per-request timeout in seconds')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            label, sep, url = target.partition('=')
+            parts = urlsplit(url)
+            if not sep or parts.scheme != 'http' or not parts.hostname:
+                raise CommandError(f"Expected label=http://host:port/path, got '{target}'")
+            targets.append((label, parts))
+
+        self.stdout.write(f"{'target':<12} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for label, parts in targets:
+            latencies, errors, elapsed = asyncio.run(self._run(parts, options))
+            latencies.sort()
+            self.stdout.write(
+                f"{label:<12} {len(latencies):>9} {errors:>7} {len(latencies) / elapsed:>9.1f} "
+                f"{self._percentile(latencies, 50):>9.1f} {self._percentile(latencies, 99):>9.1f}"
+            )
+
+    async def _run(self, parts, options):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = [f"GET {path} HTTP/1.1", f"Host: {parts.netloc}", "Connection: keep-alive"]
+        if options['token']:
+            headers.append(f"Authorization: Token {options['token']}")
+        request = ('\r\n'.join(headers) + '\r\n\r\n').encode('ascii')
+
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        deadline = started + options['duration']
+
+        async def connection():
+            nonlocal errors
+            reader = writer = None
+            while time.perf_counter() < deadline:
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+                    sent = time.perf_counter()
+                    writer.write(request)
+                    status, keep_alive = await asyncio.wait_for(self._read_response(reader), options['timeout'])
+                    if status == 200:
+                        latencies.append((time.perf_counter() - sent) * 1000)
+                    else:
+                        errors += 1
+                    if not keep_alive:
+                        writer.close()
+                        writer = None
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                    errors += 1
+                    if writer is not None:
+                        writer.close()
+                    writer = None
+                    await asyncio.sleep(0.01)
+            if writer is not None:
+                writer.close()
+
+        await asyncio.gather(*(connection() for _ in range(options['concurrency'])))
+        return latencies, errors, time.perf_counter() - started
+
+    async def _read_response(self, reader):
+        """Read one HTTP/1.1 response; returns (status, keep_alive)"""
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        fields = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            fields[name.strip().lower()] = value.strip().lower()
+
+        if fields.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await reader.readexactly(int(fields.get('content-length', 0)))
+        if lines[0].startswith('HTTP/1.0'):
+            return status, fields.get('connection') == 'keep-alive'
+        return status, fields.get('connection') != 'close'
+
+    def _percentile(self, ordered, percent):
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import TransferSaga
+from api.shards import account_dbs
+from api.transfers import settle_saga
+
+
+class Command(BaseCommand):
+    help = (
+        "Settle transfers between shards that were debited but never completed, "
+        "e.g. because the process died or the recipient's shard was down. A transfer "
+        "whose credit went through is marked completed and its notifications queued; "
+        "any other is aborted on the recipient's shard and the sender refunded. Safe "
+        "to run repeatedly and alongside live traffic."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=60,
+                            help='Only settle sagas untouched for this many seconds')
+        parser.add_argument('--limit', type=int, default=500, help='Sagas settled per shard per run')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['older_than'])
+        totals = {'completed': 0, 'compensated': 0, 'pending': 0}
+        for using in account_dbs():
+            stuck = (
+                TransferSaga.objects.db_manager(using)
+                .filter(leg='debit', state='pending', updated_at__lte=cutoff)
+                .order_by('updated_at')[:options['limit']]
+            )
+            for saga in stuck:
+                state = settle_saga(saga)
+                totals[state] = totals.get(state, 0) + 1
+                self.stdout.write(f"{saga.reference}: {state}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Completed {totals['completed']}, compensated {totals['compensated']}, "
+            f"{totals['pending']} still pending"
+        ))
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.hot_accounts import roll_up_all
+from api.shards import account_dbs
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold the credits waiting in hot accounts' balance slots into their balances "
+        "and daily snapshots. Debits only spend rolled-up money, so run it every few "
+        "seconds while any account has balance slots. With sharded accounts every "
+        "shard is rolled up. Runs until interrupted unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between roll-ups')
+        parser.add_argument('--once', action='store_true', help='Roll up once and exit')
+
+    def handle(self, *args, **options):
+        totals = [0, 0]
+        try:
+            while True:
+                close_old_connections()
+                for using in account_dbs():
+                    accounts, credits = roll_up_all(using=using)
+                    totals[0] += accounts
+                    totals[1] += credits
+                    if credits:
+                        self.stdout.write(f"{using or 'default'}: accounts={accounts} credits={credits}")
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {totals[1]} credit(s) over {totals[0]} account roll-up(s)"))
@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api.key_ring import generate_middleware_key
+from api.models import MiddlewareKey
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a new middleware key pair and retire the current ones. Retired "
+        "keys stop being offered to clients but are still accepted for --grace-hours "
+        "so in-flight handshakes complete. Running servers pick the change up on "
+        "their next key ring poll (MIDDLEWARE_KEY_POLL_INTERVAL); no restart needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='How long retired keys stay valid')
+        parser.add_argument('--purge', action='store_true',
+                            help='Also delete keys that have already expired')
+        parser.add_argument('--list', action='store_true',
+                            help='Only list keys and their state')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+
+        if not options['list']:
+            expires_at = now + timedelta(hours=options['grace_hours'])
+            with transaction.atomic():
+                retiring = MiddlewareKey.objects.filter(is_active=True)
+                retired = retiring.filter(expires_at__isnull=True).update(
+                    is_active=False, expires_at=expires_at, updated_at=now
+                ) + retiring.filter(expires_at__isnull=False).update(is_active=False, updated_at=now)
+                key = generate_middleware_key()
+            self.stdout.write(self.style.SUCCESS(
+                f"New key {key.key_id}; retired {retired} key(s), valid until {expires_at:%Y-%m-%d %H:%M %Z}"
+            ))
+
+            if options['purge']:
+                purged, _ = MiddlewareKey.objects.filter(expires_at__lte=now).delete()
+                self.stdout.write(f"Purged {purged} expired key(s)")
+
+        for key in MiddlewareKey.objects.order_by('-created_at'):
+            if key.expires_at is not None and key.expires_at <= now:
+                state = 'expired'
+            else:
+                state = 'active' if key.is_active else 'retiring'
+            expiry = f" until {key.expires_at:%Y-%m-%d %H:%M %Z}" if key.expires_at else ''
+            self.stdout.write(f"{key.key_id}  {state}{expiry}  created {key.created_at:%Y-%m-%d %H:%M %Z}")
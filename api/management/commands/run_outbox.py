@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api import outbox
+from api.shards import account_dbs
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver queued outbox events (notifications and other post-commit side "
+        "effects). Claims due events in batches and runs their handlers on a thread "
+        "pool; failures are retried with exponential backoff. Several workers may "
+        "run at once. With sharded accounts every shard's queue is drained. Runs until "
+        "interrupted unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events claimed per batch')
+        parser.add_argument('--workers', type=int, default=4, help='Handler threads')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when nothing is due')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no events are due instead of polling')
+
+    def handle(self, *args, **options):
+        totals = [0, 0]
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='outbox') as executor:
+            def run(process, events):
+                return executor.map(lambda event: self._in_thread(process, event), events)
+
+            try:
+                while True:
+                    close_old_connections()
+                    succeeded = failed = 0
+                    for using in account_dbs():
+                        batch = outbox.drain(options['batch_size'], run, using=using)
+                        succeeded += batch[0]
+                        failed += batch[1]
+                    totals[0] += succeeded
+                    totals[1] += failed
+                    if succeeded or failed:
+                        self.stdout.write(f"processed={succeeded} failed={failed}")
+                        continue
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(self.style.SUCCESS(f"Delivered {totals[0]} event(s), {totals[1]} failed attempt(s)"))
+
+    def _in_thread(self, process, event):
+        # Long-lived pool threads keep their own connections; drop broken or stale ones
+        close_old_connections()
+        return process(event)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.hot_accounts import set_balance_slots
+from api.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Make an account hot: spread its incoming credits over SLOTS balance slot "
+        "rows so concurrent transfers to it don't queue on one row lock. 0 turns it "
+        "back into a normal account. Pending credits are rolled up first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_number')
+        parser.add_argument('slots', type=int, help='Balance slots, e.g. 8-32 for a busy merchant; 0 to stop')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['slots'] <= 256:
+            raise CommandError('slots must be between 0 and 256')
+        try:
+            profile = UserProfile.objects.only('id', 'user_id').find(account_number=options['account_number'])
+        except UserProfile.DoesNotExist:
+            raise CommandError(f"No account {options['account_number']}")
+        set_balance_slots(profile, options['slots'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['account_number']} now has {options['slots']} balance slot(s)"
+        ))
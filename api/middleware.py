@@ -5,6 +5,12 @@ class CorsFixMiddleware(MiddlewareMixin):
     Custom middleware to ensure CORS headers are added to all responses
     This helps with edge cases where django-cors-headers might not catch all responses
     """
+    async def __acall__(self, request):
+        # process_response only touches headers, so run it inline instead of
+        # paying for MiddlewareMixin's sync_to_async thread hop
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+    
     def process_response(self, request, response):
         # Check if the origin is in the request
         origin = request.META.get('HTTP_ORIGIN')
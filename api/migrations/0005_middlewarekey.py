@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_dailybalancesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MiddlewareKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ecdsa_private_key', models.TextField(help_text='ECDSA private key in PEM format')),
+                ('ecdsa_public_key', models.TextField(help_text='ECDSA public key in PEM format')),
+                ('ecdh_private_key', models.TextField(help_text='ECDH private key in PEM format')),
+                ('ecdh_public_key', models.TextField(help_text='ECDH public key in PEM format')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Middleware Key',
+                'verbose_name_plural': 'Middleware Keys',
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.3 on 2026-10-17 12:40
+
+import api.models
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def assign_key_ids(apps, schema_editor):
+    MiddlewareKey = apps.get_model('api', 'MiddlewareKey')
+    for key in MiddlewareKey.objects.filter(key_id__isnull=True):
+        key.key_id = api.models.new_key_id()
+        key.save(update_fields=['key_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_middlewarekey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='middlewarekey',
+            name='key_id',
+            field=models.CharField(max_length=32, null=True),
+        ),
+        migrations.RunPython(assign_key_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='middlewarekey',
+            name='key_id',
+            field=models.CharField(default=api.models.new_key_id, help_text='Identifies the key pair to clients', max_length=32, unique=True),
+        ),
+        migrations.AddField(
+            model_name='middlewarekey',
+            name='is_active',
+            field=models.BooleanField(default=True, help_text='Offered to clients for new sessions'),
+        ),
+        migrations.AddField(
+            model_name='middlewarekey',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, help_text='Not accepted at all after this time', null=True),
+        ),
+        migrations.AddField(
+            model_name='middlewarekey',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.3 on 2026-10-17 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_profile_message_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransferSaga',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reference', models.CharField(max_length=100, unique=True)),
+                ('leg', models.CharField(choices=[('debit', 'Debit'), ('credit', 'Credit')], max_length=10)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('compensated', 'Compensated'), ('credited', 'Credited'), ('aborted', 'Aborted')], max_length=12)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('sender_id', models.BigIntegerField()),
+                ('sender_profile_id', models.BigIntegerField()),
+                ('sender_transaction_id', models.BigIntegerField(blank=True, null=True)),
+                ('recipient_shard', models.CharField(max_length=100)),
+                ('recipient_id', models.BigIntegerField()),
+                ('recipient_profile_id', models.BigIntegerField()),
+                ('attempts', models.PositiveSmallIntegerField(default=0, help_text='Recovery attempts')),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'updated_at'], name='api_saga_state_updated_idx')],
+            },
+        ),
+    ]
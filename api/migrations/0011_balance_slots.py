@@ -0,0 +1,33 @@
+# Generated by Django 5.2.3 on 2026-10-17 21:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_transfersaga'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='balance_slots',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Hot accounts: credits go to this many BalanceSlot rows; 0 credits the balance directly'),
+        ),
+        migrations.CreateModel(
+            name='BalanceSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveSmallIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('credits', models.PositiveIntegerField(default=0, help_text='Credits since the last roll-up')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='api.userprofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('profile', 'slot'), name='api_balance_slot_uniq')],
+            },
+        ),
+    ]
@@ -1,20 +1,32 @@
+import secrets
+
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .shards import ShardedManager
+
+def new_key_id():
+    return secrets.token_hex(8)
+
 class MiddlewareKey(models.Model):
     """Store middleware ECDSA and ECDH key pairs"""
+    key_id = models.CharField(max_length=32, unique=True, default=new_key_id, help_text="Identifies the key pair to clients")
     ecdsa_private_key = models.TextField(help_text="ECDSA private key in PEM format")
     ecdsa_public_key = models.TextField(help_text="ECDSA public key in PEM format")
     ecdh_private_key = models.TextField(help_text="ECDH private key in PEM format")
     ecdh_public_key = models.TextField(help_text="ECDH public key in PEM format")
+    is_active = models.BooleanField(default=True, help_text="Offered to clients for new sessions")
+    expires_at = models.DateTimeField(null=True, blank=True, help_text="Not accepted at all after this time")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         verbose_name = "Middleware Key"
         verbose_name_plural = "Middleware Keys"
     
     def __str__(self):
-        return f"Middleware Keys (created: {self.created_at})"
+        return f"Middleware Keys {self.key_id} (created: {self.created_at})"
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
@@ -29,9 +41,44 @@ class UserProfile(models.Model):
     profile_picture = models.URLField(blank=True)
     public_key = models.TextField(blank=True)
     pin_set = models.BooleanField(default=False)
+    balance_slots = models.PositiveSmallIntegerField(
+        default=0, help_text="Hot accounts: credits go to this many BalanceSlot rows; 0 credits the balance directly"
+    )
+    # Bumped by every write, including the F() balance updates in api/transfers.py
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    # Rows live on the owner's shard; see api/shards.py
+    objects = ShardedManager()
     
     def __str__(self):
         return f"{self.user.username}'s profile"
+    
+    @property
+    def balance(self):
+        """The balance shown to the customer: ``account_balance`` plus credits not yet rolled up"""
+        if not self.balance_slots:
+            return self.account_balance
+        pending = self.slots.aggregate(total=models.Sum('amount'))['total']
+        return self.account_balance + (pending or 0)
+
+class BalanceSlot(models.Model):
+    """
+    Credits to a hot account not yet folded into ``account_balance`` (see
+    ``api/hot_accounts.py``). Lives on the account's shard.
+    """
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='slots')
+    slot = models.PositiveSmallIntegerField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    credits = models.PositiveIntegerField(default=0, help_text="Credits since the last roll-up")
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'slot'], name='api_balance_slot_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.profile_id}/{self.slot}: {self.amount}"
 
 class Transaction(models.Model):
     TRANSACTION_TYPES = (
@@ -61,9 +108,82 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = ShardedManager()
+    
+    class Meta:
+        indexes = [
+            # Transaction history: filter by user, newest first (id breaks ties)
+            models.Index(fields=['user', '-created_at', '-id'], name='api_txn_user_created_idx'),
+            models.Index(fields=['recipient_account'], name='api_txn_recipient_acct_idx'),
+            models.Index(fields=['status'], name='api_txn_status_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.reference} - {self.amount} {self.currency}"
 
+class DailyBalanceSnapshot(models.Model):
+    """Opening and closing balance of an account for one calendar day with activity"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_snapshots')
+    date = models.DateField()
+    opening_balance = models.DecimalField(max_digits=12, decimal_places=2)
+    closing_balance = models.DecimalField(max_digits=12, decimal_places=2)
+    transaction_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = ShardedManager()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'date'], name='api_snapshot_user_date_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} {self.date}: {self.opening_balance} -> {self.closing_balance}"
+
+class IdempotencyRecord(models.Model):
+    """The stored response to a request made with an Idempotency-Key header"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_records')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64, help_text="SHA-256 of the method, path and body")
+    response_status = models.PositiveSmallIntegerField(null=True)
+    response_content_type = models.CharField(max_length=100, blank=True)
+    response_body = models.BinaryField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='api_idempotency_user_key_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} {self.key} ({self.response_status})"
+
+class OutboxEvent(models.Model):
+    """A side effect of a committed write, waiting for the outbox worker"""
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now, help_text="Not processed before this time")
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # The worker's queue: pending events that are due, oldest first
+            models.Index(fields=['status', 'available_at'], name='api_outbox_status_avail_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.topic} #{self.pk} ({self.status})"
+
 class Card(models.Model):
     CARD_TYPES = (
         ('debit', 'Debit Card'),
@@ -90,6 +210,8 @@ class Card(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = ShardedManager()
+    
     def __str__(self):
         return f"{self.card_brand} {self.card_type} ending in {self.card_number[-4:]}"
 
@@ -113,6 +235,63 @@ class Message(models.Model):
     priority = models.CharField(max_length=10, choices=PRIORITY_CHOICES, default='medium')
     read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = ShardedManager()
+    
+    class Meta:
+        indexes = [
+            # Inbox listing, newest first
+            models.Index(fields=['user', '-created_at', '-id'], name='api_msg_user_created_idx'),
+            # Unread messages, newest first
+            models.Index(fields=['user', 'read', '-created_at', '-id'], name='api_msg_user_read_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.title} ({self.user.username})"
+
+class TransferSaga(models.Model):
+    """
+    One leg of a transfer between accounts on different shards (see
+    ``api/transfers.py``). The debit leg lives on the sender's shard and
+    tracks the transfer until it completes or is compensated; the credit leg
+    lives on the recipient's shard and fences the credit, so it is applied or
+    aborted exactly once. Ids are plain integers: the rows they point at may
+    be on another database.
+    """
+    LEGS = (
+        ('debit', 'Debit'),
+        ('credit', 'Credit'),
+    )
+    
+    STATES = (
+        ('pending', 'Pending'),
+        ('completed', 'Completed'),
+        ('compensated', 'Compensated'),
+        ('credited', 'Credited'),
+        ('aborted', 'Aborted'),
+    )
+    
+    reference = models.CharField(max_length=100, unique=True)
+    leg = models.CharField(max_length=10, choices=LEGS)
+    state = models.CharField(max_length=12, choices=STATES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    sender_id = models.BigIntegerField()
+    sender_profile_id = models.BigIntegerField()
+    sender_transaction_id = models.BigIntegerField(null=True, blank=True)
+    recipient_shard = models.CharField(max_length=100)
+    recipient_id = models.BigIntegerField()
+    recipient_profile_id = models.BigIntegerField()
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="Recovery attempts")
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            # The recovery command's queue: debit legs stuck in pending
+            models.Index(fields=['state', 'updated_at'], name='api_saga_state_updated_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.reference} {self.leg} ({self.state})"
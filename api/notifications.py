@@ -0,0 +1,54 @@
+"""
+Outbox handlers that notify customers about completed transfers.
+
+Registered when the app loads (see ``ApiConfig.ready``).
+"""
+from . import outbox
+from .models import Message
+
+TRANSFER_COMPLETED = 'transfer.completed'
+
+
+def transfer_completed_payload(sender_transaction, recipient_user_id, recipient_balance):
+    """Everything the notifications need, so the handler makes no extra queries"""
+    return {
+        'reference': sender_transaction.reference,
+        'sender_id': sender_transaction.user_id,
+        'recipient_id': recipient_user_id,
+        'amount': str(sender_transaction.amount),
+        'currency': sender_transaction.currency,
+        'recipient_name': sender_transaction.recipient_name,
+        'recipient_account': sender_transaction.recipient_account,
+        'recipient_bank': sender_transaction.recipient_bank,
+        'sender_balance': str(sender_transaction.balance_after),
+        'recipient_balance': None if recipient_balance is None else str(recipient_balance),
+    }
+
+
+@outbox.handler(TRANSFER_COMPLETED)
+def notify_transfer(payload):
+    """A debit notice for the sender and, for internal transfers, a credit alert for the recipient"""
+    amount = f"{payload['currency']} {payload['amount']}"
+    messages = [Message(
+        user_id=payload['sender_id'],
+        title='Transfer successful',
+        content=(
+            f"You sent {amount} to {payload['recipient_name']} "
+            f"({payload['recipient_account']}, {payload['recipient_bank']}). "
+            f"Ref: {payload['reference']}. Balance: {payload['currency']} {payload['sender_balance']}"
+        ),
+        type='notification',
+        priority='low',
+    )]
+    if payload['recipient_id'] is not None:
+        messages.append(Message(
+            user_id=payload['recipient_id'],
+            title='Credit alert',
+            content=(
+                f"You received {amount}. Ref: {payload['reference']}. "
+                f"Balance: {payload['currency']} {payload['recipient_balance']}"
+            ),
+            type='alert',
+            priority='medium',
+        ))
+    Message.objects.bulk_create(messages)
@@ -0,0 +1,145 @@
+"""
+Transactional outbox for the side effects of ledger writes.
+
+Code that commits a change calls ``emit()`` inside the same transaction. The
+``OutboxEvent`` row commits or rolls back with the change, so a side effect
+is never lost once the change is committed and never runs for a change that
+rolled back, and the request doesn't wait for it.
+
+``python manage.py run_outbox`` drains due events. Each claim leases a batch
+for ``OUTBOX_LEASE_SECONDS`` (so several workers can run side by side) and
+hands the events to a thread pool. The handlers registered for an event's
+topic run in one transaction together with marking the event done, so their
+database writes happen exactly once. A failed event is retried with
+exponential backoff (``OUTBOX_RETRY_DELAY`` doubling up to
+``OUTBOX_MAX_RETRY_DELAY`` seconds) and marked failed after
+``OUTBOX_MAX_ATTEMPTS`` attempts. An event whose handlers outlive the lease
+can be picked up again, so handlers with external effects such as webhooks
+must tolerate running twice.
+
+Handlers are registered with ``@outbox.handler('topic')`` and receive the
+event's JSON payload.
+
+With sharded accounts (see ``api/shards.py``) an event is queued on the
+shard of the write it follows and ``run_outbox`` drains every shard. Handler
+writes to another shard are outside the event's transaction, so they can
+repeat if marking the event done fails.
+"""
+import logging
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+_handlers = defaultdict(list)
+
+
+def handler(topic):
+    """Register the decorated function for events of ``topic``"""
+    def register(func):
+        _handlers[topic].append(func)
+        return func
+    return register
+
+
+def handlers_for(topic):
+    return list(_handlers.get(topic, ()))
+
+
+def emit(topic, payload, using=None):
+    """Queue one event; call inside the transaction whose commit it follows, on its database"""
+    return emit_many([(topic, payload)], using=using)[0]
+
+
+def emit_many(events, using=None):
+    """Queue ``(topic, payload)`` pairs with a single insert"""
+    return OutboxEvent.objects.db_manager(using).bulk_create(
+        [OutboxEvent(topic=topic, payload=payload) for topic, payload in events]
+    )
+
+
+def outbox_settings():
+    return {
+        'max_attempts': getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8),
+        'retry_delay': getattr(settings, 'OUTBOX_RETRY_DELAY', 5),
+        'max_retry_delay': getattr(settings, 'OUTBOX_MAX_RETRY_DELAY', 3600),
+        'lease': getattr(settings, 'OUTBOX_LEASE_SECONDS', 300),
+    }
+
+
+def retry_delay(attempts):
+    """Seconds before retrying after failed attempt number ``attempts``, with jitter"""
+    config = outbox_settings()
+    delay = min(config['retry_delay'] * 2 ** (attempts - 1), config['max_retry_delay'])
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim(batch_size, using=None):
+    """
+    Lease up to ``batch_size`` due events to this worker and return them.
+
+    Where the database supports it the rows are locked with SKIP LOCKED, so
+    concurrent workers claim disjoint batches without waiting on each other.
+    """
+    now = timezone.now()
+    queue = OutboxEvent.objects.db_manager(using)
+    due = queue.filter(status='pending', available_at__lte=now).order_by('available_at', 'id')
+    with transaction.atomic(using=using):
+        if connections[using or DEFAULT_DB_ALIAS].features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        events = list(due[:batch_size])
+        if events:
+            queue.filter(pk__in=[event.pk for event in events]).update(
+                available_at=now + timedelta(seconds=outbox_settings()['lease']),
+                attempts=F('attempts') + 1,
+            )
+    for event in events:
+        event.attempts += 1
+    return events
+
+
+def process(event):
+    """Run the handlers of one claimed event; returns whether it succeeded"""
+    queue = OutboxEvent.objects.db_manager(event._state.db)
+    try:
+        handlers = handlers_for(event.topic)
+        if not handlers:
+            raise LookupError(f'No outbox handler for {event.topic!r}')
+        with transaction.atomic(using=event._state.db):
+            for func in handlers:
+                func(event.payload)
+            queue.filter(pk=event.pk).update(
+                status='done', processed_at=timezone.now(), last_error=''
+            )
+        return True
+    except Exception as e:
+        logger.warning(f"Outbox event {event.pk} ({event.topic}) failed on attempt {event.attempts}: {e}")
+        if event.attempts >= outbox_settings()['max_attempts']:
+            queue.filter(pk=event.pk).update(status='failed', last_error=repr(e))
+        else:
+            queue.filter(pk=event.pk).update(
+                available_at=timezone.now() + timedelta(seconds=retry_delay(event.attempts)),
+                last_error=repr(e),
+            )
+        return False
+
+
+def drain(batch_size=100, run=None, using=None):
+    """
+    Claim and process one batch from ``using``'s queue. ``run`` maps
+    ``process`` over the events (e.g. a thread pool's ``map``); by default
+    they run inline. Returns ``(succeeded, failed)``; ``(0, 0)`` means
+    nothing was due.
+    """
+    events = claim(batch_size, using=using)
+    outcomes = list((run or map)(process, events))
+    succeeded = sum(outcomes)
+    return succeeded, len(outcomes) - succeeded
@@ -0,0 +1,20 @@
+from rest_framework.parsers import JSONParser, FormParser, MultiPartParser
+
+
+class SignedJSONParser(JSONParser):
+    """
+    JSONParser that reuses the body CryptographicSignatureMiddleware already
+    parsed while verifying the request, instead of decoding it a second time.
+    Bodies the middleware didn't parse are handled as usual.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = (parser_context or {}).get('request')
+        http_request = getattr(request, '_request', None)
+        if http_request is not None and hasattr(http_request, 'signed_data'):
+            return http_request.signed_data
+        return super().parse(stream, media_type, parser_context)
+
+
+# DRF's default parsers, with JSON going through SignedJSONParser
+API_PARSER_CLASSES = [SignedJSONParser, FormParser, MultiPartParser]
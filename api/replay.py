@@ -0,0 +1,172 @@
+"""
+Replay protection for signed requests.
+
+A signed request is identified by its signer, timestamp and the ``r`` value
+of its ECDSA signature. ``r`` is used rather than the raw signature bytes
+because ``(r, s)`` and ``(r, n - s)`` both verify, so hashing the encoded
+signature would let a replay through with the other ``s``.
+
+Requests are only accepted within ``SIGNATURE_MAX_AGE`` seconds of their
+timestamp, so a digest has to be remembered for that long and no longer.
+The backend is chosen with ``SIGNATURE_REPLAY_BACKEND``:
+
+- ``api.replay.MemoryReplayCache`` (default): per process. Fine for a single
+  worker; with several, a replay can succeed once on each of them.
+- ``api.replay.DjangoCacheReplayCache``: shared through the cache named by
+  ``SIGNATURE_REPLAY_CACHE_ALIAS`` (default ``default``). Use a cache that all
+  workers share and whose ``add()`` is atomic, such as Redis or Memcached.
+"""
+import base64
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+
+def max_age():
+    return getattr(settings, 'SIGNATURE_MAX_AGE', 300)
+
+
+def parse_timestamp(timestamp):
+    """Milliseconds since the epoch, as sent in X-Timestamp; None if malformed"""
+    try:
+        return int(timestamp) / 1000
+    except (TypeError, ValueError):
+        return None
+
+
+def is_fresh(timestamp_seconds, now=None):
+    """Whether a request stamped ``timestamp_seconds`` is inside the allowed window"""
+    now = time.time() if now is None else now
+    return abs(now - timestamp_seconds) <= max_age()
+
+
+def replay_digest(user_id, timestamp, signature_b64):
+    """Digest identifying a signed request; raises ValueError for a malformed signature"""
+    r, _ = decode_dss_signature(base64.b64decode(signature_b64, validate=True))
+    return hashlib.sha256(f'{user_id}:{timestamp}:{r}'.encode('ascii')).digest()
+
+
+class ReplayCache:
+    """
+    Backend interface. ``timestamp`` is the request's timestamp in seconds;
+    a digest only needs to be kept until that plus ``max_age``.
+    """
+
+    def seen(self, digest, timestamp):
+        raise NotImplementedError
+
+    def add(self, digest, timestamp):
+        """Record ``digest``; returns False if it was already recorded"""
+        raise NotImplementedError
+
+    async def aseen(self, digest, timestamp):
+        return self.seen(digest, timestamp)
+
+    async def aadd(self, digest, timestamp):
+        return self.add(digest, timestamp)
+
+
+class MemoryReplayCache(ReplayCache):
+    """
+    Per-process digests in sets bucketed by request timestamp.
+
+    Each bucket covers ``bucket_seconds``; once every timestamp in it is
+    older than the freshness window the whole set is dropped, so memory is
+    bounded by the request rate over the window and every check is a single
+    set lookup.
+    """
+
+    def __init__(self, bucket_seconds=10):
+        self.bucket_seconds = bucket_seconds
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._next_expiry = 0
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.bucket_seconds)
+
+    def _expire(self, now):
+        if now < self._next_expiry:
+            return
+        # Buckets before the one holding ``now - max_age`` only hold stale timestamps
+        oldest_live = self._bucket(now - max_age())
+        for bucket in [b for b in self._buckets if b < oldest_live]:
+            del self._buckets[bucket]
+        self._next_expiry = now + self.bucket_seconds
+
+    def seen(self, digest, timestamp):
+        with self._lock:
+            digests = self._buckets.get(self._bucket(timestamp))
+            return digests is not None and digest in digests
+
+    def add(self, digest, timestamp):
+        with self._lock:
+            self._expire(time.time())
+            digests = self._buckets.setdefault(self._bucket(timestamp), set())
+            if digest in digests:
+                return False
+            digests.add(digest)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._next_expiry = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'size': sum(len(digests) for digests in self._buckets.values()),
+            }
+
+
+class DjangoCacheReplayCache(ReplayCache):
+    """Digests stored in a Django cache shared by all workers, expiring with the window"""
+
+    key_prefix = 'signature-replay:'
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'SIGNATURE_REPLAY_CACHE_ALIAS', 'default')
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, digest):
+        return self.key_prefix + digest.hex()
+
+    def _timeout(self, timestamp):
+        return max(1, int(timestamp + max_age() - time.time()) + 1)
+
+    def seen(self, digest, timestamp):
+        return self.cache.get(self._key(digest)) is not None
+
+    def add(self, digest, timestamp):
+        return self.cache.add(self._key(digest), 1, timeout=self._timeout(timestamp))
+
+    async def aseen(self, digest, timestamp):
+        return await self.cache.aget(self._key(digest)) is not None
+
+    async def aadd(self, digest, timestamp):
+        return await self.cache.aadd(self._key(digest), 1, timeout=self._timeout(timestamp))
+
+
+_replay_cache = None
+_replay_cache_lock = threading.Lock()
+
+
+def get_replay_cache():
+    """The configured replay cache backend (one instance per process)"""
+    global _replay_cache
+    if _replay_cache is None:
+        with _replay_cache_lock:
+            if _replay_cache is None:
+                backend = getattr(settings, 'SIGNATURE_REPLAY_BACKEND', 'api.replay.MemoryReplayCache')
+                _replay_cache = import_string(backend)()
+    return _replay_cache
@@ -0,0 +1,258 @@
+"""
+Read-replica routing with read-your-writes stickiness.
+
+Enable it with::
+
+    DATABASE_ROUTERS = ['api.routers.ReplicaRouter']
+    DATABASE_REPLICAS = ['replica1', 'replica2']   # aliases in DATABASES
+
+and put ``api.routers.ReplicaRoutingMiddleware`` in ``MIDDLEWARE`` before
+``CryptographicSignatureMiddleware``.
+
+Writes always go to ``default``. Reads go to a random healthy replica
+except when they must see data this process just wrote:
+
+- inside a transaction on ``default`` (``transaction.atomic()`` blocks,
+  ``select_for_update()``), and for objects loaded from ``default``
+- for ``REPLICA_STICKY_SECONDS`` (default 5) after a write from the same
+  thread or task
+- for the whole of a POST, PUT, PATCH or DELETE request, and for
+  ``REPLICA_STICKY_SECONDS`` after it for every request by the same user.
+  The pin is kept in the Django cache (``REPLICA_STICKY_CACHE``, default
+  ``default``), so it covers other workers only with a shared cache.
+  Anonymous requests are only pinned while they run; registration pins the
+  new user with ``pin_user()`` itself.
+
+A replica's lag is measured at most every ``REPLICA_LAG_CHECK_INTERVAL``
+seconds (default 1) and the replica is skipped while it is more than
+``REPLICA_MAX_LAG`` seconds (default 2) behind or unreachable. When no
+replica qualifies, reads fall back to ``default``. Keep the sticky window
+above the maximum lag plus the check interval, or a pinned user can be
+unpinned before their write has reached the replicas.
+
+Lag is measured on PostgreSQL and MySQL. Other engines (e.g. SQLite in
+development) report no lag.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.deprecation import MiddlewareMixin
+
+from .authentication import arequest_user, request_user
+
+logger = logging.getLogger(__name__)
+
+UNSAFE_METHODS = frozenset(('POST', 'PUT', 'PATCH', 'DELETE'))
+
+# monotonic() deadline until which this thread or task reads from the primary
+_pinned_until = ContextVar('replica_pinned_until', default=0.0)
+# Whether the current request has written
+_wrote = ContextVar('replica_wrote', default=False)
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def replica_settings():
+    return {
+        'sticky_seconds': getattr(settings, 'REPLICA_STICKY_SECONDS', 5),
+        'max_lag': getattr(settings, 'REPLICA_MAX_LAG', 2),
+        'check_interval': getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 1),
+        'cache': getattr(settings, 'REPLICA_STICKY_CACHE', 'default'),
+    }
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside this block"""
+    token = _pinned_until.set(math.inf)
+    try:
+        yield
+    finally:
+        _pinned_until.reset(token)
+
+
+def pin(seconds=None):
+    """Read from the primary in this thread or task for ``seconds`` (the sticky window)"""
+    if seconds is None:
+        seconds = replica_settings()['sticky_seconds']
+    _pinned_until.set(max(_pinned_until.get(), time.monotonic() + seconds))
+
+
+def _pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def _pin_entry():
+    config = replica_settings()
+    return caches[config['cache']], time.time() + config['sticky_seconds'], math.ceil(config['sticky_seconds'])
+
+
+def pin_user(user_id):
+    """Send ``user_id``'s reads to the primary for the sticky window, in every request"""
+    if replicas():
+        cache, expires, timeout = _pin_entry()
+        cache.set(_pin_key(user_id), expires, timeout=timeout)
+
+
+async def apin_user(user_id):
+    if replicas():
+        cache, expires, timeout = _pin_entry()
+        await cache.aset(_pin_key(user_id), expires, timeout=timeout)
+
+
+def user_is_pinned(user_id):
+    expires = caches[replica_settings()['cache']].get(_pin_key(user_id))
+    return expires is not None and expires > time.time()
+
+
+async def auser_is_pinned(user_id):
+    expires = await caches[replica_settings()['cache']].aget(_pin_key(user_id))
+    return expires is not None and expires > time.time()
+
+
+def replica_lag(alias):
+    """
+    Seconds ``alias`` is behind its primary, 0.0 where the engine can't tell.
+    Raises DatabaseError when the replica can't be reached.
+    """
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # An idle replica has replayed everything it received; don't count idle time as lag
+            cursor.execute(
+                "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+            )
+            lag = cursor.fetchone()[0]
+            return float(lag or 0)
+        if connection.vendor == 'mysql':
+            cursor.execute('SHOW REPLICA STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                return 0.0
+            columns = [column[0] for column in cursor.description]
+            lag = dict(zip(columns, row)).get('Seconds_Behind_Source')
+            # NULL means replication is stopped
+            return math.inf if lag is None else float(lag)
+    return 0.0
+
+
+class ReplicaHealth:
+    """Per-process cache of replica lag measurements"""
+
+    def __init__(self):
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def is_usable(self, alias):
+        config = replica_settings()
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._checked.get(alias, (None, None))
+        if checked_at is None or now - checked_at >= config['check_interval']:
+            lag = self._measure(alias)
+            with self._lock:
+                self._checked[alias] = (now, lag)
+        return lag <= config['max_lag']
+
+    def _measure(self, alias):
+        try:
+            return replica_lag(alias)
+        except DatabaseError as e:
+            logger.warning(f"Replica {alias} is unreachable, reading from the primary: {e}")
+            return math.inf
+
+    def clear(self):
+        with self._lock:
+            self._checked.clear()
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    """Writes to ``default``; reads to a healthy replica unless they must see recent writes"""
+
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or self._needs_primary(hints):
+            return DEFAULT_DB_ALIAS
+        usable = [alias for alias in aliases if replica_health.is_usable(alias)]
+        return random.choice(usable) if usable else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if replicas():
+            pin()
+            _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def _needs_primary(self, hints):
+        if time.monotonic() < _pinned_until.get():
+            return True
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return True
+        instance = hints.get('instance')
+        return instance is not None and instance._state.db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    """
+    Pins requests to the primary: writes for their whole duration, and every
+    request from a user who wrote within the sticky window.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not replicas():
+            return self.get_response(request)
+        with primary():
+            # A new token may not have reached the replicas yet
+            user = request_user(request)
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        pinned = request.method in UNSAFE_METHODS or (user_id is not None and user_is_pinned(user_id))
+        tokens = (_pinned_until.set(math.inf if pinned else 0.0), _wrote.set(False))
+        try:
+            response = self.get_response(request)
+            if user_id is not None and self._wrote(request):
+                pin_user(user_id)
+        finally:
+            _pinned_until.reset(tokens[0])
+            _wrote.reset(tokens[1])
+        return response
+
+    async def __acall__(self, request):
+        if not replicas():
+            return await self.get_response(request)
+        with primary():
+            user = await arequest_user(request)
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        pinned = request.method in UNSAFE_METHODS or (user_id is not None and await auser_is_pinned(user_id))
+        tokens = (_pinned_until.set(math.inf if pinned else 0.0), _wrote.set(False))
+        try:
+            response = await self.get_response(request)
+            if user_id is not None and self._wrote(request):
+                await apin_user(user_id)
+        finally:
+            _pinned_until.reset(tokens[0])
+            _wrote.reset(tokens[1])
+        return response
+
+    def _wrote(self, request):
+        return _wrote.get() or request.method in UNSAFE_METHODS
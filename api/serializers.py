@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.contrib.auth.validators import UnicodeUsernameValidator
 from .models import UserProfile, Transaction, Card, Message
+from .row_serializers import RowSerializer
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -8,8 +10,15 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 'date_joined']
         read_only_fields = ['date_joined']
 
+class RegistrationSerializer(UserSerializer):
+    """UserSerializer without the username uniqueness query; register_user checks all fields at once"""
+    class Meta(UserSerializer.Meta):
+        extra_kwargs = {'username': {'validators': [UnicodeUsernameValidator()]}}
+
 class UserProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    # Includes a hot account's credits not yet rolled up
+    account_balance = serializers.DecimalField(source='balance', max_digits=12, decimal_places=2, read_only=True)
     
     class Meta:
         model = UserProfile
@@ -48,3 +57,7 @@ class MessageSerializer(serializers.ModelSerializer):
             'priority', 'read', 'created_at'
         ]
         read_only_fields = ['user', 'created_at']
+
+# .values() read path for the list endpoints; same output as the serializers above
+transaction_rows = RowSerializer(TransactionSerializer)
+message_rows = RowSerializer(MessageSerializer)
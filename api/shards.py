@@ -0,0 +1,216 @@
+"""
+Hash-sharded customer data.
+
+``UserProfile``, ``Transaction``, ``Card``, ``Message`` and
+``DailyBalanceSnapshot`` rows live on one of the database aliases listed in
+``ACCOUNT_SHARDS`` (default ``['default']``, i.e. unsharded), chosen by a
+stable hash of the owner's user id. Users, tokens and the other tables stay
+on ``default``, which acts as the directory: a user id alone says which
+shard holds the account. Each shard keeps a stub of its users' ``auth_user``
+rows (names but no password, see ``mirror_users``) so foreign keys and
+``select_related('user')`` stay local to the shard.
+
+Enable it with::
+
+    ACCOUNT_SHARDS = ['default', 'shard1', 'shard2', 'shard3']
+    DATABASE_ROUTERS = ['api.shards.ShardRouter']
+
+and run ``migrate --database=<alias>`` for every shard. The shard is the
+hash modulo the number of aliases, so changing the list moves accounts; add
+shards to a new deployment or move the affected accounts first.
+
+Per-user queries go through the sharded models' manager:
+``Transaction.objects.for_user(user)`` reads the owner's shard, ``create()``
+and ``bulk_create()`` write each row to its owner's shard, and
+``scatter()``/``find()`` search every shard for lookups that don't start
+from a user (an account number, a BVN). ``ShardRouter`` covers relations
+such as ``user.profile``. Unsharded, these leave the choice of database to
+the configured routers, so read replicas keep working.
+
+Transfers between accounts on different shards can't share a database
+transaction; ``api.transfers`` runs them as a saga (see ``TransferSaga``).
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import checks
+from django.db import DEFAULT_DB_ALIAS, connections, models
+
+UNUSABLE_PASSWORD = '!'
+# auth_user columns copied into the shard stubs
+STUB_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'date_joined')
+
+
+def shard_aliases():
+    return list(getattr(settings, 'ACCOUNT_SHARDS', None) or [DEFAULT_DB_ALIAS])
+
+
+def is_sharded():
+    return shard_aliases() != [DEFAULT_DB_ALIAS]
+
+
+def shard_for_user(user_id):
+    """The alias holding ``user_id``'s account; stable across processes and restarts"""
+    aliases = shard_aliases()
+    if len(aliases) == 1:
+        return aliases[0]
+    digest = hashlib.blake2b(str(user_id).encode('ascii'), digest_size=8).digest()
+    return aliases[int.from_bytes(digest, 'big') % len(aliases)]
+
+
+def account_db(user_id):
+    """
+    The alias to send ``user_id``'s account queries to, or None when
+    unsharded so the configured routers (e.g. read replicas) still decide
+    """
+    return shard_for_user(user_id) if is_sharded() else None
+
+
+def account_dbs():
+    """Every shard's alias, or ``[None]`` (the routers' choice) when unsharded"""
+    return shard_aliases() if is_sharded() else [None]
+
+
+def _user_id(value):
+    return value if isinstance(value, int) else value.pk
+
+
+class ShardedQuerySet(models.QuerySet):
+    def on_shard(self, user):
+        """Rows on ``user``'s shard, not only theirs (e.g. to update by primary key)"""
+        if not is_sharded():
+            return self
+        return self.using(shard_for_user(_user_id(user)))
+
+    def for_user(self, user):
+        """``user``'s rows, read from their shard"""
+        return self.on_shard(user).filter(user_id=_user_id(user))
+
+    def scatter(self, **filters):
+        """Matching rows from every shard, in shard order"""
+        if not is_sharded():
+            return list(self.filter(**filters))
+        rows = []
+        for alias in shard_aliases():
+            rows.extend(self.using(alias).filter(**filters))
+        return rows
+
+    def find(self, **filters):
+        """The one row matching ``filters`` on any shard; raises DoesNotExist if none"""
+        if not is_sharded():
+            return self.get(**filters)
+        for alias in shard_aliases():
+            try:
+                return self.using(alias).get(**filters)
+            except self.model.DoesNotExist:
+                continue
+        raise self.model.DoesNotExist(f'{self.model._meta.object_name} matching query does not exist.')
+
+    async def afind(self, **filters):
+        if not is_sharded():
+            return await self.aget(**filters)
+        for alias in shard_aliases():
+            row = await self.using(alias).filter(**filters).afirst()
+            if row is not None:
+                return row
+        raise self.model.DoesNotExist(f'{self.model._meta.object_name} matching query does not exist.')
+
+    def create(self, **kwargs):
+        owner = kwargs.get('user_id', kwargs.get('user'))
+        if self._db is None and owner is not None and is_sharded():
+            return self.using(shard_for_user(_user_id(owner))).create(**kwargs)
+        return super().create(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        if self._db is not None or not is_sharded():
+            return super().bulk_create(objs, *args, **kwargs)
+        by_shard = {}
+        for obj in objs:
+            by_shard.setdefault(shard_for_user(obj.user_id), []).append(obj)
+        for alias, group in by_shard.items():
+            self.using(alias).bulk_create(group, *args, **kwargs)
+        return objs
+
+
+class ShardedManager(models.Manager.from_queryset(ShardedQuerySet)):
+    """Manager for models whose rows live on their owner's shard"""
+
+
+def is_sharded_model(model):
+    return isinstance(model._default_manager, ShardedManager)
+
+
+def mirror_users(users, alias=None):
+    """
+    Write password-less stubs of ``users`` (saved on ``default``) to their
+    shards, or all to ``alias``. Users already mirrored are left alone.
+    """
+    by_shard = {}
+    for user in users:
+        target = alias or shard_for_user(user.pk)
+        if target != DEFAULT_DB_ALIAS:
+            by_shard.setdefault(target, []).append(
+                User(password=UNUSABLE_PASSWORD, **{field: getattr(user, field) for field in STUB_FIELDS})
+            )
+    for target, stubs in by_shard.items():
+        User.objects.using(target).bulk_create(stubs, ignore_conflicts=True)
+
+
+def delete_users(user_ids):
+    """Delete users with their sharded data (a delete on ``default`` doesn't cascade to shards)"""
+    user_ids = list(user_ids)
+    for alias in shard_aliases():
+        if alias != DEFAULT_DB_ALIAS:
+            User.objects.using(alias).filter(pk__in=user_ids).delete()
+    User.objects.filter(pk__in=user_ids).delete()
+
+
+class ShardRouter:
+    """
+    Sends sharded models to their owner's shard when Django resolves a
+    relation (``user.profile``, ``user.transactions``) or saves an instance,
+    and allows relations between users on ``default`` and their sharded rows.
+    """
+
+    def _shard(self, model, hints):
+        if not is_sharded_model(model):
+            return None
+        instance = hints.get('instance')
+        if isinstance(instance, User):
+            return shard_for_user(instance.pk)
+        user_id = getattr(instance, 'user_id', None)
+        if user_id is not None:
+            return shard_for_user(user_id)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = set(shard_aliases()) | {DEFAULT_DB_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases and any(
+            is_sharded_model(type(obj)) for obj in (obj1, obj2)
+        ):
+            return True
+        return None
+
+
+@checks.register()
+def check_shards(app_configs, **kwargs):
+    errors = []
+    aliases = shard_aliases()
+    for alias in aliases:
+        if alias not in connections.settings:
+            errors.append(checks.Error(
+                f"ACCOUNT_SHARDS lists '{alias}', which is not in DATABASES", id='api.E001'
+            ))
+    if is_sharded() and 'api.shards.ShardRouter' not in getattr(settings, 'DATABASE_ROUTERS', []):
+        errors.append(checks.Error(
+            'ACCOUNT_SHARDS needs api.shards.ShardRouter in DATABASE_ROUTERS', id='api.E002'
+        ))
+    return errors
@@ -1,15 +1,44 @@
+import asyncio
 import json
 import base64
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
-from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.exceptions import InvalidSignature
+from rest_framework.utils.json import strict_constant
 from .models import UserProfile
+from .authentication import arequest_user, request_user
+from .key_cache import public_key_cache
+from .replay import get_replay_cache, is_fresh, parse_timestamp, replay_digest
+from .timing import phase
 import logging
 
 logger = logging.getLogger(__name__)
 
+_verify_executor = None
+_verify_executor_lock = threading.Lock()
+
+def get_verify_executor():
+    """
+    Bounded thread pool for CPU-bound signature verification on the async path.
+    Sized by SIGNATURE_VERIFY_WORKERS (default: number of CPUs).
+    """
+    global _verify_executor
+    if _verify_executor is None:
+        with _verify_executor_lock:
+            if _verify_executor is None:
+                _verify_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'SIGNATURE_VERIFY_WORKERS', None) or os.cpu_count() or 4,
+                    thread_name_prefix='signature-verify',
+                )
+    return _verify_executor
+
 class CryptographicSignatureMiddleware(MiddlewareMixin):
     """
     Middleware to verify cryptographic signatures on sensitive API requests.
@@ -28,15 +57,106 @@ class CryptographicSignatureMiddleware(MiddlewareMixin):
     # Methods that require signatures
     SIGNATURE_REQUIRED_METHODS = ['POST', 'PUT', 'PATCH', 'DELETE']
     
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        # One anchored alternation instead of a startswith() per prefix
+        self._signed_methods = frozenset(self.SIGNATURE_REQUIRED_METHODS)
+        self._signed_paths = re.compile(
+            '|'.join(re.escape(endpoint) for endpoint in self.SIGNATURE_REQUIRED_ENDPOINTS)
+        )
+    
     def process_request(self, request):
         """Process incoming request and verify signature if required"""
         
         # Skip signature verification for certain conditions
         if not self._requires_signature(request):
             return None
+        
+        with phase(request, 'auth'):
+            user = request_user(request)
+        error = self._check_headers(request, user)
+        if error is not None:
+            return error
+        
+        signature = request.META['HTTP_X_SIGNATURE']
+        timestamp = request.META['HTTP_X_TIMESTAMP']
+        try:
+            digest = replay_digest(user.id, timestamp, signature)
+        except ValueError:
+            return self._invalid_signature()
+        
+        # Reject replays before paying for the key lookup and ECDSA verify
+        replay_cache = get_replay_cache()
+        timestamp_seconds = parse_timestamp(timestamp)
+        with phase(request, 'replay'):
+            seen = replay_cache.seen(digest, timestamp_seconds)
+        if seen:
+            return self._replayed(user)
+        
+        # Verify the signature
+        try:
+            verified = self._verify_signature(request, user, signature, timestamp)
+        except Exception as e:
+            logger.error(f"Signature verification error: {str(e)}")
+            return self._verification_error()
+        
+        if not verified:
+            return self._invalid_signature()
+        
+        # Only verified requests are recorded; a concurrent duplicate loses here
+        with phase(request, 'replay'):
+            added = replay_cache.add(digest, timestamp_seconds)
+        if not added:
+            return self._replayed(user)
+        return None
+    
+    async def __acall__(self, request):
+        """
+        Native async path: the profile lookup uses the async ORM and the ECDSA
+        verify runs on a bounded thread pool, so the event loop never blocks
+        and no sync_to_async thread hop is needed.
+        """
+        if self._requires_signature(request):
+            with phase(request, 'auth'):
+                user = await arequest_user(request)
+            error = self._check_headers(request, user)
+            if error is not None:
+                return error
+            
+            signature = request.META['HTTP_X_SIGNATURE']
+            timestamp = request.META['HTTP_X_TIMESTAMP']
+            try:
+                digest = replay_digest(user.id, timestamp, signature)
+            except ValueError:
+                return self._invalid_signature()
+            
+            replay_cache = get_replay_cache()
+            timestamp_seconds = parse_timestamp(timestamp)
+            with phase(request, 'replay'):
+                seen = await replay_cache.aseen(digest, timestamp_seconds)
+            if seen:
+                return self._replayed(user)
+            
+            try:
+                verified = await self._averify_signature(request, user, signature, timestamp)
+            except Exception as e:
+                logger.error(f"Signature verification error: {str(e)}")
+                return self._verification_error()
             
+            if not verified:
+                return self._invalid_signature()
+            with phase(request, 'replay'):
+                added = await replay_cache.aadd(digest, timestamp_seconds)
+            if not added:
+                return self._replayed(user)
+        
+        return await self.get_response(request)
+    
+    def _check_headers(self, request, user):
+        """Return an error response if the request can't be verified at all"""
+        
         # Check if user is authenticated
-        if not hasattr(request, 'user') or not request.user.is_authenticated:
+        if user is None or not user.is_authenticated:
             return JsonResponse({
                 'error': 'Authentication required for signed requests'
             }, status=401)
@@ -51,45 +171,102 @@ class CryptographicSignatureMiddleware(MiddlewareMixin):
                 'details': 'Sensitive operations require digital signature verification'
             }, status=400)
         
-        # Verify the signature
-        try:
-            if not self._verify_signature(request, signature, timestamp):
-                return JsonResponse({
-                    'error': 'Invalid cryptographic signature',
-                    'details': 'Request signature verification failed'
-                }, status=403)
-        except Exception as e:
-            logger.error(f"Signature verification error: {str(e)}")
+        # Freshness is checked before any database or crypto work
+        timestamp_seconds = parse_timestamp(timestamp)
+        if timestamp_seconds is None:
             return JsonResponse({
-                'error': 'Signature verification failed',
-                'details': 'Unable to verify request authenticity'
-            }, status=500)
+                'error': 'Invalid timestamp',
+                'details': 'X-Timestamp must be milliseconds since the epoch'
+            }, status=400)
+        if not is_fresh(timestamp_seconds):
+            return JsonResponse({
+                'error': 'Request expired',
+                'details': 'X-Timestamp is outside the allowed time window'
+            }, status=403)
         
         return None
     
+    def _invalid_signature(self):
+        return JsonResponse({
+            'error': 'Invalid cryptographic signature',
+            'details': 'Request signature verification failed'
+        }, status=403)
+    
+    def _replayed(self, user):
+        logger.warning(f"Replayed signed request for user {user.username}")
+        return JsonResponse({
+            'error': 'Duplicate request',
+            'details': 'This signed request has already been processed'
+        }, status=403)
+    
+    def _verification_error(self):
+        return JsonResponse({
+            'error': 'Signature verification failed',
+            'details': 'Unable to verify request authenticity'
+        }, status=500)
+    
     def _requires_signature(self, request):
         """Check if the request requires a cryptographic signature"""
         
         # Skip for non-sensitive methods
-        if request.method not in self.SIGNATURE_REQUIRED_METHODS:
+        if request.method not in self._signed_methods:
             return False
         
         # Check if the endpoint requires signature
-        path = request.path
-        for endpoint in self.SIGNATURE_REQUIRED_ENDPOINTS:
-            if path.startswith(endpoint):
-                return True
-        
-        return False
+        return self._signed_paths.match(request.path) is not None
     
-    def _verify_signature(self, request, signature_b64, timestamp):
+    def _verify_signature(self, request, user, signature_b64, timestamp):
         """Verify the cryptographic signature"""
         
         try:
-            # Get user's public key
-            profile = UserProfile.objects.get(user=request.user)
-            if not profile.public_key:
-                logger.warning(f"No public key found for user {request.user.username}")
+            # The profile is memoized on the user for the rest of the request;
+            # a cached one has the key deferred, so it is read fresh here
+            with phase(request, 'profile'):
+                stored_key = user.profile.public_key
+        except UserProfile.DoesNotExist:
+            stored_key = None
+        except Exception as e:
+            logger.error(f"Signature verification error: {str(e)}")
+            return False
+        
+        return self._check_signature(request, user, stored_key, signature_b64, timestamp)
+    
+    async def _averify_signature(self, request, user, signature_b64, timestamp):
+        """Async version of _verify_signature"""
+        
+        try:
+            # Reuse the profile memoized on the user (e.g. by the token cache)
+            if type(user).profile.is_cached(user):
+                profile = user.profile
+            else:
+                with phase(request, 'profile'):
+                    profile = await UserProfile.objects.for_user(user).afirst()
+                if profile is not None:
+                    user.profile = profile
+            if profile is not None and 'public_key' in profile.get_deferred_fields():
+                # Deferred by the token cache, so a rotated key is never served stale
+                with phase(request, 'profile'):
+                    await profile.arefresh_from_db(fields=['public_key'])
+            stored_key = profile.public_key if profile is not None else None
+        except Exception as e:
+            logger.error(f"Signature verification error: {str(e)}")
+            return False
+        
+        # Parsing and ECDSA verification are CPU-bound; keep them off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            get_verify_executor(),
+            self._check_signature, request, user, stored_key, signature_b64, timestamp
+        )
+    
+    def _check_signature(self, request, user, stored_key, signature_b64, timestamp):
+        """Check ``signature_b64`` against the user's stored key (no database access)"""
+        
+        try:
+            if stored_key is None:
+                raise UserProfile.DoesNotExist
+            if not stored_key:
+                logger.warning(f"No public key found for user {user.username}")
                 return False
             
             # Decode the signature
@@ -102,46 +279,67 @@ class CryptographicSignatureMiddleware(MiddlewareMixin):
                 'path': request.path,
                 'data': request_data,
                 'timestamp': timestamp,
-                'user_id': str(request.user.id)
+                'user_id': str(user.id)
             }
             
-            # Convert to JSON string for verification
-            data_string = json.dumps(data_to_verify, sort_keys=True, separators=(',', ':'))
+            # Canonical JSON, built once; kept on the request for later consumers
+            request.signed_message = json.dumps(
+                data_to_verify, sort_keys=True, separators=(',', ':')
+            ).encode('utf-8')
             
-            # Load the public key
-            public_key_bytes = base64.b64decode(profile.public_key)
-            public_key = serialization.load_der_public_key(public_key_bytes)
+            # Load the public key (parsed keys are cached per process)
+            with phase(request, 'key'):
+                public_key = public_key_cache.get(user.id, stored_key)
             
             # Verify the signature
-            public_key.verify(
-                signature,
-                data_string.encode('utf-8'),
-                ec.ECDSA(hashes.SHA384())
-            )
+            with phase(request, 'verify'):
+                public_key.verify(
+                    signature,
+                    request.signed_message,
+                    ec.ECDSA(hashes.SHA384())
+                )
             
-            logger.info(f"Signature verified successfully for user {request.user.username}")
+            logger.info(f"Signature verified successfully for user {user.username}")
             return True
             
         except InvalidSignature:
-            logger.warning(f"Invalid signature for user {request.user.username}")
+            logger.warning(f"Invalid signature for user {user.username}")
             return False
         except UserProfile.DoesNotExist:
-            logger.error(f"User profile not found for {request.user.username}")
+            logger.error(f"User profile not found for {user.username}")
             return False
         except Exception as e:
             logger.error(f"Signature verification error: {str(e)}")
             return False
     
     def _get_request_data(self, request):
-        """Extract and parse request data"""
+        """
+        Extract and parse request data.
+        
+        A body that DRF's JSONParser would accept is kept on the request as
+        ``signed_data`` so SignedJSONParser hands it to the view without
+        parsing it again.
+        """
         try:
             if hasattr(request, '_body'):
                 body = request._body
             else:
                 body = request.body
             
-            if body:
-                return json.loads(body.decode('utf-8'))
+            if not body:
+                return {}
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
             return {}
-        except (json.JSONDecodeError, UnicodeDecodeError):
+        
+        try:
+            request.signed_data = json.loads(text, parse_constant=strict_constant)
+            return request.signed_data
+        except ValueError:
+            pass
+        
+        # Not valid for DRF either (e.g. NaN); the view will reject it itself
+        try:
+            return json.loads(text)
+        except ValueError:
             return {}
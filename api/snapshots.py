@@ -0,0 +1,156 @@
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DailyBalanceSnapshot, Transaction, UserProfile
+
+DEBIT_TYPES = ('debit', 'transfer')
+
+
+def signed_amount(txn_type, amount):
+    return -amount if txn_type in DEBIT_TYPES else amount
+
+
+def ledger_date(moment):
+    """The calendar day a transaction is booked on, in the current time zone"""
+    if timezone.is_aware(moment):
+        return timezone.localdate(moment)
+    return moment.date()
+
+
+def start_of_day(day):
+    moment = datetime.combine(day, time.min)
+    if settings.USE_TZ:
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def fold_into_days(transactions):
+    """
+    Group completed transactions by (user, day) in the order given.
+
+    Returns ``{(user_id, date): [opening, closing, count]}`` where the opening
+    balance is derived from the first transaction's ``balance_after``.
+    """
+    days = {}
+    for txn in transactions:
+        if txn.status != 'completed':
+            continue
+        key = (txn.user_id, ledger_date(txn.created_at))
+        entry = days.get(key)
+        if entry is None:
+            opening = txn.balance_after - signed_amount(txn.type, txn.amount)
+            days[key] = [opening, txn.balance_after, 1]
+        else:
+            entry[1] = txn.balance_after
+            entry[2] += 1
+    return days
+
+
+def record_transactions(transactions, using=None):
+    """
+    Fold newly written transactions into their owners' daily snapshots.
+
+    Call inside the transaction that wrote them, after the account rows were
+    locked, so each account's snapshot is updated in ledger order. ``using``
+    is that transaction's database when the accounts are sharded.
+    """
+    for (user_id, day), (opening, closing, count) in fold_into_days(transactions).items():
+        record_day(user_id, day, opening, closing, count, using=using)
+
+
+def record_day(user_id, day, opening, closing, count, using=None):
+    """Add ``count`` transactions ending at ``closing`` to a day's snapshot, opening it if needed"""
+    snapshots = DailyBalanceSnapshot.objects.db_manager(using)
+    update = dict(
+        closing_balance=closing,
+        transaction_count=F('transaction_count') + count,
+        updated_at=timezone.now(),
+    )
+    if snapshots.filter(user_id=user_id, date=day).update(**update):
+        return
+    try:
+        with transaction.atomic(using=using):
+            snapshots.create(
+                user_id=user_id,
+                date=day,
+                opening_balance=opening,
+                closing_balance=closing,
+                transaction_count=count,
+            )
+    except IntegrityError:
+        # Someone else opened the day first; extend their row instead
+        snapshots.filter(user_id=user_id, date=day).update(**update)
+
+
+def _closing_before(user, day):
+    """Balance at the start of ``day``: the last earlier snapshot's closing balance"""
+    closing = (
+        DailyBalanceSnapshot.objects.for_user(user).filter(date__lt=day)
+        .order_by('-date')
+        .values_list('closing_balance', flat=True)
+        .first()
+    )
+    if closing is not None:
+        return closing
+
+    # No activity before this day: the account held its first recorded
+    # opening balance, or (no activity at all) its current balance.
+    opening = (
+        DailyBalanceSnapshot.objects.for_user(user)
+        .order_by('date')
+        .values_list('opening_balance', flat=True)
+        .first()
+    )
+    if opening is not None:
+        return opening
+    profile = UserProfile.objects.for_user(user).only('account_balance', 'balance_slots').first()
+    return profile.balance if profile is not None else None
+
+
+def balance_at(user, moment):
+    """
+    Account balance at the end of a date, or at an exact datetime.
+
+    Needs one snapshot lookup plus, for a datetime, the latest of that day's
+    transactions; the size of the account's history doesn't matter.
+    """
+    if not isinstance(moment, datetime):
+        return _closing_before(user, moment + timedelta(days=1))
+
+    day = ledger_date(moment)
+    latest_today = (
+        Transaction.objects.for_user(user).filter(
+            status='completed',
+            created_at__gte=start_of_day(day), created_at__lte=moment,
+        )
+        .order_by('-created_at', '-id')
+        .values_list('balance_after', flat=True)
+        .first()
+    )
+    if latest_today is not None:
+        return latest_today
+    return _closing_before(user, day)
+
+
+def statement(user, start, end):
+    """Opening/closing balances and per-day activity for ``start``..``end`` inclusive"""
+    days = list(
+        DailyBalanceSnapshot.objects.for_user(user).filter(date__gte=start, date__lte=end)
+        .order_by('date')
+        .values('date', 'opening_balance', 'closing_balance', 'transaction_count')
+    )
+    opening = _closing_before(user, start)
+    closing = days[-1]['closing_balance'] if days else opening
+
+    return {
+        'start': start,
+        'end': end,
+        'opening_balance': opening,
+        'closing_balance': closing,
+        'transaction_count': sum(day['transaction_count'] for day in days),
+        'days': days,
+    }
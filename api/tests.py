@@ -1,3 +1,1932 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from contextvars import copy_context
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.signals import request_finished
+from django.db import connection, transaction, DataError, IntegrityError, OperationalError
+from django.db.transaction import TransactionManagementError
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, RequestFactory, AsyncRequestFactory, modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from . import async_views
+from .accounts import conflict_field, conflict_message
+from .exports import EXPORT_FIELDS
+from .gateway import HKDF_INFO, session_cache
+from .hot_accounts import roll_up, set_balance_slots
+from .idempotency import IdempotencyMiddleware, response_cache
+from .key_ring import MiddlewareKeyRing, key_ring, parse_key
+from .authentication import TokenCache, aresolve_token, resolve_token, token_cache
+from .key_cache import PublicKeyCache, public_key_cache
+from .references import ReferenceGenerator, MAX_SEQUENCE
+from .serializers import TransactionSerializer, MessageSerializer
+from .routers import ReplicaRouter, replica_health
+from .shards import mirror_users, shard_for_user
+from .replay import DjangoCacheReplayCache, MemoryReplayCache, get_replay_cache, replay_digest
+from . import outbox
+from .models import (
+    UserProfile, Transaction, DailyBalanceSnapshot, Message, MiddlewareKey, IdempotencyRecord, OutboxEvent,
+    TransferSaga, BalanceSlot,
+)
+from . import transfers
+from .transfers import (
+    transfer_funds, batch_transfer, credit_reference, InsufficientFunds, InvalidAmount,
+    AccountNotFound, BatchRejected, TransferNotCompleted, TransferPending, INTERNAL_BANK_NAME, BATCH_MODE_ATOMIC,
+    BATCH_MODE_BEST_EFFORT,
+)
+from .signature_middleware import CryptographicSignatureMiddleware
+from .snapshots import balance_at, statement
+from .timing import Histogram, phase_duration, request_duration
+
+
+def make_key_pair():
+    """Return (private_key, base64 DER public key) as stored on UserProfile"""
+    private_key = ec.generate_private_key(ec.SECP384R1())
+    public_der = private_key.public_key().public_bytes(
+        serialization.Encoding.DER,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    return private_key, base64.b64encode(public_der).decode('ascii')
+
+
+def sign_request(private_key, user, method, path, data, timestamp=None):
+    """Build the X-Signature/X-Timestamp headers the way the client does"""
+    if timestamp is None:
+        timestamp = str(int(time.time() * 1000))
+    payload = json.dumps({
+        'method': method,
+        'path': path,
+        'data': data,
+        'timestamp': timestamp,
+        'user_id': str(user.id),
+    }, sort_keys=True, separators=(',', ':'))
+    signature = private_key.sign(payload.encode('utf-8'), ec.ECDSA(hashes.SHA384()))
+    return {
+        'HTTP_X_SIGNATURE': base64.b64encode(signature).decode('ascii'),
+        'HTTP_X_TIMESTAMP': timestamp,
+    }
+
+
+def create_customer(username, account_number, balance='50000.00', **profile_fields):
+    user = User.objects.create_user(username=username, password='password123')
+    profile = UserProfile.objects.create(
+        user=user,
+        account_number=account_number,
+        account_balance=balance,
+        bvn=f'bvn-{account_number}',
+        nin=f'nin-{account_number}',
+        **profile_fields
+    )
+    return user, profile
+
+
+class PublicKeyCacheTests(TestCase):
+    def test_hits_after_first_load(self):
+        cache = PublicKeyCache(max_size=4)
+        _, public_key = make_key_pair()
+
+        first = cache.get(1, public_key)
+        second = cache.get(1, public_key)
+
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_changed_key_is_reloaded(self):
+        cache = PublicKeyCache(max_size=4)
+        _, old_key = make_key_pair()
+        _, new_key = make_key_pair()
+
+        first = cache.get(1, old_key)
+        second = cache.get(1, new_key)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_size_is_bounded(self):
+        cache = PublicKeyCache(max_size=2)
+        _, public_key = make_key_pair()
+
+        for user_id in range(5):
+            cache.get(user_id, public_key)
+
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertEqual(cache.stats()['evictions'], 3)
+
+
+class SignatureMiddlewareTests(TestCase):
+    path = '/api/auth/update-public-key/'
+
+    def setUp(self):
+        public_key_cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = CryptographicSignatureMiddleware(lambda request: HttpResponse('ok'))
+        self.private_key, public_key = make_key_pair()
+        self.user, self.profile = create_customer('alice', '8030000001', public_key=public_key)
+
+    def signed_post(self, data, private_key=None, headers=None):
+        headers = headers or sign_request(private_key or self.private_key, self.user, 'POST', self.path, data)
+        request = self.factory.post(self.path, data=json.dumps(data),
+                                    content_type='application/json', **headers)
+        request.user = self.user
+        return self.middleware(request)
+
+    def test_valid_signature_uses_cached_key(self):
+        self.assertEqual(self.signed_post({'a': 1}).status_code, 200)
+        self.assertEqual(self.signed_post({'a': 2}).status_code, 200)
+        self.assertEqual(public_key_cache.stats()['hits'], 1)
+
+    def test_key_change_invalidates_cache(self):
+        self.assertEqual(self.signed_post({'a': 1}).status_code, 200)
+
+        new_private_key, new_public_key = make_key_pair()
+        self.profile.public_key = new_public_key
+        self.profile.save()
+        public_key_cache.invalidate(self.user.id)
+
+        self.assertEqual(self.signed_post({'a': 1}).status_code, 403)
+        self.assertEqual(self.signed_post({'a': 1}, new_private_key).status_code, 200)
+
+    def test_rotated_key_is_rejected_while_the_token_is_cached(self):
+        token_cache.clear()
+        token = Token.objects.create(user=self.user)
+        resolve_token(token.key)
+        new_private_key, new_public_key = make_key_pair()
+        # Rotated through another worker, so this worker's cached entry stays
+        UserProfile.objects.filter(pk=self.profile.pk).update(public_key=new_public_key)
+
+        for private_key, expected in ((self.private_key, 403), (new_private_key, 200)):
+            self.user, _ = resolve_token(token.key)
+            self.assertEqual(self.signed_post({'a': 1}, private_key).status_code, expected)
+        self.assertEqual(token_cache.stats()['hits'], 2)
+
+    async def test_rotated_key_is_rejected_while_the_token_is_cached_async(self):
+        async def get_response(request):
+            return HttpResponse('ok')
+
+        middleware = CryptographicSignatureMiddleware(get_response)
+        token_cache.clear()
+        token = await Token.objects.acreate(user=self.user)
+        await aresolve_token(token.key)
+        new_private_key, new_public_key = make_key_pair()
+        await UserProfile.objects.filter(pk=self.profile.pk).aupdate(public_key=new_public_key)
+
+        for private_key, expected in ((self.private_key, 403), (new_private_key, 200)):
+            user, _ = await aresolve_token(token.key)
+            data = {'a': 1}
+            request = self.factory.post(self.path, data=json.dumps(data), content_type='application/json',
+                                        **sign_request(private_key, user, 'POST', self.path, data))
+            request.user = user
+            self.assertEqual((await middleware(request)).status_code, expected)
+
+    def test_endpoint_matcher(self):
+        for method, path, expected in (
+            ('POST', '/api/transactions/transfer/', True),
+            ('POST', '/api/transactions/transfer/batch/', True),
+            ('PUT', '/api/cards/3/', True),
+            ('GET', '/api/cards/3/', False),
+            ('POST', '/api/messages/3/read/', False),
+            ('POST', '/prefix/api/cards/', False),
+        ):
+            request = getattr(self.factory, method.lower())(path)
+            self.assertEqual(self.middleware._requires_signature(request), expected, path)
+
+    def test_stale_timestamp_rejected_before_any_lookup(self):
+        stale = str(int((time.time() - 3600) * 1000))
+        headers = sign_request(self.private_key, self.user, 'POST', self.path, {'a': 1}, timestamp=stale)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.signed_post({'a': 1}, headers=headers).status_code, 403)
+
+        headers['HTTP_X_TIMESTAMP'] = 'yesterday'
+        self.assertEqual(self.signed_post({'a': 1}, headers=headers).status_code, 400)
+
+    def test_replay_rejected_before_any_lookup(self):
+        headers = sign_request(self.private_key, self.user, 'POST', self.path, {'a': 1})
+        self.assertEqual(self.signed_post({'a': 1}, headers=headers).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.signed_post({'a': 1}, headers=headers).status_code, 403)
+
+        # The other valid encoding of the same signature is the same request
+        r, s = decode_dss_signature(base64.b64decode(headers['HTTP_X_SIGNATURE']))
+        order = int('FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFC7634D81F4372DDF'
+                    '581A0DB248B0A77AECEC196ACCC52973', 16)
+        headers['HTTP_X_SIGNATURE'] = base64.b64encode(encode_dss_signature(r, order - s)).decode('ascii')
+        self.assertEqual(self.signed_post({'a': 1}, headers=headers).status_code, 403)
+
+    def test_failed_verification_is_not_recorded(self):
+        other_private_key, _ = make_key_pair()
+        headers = sign_request(other_private_key, self.user, 'POST', self.path, {'a': 1})
+        self.signed_post({'a': 1}, headers=headers)
+        digest = replay_digest(self.user.id, headers['HTTP_X_TIMESTAMP'], headers['HTTP_X_SIGNATURE'])
+        self.assertFalse(get_replay_cache().seen(digest, int(headers['HTTP_X_TIMESTAMP']) / 1000))
+
+    async def test_async_path_verifies_off_the_event_loop(self):
+        async def get_response(request):
+            return HttpResponse('ok')
+
+        middleware = CryptographicSignatureMiddleware(get_response)
+        factory = AsyncRequestFactory()
+        data = {'a': 1}
+
+        async def signed_post(private_key):
+            headers = sign_request(private_key, self.user, 'POST', self.path, data)
+            request = factory.post(self.path, data=json.dumps(data), content_type='application/json',
+                                   headers={'X-Signature': headers['HTTP_X_SIGNATURE'],
+                                            'X-Timestamp': headers['HTTP_X_TIMESTAMP']})
+
+            async def auser():
+                return self.user
+            request.auser = auser
+            return await middleware(request)
+
+        self.assertEqual((await signed_post(self.private_key)).status_code, 200)
+        other_private_key, _ = make_key_pair()
+        self.assertEqual((await signed_post(other_private_key)).status_code, 403)
+
+
+class AsyncReadViewTests(TestCase):
+    def setUp(self):
+        self.user, _ = create_customer('async-reader', '8030000300')
+        self.recipient, _ = create_customer('async-recipient', '8030000301')
+        self.recipient.first_name, self.recipient.last_name = 'Bola', 'Ade'
+        self.recipient.save()
+        self.token = Token.objects.create(user=self.user)
+        for n in range(5):
+            Transaction.objects.create(user=self.user, type='credit', amount='1.00',
+                                       reference=f'ASYNC-{n}', balance_after='1.00')
+        Message.objects.create(user=self.user, title='Hi', content='Hello', type='notification')
+        self.factory = AsyncRequestFactory()
+        self.auth = {'Authorization': f'Token {self.token.key}'}
+
+    async def test_list_matches_drf_view(self):
+        for path, view in (('/api/transactions/', async_views.transaction_list),
+                           ('/api/messages/', async_views.message_list)):
+            query = {'page_size': 2}
+            response = await view(self.factory.get(path, query, headers=self.auth))
+            expected = await self.async_client.get(path, query, headers=self.auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, expected.content)
+
+    async def test_detail_is_scoped_to_owner(self):
+        txn = await Transaction.objects.filter(user=self.user).afirst()
+        response = await async_views.transaction_detail(
+            self.factory.get(f'/api/transactions/{txn.pk}/', headers=self.auth), pk=txn.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['reference'], txn.reference)
+
+        other = await Token.objects.acreate(user=self.recipient)
+        response = await async_views.transaction_detail(
+            self.factory.get(f'/api/transactions/{txn.pk}/', headers={'Authorization': f'Token {other.key}'}),
+            pk=txn.pk)
+        self.assertEqual(response.status_code, 404)
+
+    async def test_verify_account(self):
+        response = await async_views.verify_account(
+            self.factory.get('/api/transactions/verify-account/8030000301/', headers=self.auth),
+            account_number='8030000301')
+        self.assertEqual(json.loads(response.content)['name'], 'Bola Ade')
+
+        response = await async_views.verify_account(
+            self.factory.get('/api/transactions/verify-account/0000000000/', headers=self.auth),
+            account_number='0000000000')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_requires_authentication(self):
+        response = await async_views.transaction_list(self.factory.get('/api/transactions/'))
+        self.assertEqual(response.status_code, 401)
+        response = await async_views.transaction_list(
+            self.factory.get('/api/transactions/', headers={'Authorization': 'Token nope'}))
+        self.assertEqual(response.status_code, 401)
+
+    async def test_invalid_cursor(self):
+        response = await async_views.transaction_list(
+            self.factory.get('/api/transactions/', {'cursor': 'not-a-cursor'}, headers=self.auth))
+        self.assertEqual(response.status_code, 404)
+
+
+class ReplayCacheTests(TestCase):
+    def test_memory_buckets_expire_whole(self):
+        cache = MemoryReplayCache(bucket_seconds=10)
+        now = time.time()
+        with self.settings(SIGNATURE_MAX_AGE=60):
+            self.assertTrue(cache.add(b'old', now - 55))
+            self.assertFalse(cache.add(b'old', now - 55))
+            self.assertTrue(cache.add(b'new', now))
+            self.assertTrue(cache.seen(b'old', now - 55))
+
+            with mock.patch('api.replay.time.time', return_value=now + 30):
+                cache.add(b'later', now + 30)
+        self.assertFalse(cache.seen(b'old', now - 55))
+        self.assertTrue(cache.seen(b'new', now))
+
+    def test_django_cache_backend(self):
+        cache = DjangoCacheReplayCache()
+        now = time.time()
+        self.assertFalse(cache.seen(b'digest', now))
+        self.assertTrue(cache.add(b'digest', now))
+        self.assertFalse(cache.add(b'digest', now))
+        self.assertTrue(cache.seen(b'digest', now))
+
+
+class ReferenceGeneratorTests(TestCase):
+    def test_references_increase_and_pair_with_credit_leg(self):
+        generator = ReferenceGenerator(node_id=0xABCDE)
+        references = [generator.next() for _ in range(10000)]
+        self.assertEqual(references, sorted(references))
+        self.assertEqual(len(set(references)), len(references))
+        self.assertRegex(references[0], r'^TRF-[0-9A-F]{11}-00000ABCDE-[0-9A-F]{3}$')
+        self.assertEqual(credit_reference(references[0]), 'CR-' + references[0][4:])
+
+    def test_exhausted_sequence_and_clock_going_back(self):
+        clock = mock.Mock(return_value=1000)
+        generator = ReferenceGenerator(node_id=1, clock=clock)
+        references = [generator.next() for _ in range(MAX_SEQUENCE + 2)]
+        self.assertTrue(references[-1].startswith('TRF-%011X-' % 1001))
+
+        clock.return_value = 500
+        references.append(generator.next())
+        self.assertEqual(references, sorted(references))
+        self.assertEqual(len(set(references)), len(references))
+
+    def test_node_id_from_host_id_includes_pid(self):
+        with self.settings(REFERENCE_HOST_ID=7):
+            reference = ReferenceGenerator().next()
+        node = int(reference.split('-')[2], 16)
+        self.assertEqual(node >> 22, 7)
+
+    @skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_forked_processes_never_collide(self):
+        out = io.StringIO()
+        call_command('bench_references', processes=4, count=1000000, stdout=out)
+        self.assertIn('collisions=0', out.getvalue())
+
+
+class TransferEngineTests(TestCase):
+    def setUp(self):
+        self.sender, self.sender_profile = create_customer('sender', '8030000010', balance='100.00')
+        self.recipient, self.recipient_profile = create_customer('recipient', '8030000020', balance='0.00')
+
+    def transfer(self, amount, account='8030000020', bank=INTERNAL_BANK_NAME):
+        return transfer_funds(self.sender, recipient_account=account,
+                              recipient_bank=bank, amount=amount)
+
+    def test_repeated_transfers_do_not_reapply_deductions(self):
+        self.transfer('10.10')
+        sender_transaction = self.transfer('20.20')
+
+        self.sender_profile.refresh_from_db()
+        self.recipient_profile.refresh_from_db()
+        self.assertEqual(self.sender_profile.account_balance, Decimal('69.70'))
+        self.assertEqual(self.recipient_profile.account_balance, Decimal('30.30'))
+        self.assertEqual(sender_transaction.balance_after, Decimal('69.70'))
+
+        credit_leg = Transaction.objects.get(reference=credit_reference(sender_transaction.reference))
+        self.assertEqual(credit_leg.user, self.recipient)
+        self.assertEqual(credit_leg.balance_after, Decimal('30.30'))
+
+    def test_insufficient_funds_changes_nothing(self):
+        with self.assertRaises(InsufficientFunds):
+            self.transfer('100.01')
+
+        self.sender_profile.refresh_from_db()
+        self.assertEqual(self.sender_profile.account_balance, Decimal('100.00'))
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_exact_balance_can_be_spent(self):
+        self.transfer('100.00')
+        self.sender_profile.refresh_from_db()
+        self.assertEqual(self.sender_profile.account_balance, Decimal('0.00'))
+
+    def test_invalid_amounts_are_rejected(self):
+        for amount in ('abc', '-5', '0', '1.001', 'NaN'):
+            with self.assertRaises(InvalidAmount):
+                self.transfer(amount)
+
+    def test_unknown_internal_recipient(self):
+        with self.assertRaises(AccountNotFound):
+            self.transfer('1.00', account='0000000000')
+
+    def test_external_transfer_only_debits_sender(self):
+        self.transfer('5.00', account='0123456789', bank='Other Bank')
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.recipient_profile.refresh_from_db()
+        self.assertEqual(self.recipient_profile.account_balance, Decimal('0.00'))
+
+    def test_transfer_endpoint(self):
+        private_key, public_key = make_key_pair()
+        UserProfile.objects.filter(pk=self.sender_profile.pk).update(public_key=public_key)
+        path = '/api/transactions/transfer/'
+        data = {'recipient_account': '8030000020', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '12.50'}
+
+        self.client.force_login(self.sender)
+        response = self.client.post(path, data, content_type='application/json',
+                                    **sign_request(private_key, self.sender, 'POST', path, data))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['transaction']['balance_after'], '87.50')
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.sender, _ = create_customer('sender', '8030000700', balance='100.00')
+        self.recipient, _ = create_customer('recipient', '8030000701', balance='0.00')
+
+    def test_transfer_notifies_after_the_outbox_drains(self):
+        sender_transaction = transfer_funds(self.sender, '8030000701', INTERNAL_BANK_NAME, '25.00')
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(OutboxEvent.objects.get().status, 'pending')
+
+        self.assertEqual(outbox.drain(), (1, 0))
+        self.assertEqual(OutboxEvent.objects.get().status, 'done')
+        sent = Message.objects.get(user=self.sender)
+        received = Message.objects.get(user=self.recipient)
+        self.assertIn(sender_transaction.reference, sent.content)
+        self.assertIn('Balance: NGN 75.00', sent.content)
+        self.assertIn('Balance: NGN 25.00', received.content)
+        self.assertEqual(outbox.drain(), (0, 0))
+
+    def test_rolled_back_transfer_emits_nothing(self):
+        with self.assertRaises(InsufficientFunds):
+            transfer_funds(self.sender, '8030000701', INTERNAL_BANK_NAME, '500.00')
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_batch_emits_one_event_per_transfer(self):
+        item = {'recipient_account': '8030000701', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '1.00'}
+        external = {'recipient_account': '0123456789', 'recipient_bank': 'Other Bank', 'amount': '2.00'}
+        batch_transfer(self.sender, [item, external])
+        self.assertEqual(outbox.drain(), (2, 0))
+        self.assertEqual(Message.objects.filter(user=self.sender).count(), 2)
+        self.assertEqual(Message.objects.filter(user=self.recipient).count(), 1)
+
+    def test_failures_back_off_then_give_up(self):
+        def fail(payload):
+            Message.objects.create(user=self.sender, title='half', content='', type='alert')
+            raise RuntimeError('webhook down')
+
+        with mock.patch.dict(outbox._handlers, {'test.fail': [fail]}), \
+                self.settings(OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_DELAY=60):
+            event = outbox.emit('test.fail', {})
+            self.assertEqual(outbox.drain(), (0, 1))
+            event.refresh_from_db()
+            self.assertEqual((event.status, event.attempts), ('pending', 1))
+            self.assertIn('webhook down', event.last_error)
+            self.assertGreater(event.available_at, timezone.now() + timedelta(seconds=25))
+            # Nothing is due until the backoff has passed
+            self.assertEqual(outbox.drain(), (0, 0))
+
+            OutboxEvent.objects.filter(pk=event.pk).update(available_at=timezone.now())
+            self.assertEqual(outbox.drain(), (0, 1))
+            event.refresh_from_db()
+            self.assertEqual((event.status, event.attempts), ('failed', 2))
+        # The handler's writes were rolled back with each failed attempt
+        self.assertFalse(Message.objects.exists())
+
+    def test_claimed_events_are_leased(self):
+        outbox.emit('transfer.completed', {})
+        self.assertEqual(len(outbox.claim(10)), 1)
+        self.assertEqual(outbox.claim(10), [])
+
+
+class BatchTransferTests(TestCase):
+    def setUp(self):
+        self.sender, self.sender_profile = create_customer('payroll', '8030000100', balance='100.00')
+        self.alice, self.alice_profile = create_customer('alice', '8030000101', balance='0.00')
+        self.bob, self.bob_profile = create_customer('bob', '8030000102', balance='10.00')
+
+    def item(self, account, amount, bank=INTERNAL_BANK_NAME):
+        return {'recipient_account': account, 'recipient_bank': bank, 'amount': amount}
+
+    def balances(self):
+        return [
+            UserProfile.objects.get(pk=p.pk).account_balance
+            for p in (self.sender_profile, self.alice_profile, self.bob_profile)
+        ]
+
+    def test_atomic_batch_applies_every_leg(self):
+        results = batch_transfer(self.sender, [
+            self.item('8030000101', '10.00'),
+            self.item('8030000102', '20.00'),
+            self.item('8030000101', '5.00'),
+            self.item('0123456789', '1.00', bank='Other Bank'),
+        ], mode=BATCH_MODE_ATOMIC)
+
+        self.assertEqual([r['status'] for r in results], ['completed'] * 4)
+        self.assertEqual([r['balance_after'] for r in results], ['90.00', '70.00', '65.00', '64.00'])
+        self.assertEqual(self.balances(), [Decimal('64.00'), Decimal('15.00'), Decimal('30.00')])
+
+        alice_credits = Transaction.objects.filter(user=self.alice).order_by('id')
+        self.assertEqual([t.balance_after for t in alice_credits], [Decimal('10.00'), Decimal('15.00')])
+        self.assertEqual(Transaction.objects.count(), 7)
+
+    def test_atomic_batch_rejects_everything_on_one_bad_item(self):
+        with self.assertRaises(BatchRejected) as ctx:
+            batch_transfer(self.sender, [
+                self.item('8030000101', '10.00'),
+                self.item('0000000000', '10.00'),
+            ], mode=BATCH_MODE_ATOMIC)
+
+        self.assertEqual([r['status'] for r in ctx.exception.results], ['skipped', 'failed'])
+        self.assertEqual(self.balances(), [Decimal('100.00'), Decimal('0.00'), Decimal('10.00')])
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_atomic_batch_rejects_when_total_exceeds_balance(self):
+        with self.assertRaises(BatchRejected):
+            batch_transfer(self.sender, [
+                self.item('8030000101', '60.00'),
+                self.item('8030000102', '60.00'),
+            ], mode=BATCH_MODE_ATOMIC)
+
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_best_effort_batch_skips_failures(self):
+        results = batch_transfer(self.sender, [
+            self.item('8030000101', '60.00'),
+            self.item('0000000000', '1.00'),
+            self.item('8030000102', '60.00'),
+            self.item('8030000102', 'abc'),
+            self.item('8030000102', '40.00'),
+        ], mode=BATCH_MODE_BEST_EFFORT)
+
+        self.assertEqual(
+            [r['status'] for r in results],
+            ['completed', 'failed', 'failed', 'failed', 'completed']
+        )
+        self.assertEqual(results[2]['error'], 'Insufficient funds')
+        self.assertEqual(self.balances(), [Decimal('0.00'), Decimal('60.00'), Decimal('50.00')])
+
+    def test_batch_endpoint(self):
+        private_key, public_key = make_key_pair()
+        UserProfile.objects.filter(pk=self.sender_profile.pk).update(public_key=public_key)
+        path = '/api/transactions/transfer/batch/'
+        data = {'mode': 'best_effort', 'transfers': [
+            self.item('8030000101', '30.00'),
+            self.item('8030000102', '80.00'),
+        ]}
+
+        self.client.force_login(self.sender)
+        response = self.client.post(path, data, content_type='application/json',
+                                    **sign_request(private_key, self.sender, 'POST', path, data))
+
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual((body['completed'], body['failed'], body['total_amount']), (1, 1, '30.00'))
+
+    def test_signed_body_is_parsed_once(self):
+        private_key, public_key = make_key_pair()
+        UserProfile.objects.filter(pk=self.sender_profile.pk).update(public_key=public_key)
+        path = '/api/transactions/transfer/batch/'
+        data = {'transfers': [self.item('8030000101', '30.00')]}
+
+        self.client.force_login(self.sender)
+        with mock.patch.object(JSONParser, 'parse', side_effect=AssertionError('parsed twice')):
+            response = self.client.post(path, data, content_type='application/json',
+                                        **sign_request(private_key, self.sender, 'POST', path, data))
+        self.assertEqual(response.status_code, 201)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plan assertions are written for SQLite')
+class QueryPlanTests(TestCase):
+    """The hot list queries must be answered from an index, without a sort step"""
+
+    def assertIndexedWithoutSort(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan, plan)
+        self.assertNotIn('TEMP B-TREE', plan, plan)
+
+    def test_transaction_history(self):
+        self.assertIndexedWithoutSort(
+            Transaction.objects.filter(user_id=1).order_by('-created_at'),
+            'api_txn_user_created_idx'
+        )
+        self.assertIndexedWithoutSort(
+            Transaction.objects.filter(user_id=1).order_by('-created_at', '-id'),
+            'api_txn_user_created_idx'
+        )
+
+    def test_message_inbox(self):
+        self.assertIndexedWithoutSort(
+            Message.objects.filter(user_id=1).order_by('-created_at'),
+            'api_msg_user_created_idx'
+        )
+
+    def test_unread_messages(self):
+        plan = Message.objects.filter(user_id=1, read=False).order_by('-created_at').explain()
+        self.assertIn('USING INDEX api_msg_user_', plan, plan)
+        self.assertNotIn('TEMP B-TREE', plan, plan)
+
+    def test_transaction_lookups(self):
+        self.assertIndexedWithoutSort(
+            Transaction.objects.filter(recipient_account='8030000001'),
+            'api_txn_recipient_acct_idx'
+        )
+        self.assertIndexedWithoutSort(
+            Transaction.objects.filter(status='pending'),
+            'api_txn_status_idx'
+        )
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user, _ = create_customer('reader', '8030000200')
+        other, _ = create_customer('other', '8030000201')
+        Transaction.objects.bulk_create([
+            Transaction(user=owner, type='credit', amount='1.00', reference=f'REF-{owner.pk}-{n}',
+                        balance_after='1.00')
+            for owner in (self.user, other) for n in range(7)
+        ])
+        # Force timestamp ties so the id tie-break is exercised
+        Transaction.objects.filter(reference__in=['REF-%d-2' % self.user.pk, 'REF-%d-3' % self.user.pk]).update(
+            created_at=Transaction.objects.get(reference=f'REF-{self.user.pk}-4').created_at
+        )
+        self.expected = list(
+            Transaction.objects.filter(user=self.user).order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        self.client.force_login(self.user)
+
+    def ids(self, response):
+        return [row['id'] for row in response.json()['results']]
+
+    def test_walks_forward_and_back_without_gaps(self):
+        first = self.client.get('/api/transactions/', {'page_size': 3})
+        self.assertIsNone(first.json()['previous'])
+
+        seen = self.ids(first)
+        next_url = first.json()['next']
+        pages = [first]
+        while next_url:
+            page = self.client.get(next_url)
+            pages.append(page)
+            seen += self.ids(page)
+            next_url = page.json()['next']
+
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(len(pages), 3)
+
+        back = self.client.get(pages[2].json()['previous'])
+        self.assertEqual(self.ids(back), self.ids(pages[1]))
+        back = self.client.get(back.json()['previous'])
+        self.assertEqual(self.ids(back), self.ids(pages[0]))
+        self.assertIsNone(back.json()['previous'])
+
+    def test_page_size_is_capped(self):
+        with self.settings(API_MAX_PAGE_SIZE=2):
+            response = self.client.get('/api/transactions/', {'page_size': 100})
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/transactions/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_messages_are_paginated(self):
+        Message.objects.create(user=self.user, title='Hi', content='Hello', type='notification')
+        response = self.client.get('/api/messages/')
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertIsNone(response.json()['next'])
+
+
+class RowSerializerTests(TestCase):
+    def setUp(self):
+        self.user, _ = create_customer('reader', '8030000300')
+        Transaction.objects.bulk_create([
+            Transaction(user=self.user, type='debit', amount=amount, reference=f'ROW-{n}',
+                        balance_after=Decimal('1234567.8'), description='caf\u00e9 \u20a6', category='')
+            for n, amount in enumerate(['0.00', '0.5', '10', '9999999999.99', '-3.10'])
+        ])
+        Message.objects.create(user=self.user, title='Hi', content='Hello', type='alert', read=True)
+        Message.objects.create(user=self.user, title='Yo', content='World', type='notification')
+        self.client.force_login(self.user)
+
+    def assertSameAsModelSerializer(self, url, model, serializer_class):
+        response = self.client.get(url)
+        instances = list(model.objects.filter(user=self.user).order_by('-created_at', '-id'))
+        expected = JSONRenderer().render({
+            'next': None,
+            'previous': None,
+            'results': serializer_class(instances, many=True).data,
+        })
+        self.assertEqual(response.content, expected)
+
+    def test_lists_match_model_serializers_byte_for_byte(self):
+        for time_zone in ('UTC', 'Africa/Lagos'):
+            with self.subTest(time_zone=time_zone), self.settings(TIME_ZONE=time_zone):
+                self.assertSameAsModelSerializer('/api/transactions/', Transaction, TransactionSerializer)
+                self.assertSameAsModelSerializer('/api/messages/', Message, MessageSerializer)
+
+    def test_benchmark_checks_output_is_identical(self):
+        out = io.StringIO()
+        call_command('bench_serializers', rows=20, repeats=2, stdout=out)
+        self.assertIn('identical output', out.getvalue())
+        self.assertFalse(User.objects.filter(username__endswith='-serializers').exists())
+
+
+class TransactionExportTests(TestCase):
+    def setUp(self):
+        self.user, _ = create_customer('exporter', '8030000300')
+        other, _ = create_customer('someone', '8030000301')
+        for owner, reference, day in ((self.user, 'EXP-1', 1), (self.user, 'EXP-2', 5), (other, 'EXP-3', 5)):
+            txn = Transaction.objects.create(user=owner, type='credit', amount='10.50',
+                                             reference=reference, balance_after='10.50')
+            Transaction.objects.filter(pk=txn.pk).update(
+                created_at=datetime(2025, 3, day, 12, 0, tzinfo=dt_timezone.utc)
+            )
+        self.client.force_login(self.user)
+
+    def content(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_csv_export(self):
+        response = self.client.get('/api/transactions/export/')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(rows[0], list(EXPORT_FIELDS))
+        self.assertEqual([row[EXPORT_FIELDS.index('reference')] for row in rows[1:]], ['EXP-1', 'EXP-2'])
+        self.assertEqual(rows[1][EXPORT_FIELDS.index('amount')], '10.50')
+        self.assertEqual(rows[1][EXPORT_FIELDS.index('created_at')], '2025-03-01T12:00:00Z')
+
+    def test_ndjson_export_with_date_range(self):
+        response = self.client.get('/api/transactions/export/',
+                                   {'output': 'ndjson', 'start': '2025-03-02', 'end': '2025-03-05'})
+        lines = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([line['reference'] for line in lines], ['EXP-2'])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/transactions/export/', {'output': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/transactions/export/', {'start': 'yesterday'}).status_code, 400)
+
+
+class BalanceSnapshotTests(TestCase):
+    def setUp(self):
+        self.sender, self.sender_profile = create_customer('saver', '8030000400', balance='100.00')
+        self.recipient, _ = create_customer('payee', '8030000401', balance='0.00')
+
+    def transfer_on(self, day, amount):
+        moment = datetime(2025, 4, day, 9, 30, tzinfo=dt_timezone.utc)
+        with mock.patch('django.utils.timezone.now', return_value=moment):
+            transfer_funds(self.sender, recipient_account='8030000401',
+                           recipient_bank=INTERNAL_BANK_NAME, amount=amount)
+
+    def test_snapshots_follow_transfers(self):
+        self.transfer_on(1, '10.00')
+        self.transfer_on(1, '5.00')
+        self.transfer_on(3, '20.00')
+
+        snapshots = list(DailyBalanceSnapshot.objects.filter(user=self.sender).order_by('date').values_list(
+            'date', 'opening_balance', 'closing_balance', 'transaction_count'))
+        self.assertEqual(snapshots, [
+            (date(2025, 4, 1), Decimal('100.00'), Decimal('85.00'), 2),
+            (date(2025, 4, 3), Decimal('85.00'), Decimal('65.00'), 1),
+        ])
+        recipient_day = DailyBalanceSnapshot.objects.get(user=self.recipient, date=date(2025, 4, 1))
+        self.assertEqual((recipient_day.opening_balance, recipient_day.closing_balance),
+                         (Decimal('0.00'), Decimal('15.00')))
+
+    def test_balance_at_and_statement(self):
+        self.transfer_on(1, '10.00')
+        self.transfer_on(3, '20.00')
+
+        self.assertEqual(balance_at(self.sender, date(2025, 3, 31)), Decimal('100.00'))
+        self.assertEqual(balance_at(self.sender, date(2025, 4, 2)), Decimal('90.00'))
+        self.assertEqual(balance_at(self.sender, datetime(2025, 4, 3, 8, 0, tzinfo=dt_timezone.utc)),
+                         Decimal('90.00'))
+        self.assertEqual(balance_at(self.sender, datetime(2025, 4, 3, 10, 0, tzinfo=dt_timezone.utc)),
+                         Decimal('70.00'))
+
+        summary = statement(self.sender, date(2025, 4, 2), date(2025, 4, 30))
+        self.assertEqual((summary['opening_balance'], summary['closing_balance']),
+                         (Decimal('90.00'), Decimal('70.00')))
+        self.assertEqual(summary['transaction_count'], 1)
+
+    def test_backfill_rebuilds_snapshots(self):
+        self.transfer_on(1, '10.00')
+        self.transfer_on(2, '5.00')
+        expected = list(DailyBalanceSnapshot.objects.order_by('user_id', 'date').values_list(
+            'user_id', 'date', 'opening_balance', 'closing_balance', 'transaction_count'))
+        DailyBalanceSnapshot.objects.all().delete()
+
+        call_command('backfill_balance_snapshots', chunk_size=1, stdout=io.StringIO())
+
+        self.assertEqual(list(DailyBalanceSnapshot.objects.order_by('user_id', 'date').values_list(
+            'user_id', 'date', 'opening_balance', 'closing_balance', 'transaction_count')), expected)
+
+    def test_statement_endpoint(self):
+        self.transfer_on(1, '10.00')
+        self.client.force_login(self.sender)
+
+        response = self.client.get('/api/transactions/statement/', {'start': '2025-04-01', 'end': '2025-04-30'})
+        self.assertEqual(response.json()['closing_balance'], '90.00')
+        response = self.client.get('/api/transactions/balance/', {'at': '2025-04-01'})
+        self.assertEqual(response.json()['balance'], '90.00')
+        self.assertEqual(self.client.get('/api/transactions/statement/').status_code, 400)
+
+
+class HotAccountTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.merchant, self.merchant_profile = create_customer('merchant', '8030000900', balance='0.00')
+        self.payer, self.payer_profile = create_customer('payer', '8030000901', balance='100.00')
+        set_balance_slots(self.merchant_profile, 4)
+
+    def pay(self, amount, account='8030000900'):
+        return transfer_funds(self.payer, account, INTERNAL_BANK_NAME, amount)
+
+    def merchant_balance(self):
+        return UserProfile.objects.get(pk=self.merchant_profile.pk).account_balance
+
+    def test_credits_land_in_slots(self):
+        self.pay('10.00')
+        sender_transaction = self.pay('5.00')
+
+        self.assertEqual(self.merchant_balance(), Decimal('0.00'))
+        self.assertEqual(BalanceSlot.objects.filter(profile=self.merchant_profile).count(), 4)
+        self.assertEqual(sum(slot.amount for slot in self.merchant_profile.slots.all()), Decimal('15.00'))
+        self.assertEqual(sum(slot.credits for slot in self.merchant_profile.slots.all()), 2)
+        self.assertEqual(UserProfile.objects.get(pk=self.merchant_profile.pk).balance, Decimal('15.00'))
+        credit_leg = Transaction.objects.get(reference=credit_reference(sender_transaction.reference))
+        self.assertEqual(credit_leg.balance_after, Decimal('15.00'))
+
+        token = Token.objects.create(user=self.merchant)
+        response = self.client.get('/api/profiles/', HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.json()[0]['account_balance'], '15.00')
+
+    def test_a_credit_changes_the_profile_etag(self):
+        token = Token.objects.create(user=self.merchant)
+        auth = {'HTTP_AUTHORIZATION': f'Token {token.key}'}
+        first = self.client.get('/api/profiles/', **auth)
+        self.pay('1.00')
+        self.assertEqual(self.client.get('/api/profiles/', HTTP_IF_NONE_MATCH=first['ETag'], **auth).status_code, 200)
+
+    def test_roll_up_folds_slots_into_balance_and_snapshot(self):
+        self.pay('10.00')
+        self.pay('5.00')
+        self.assertFalse(DailyBalanceSnapshot.objects.filter(user=self.merchant).exists())
+
+        call_command('roll_up_balances', '--once', stdout=io.StringIO())
+
+        self.assertEqual(self.merchant_balance(), Decimal('15.00'))
+        self.assertFalse(self.merchant_profile.slots.exclude(amount=0).exists())
+        snapshot = DailyBalanceSnapshot.objects.get(user=self.merchant)
+        self.assertEqual((snapshot.opening_balance, snapshot.closing_balance, snapshot.transaction_count),
+                         (Decimal('0.00'), Decimal('15.00'), 2))
+        self.assertEqual(roll_up(self.merchant_profile.pk), 0)
+
+    def test_debits_spend_rolled_up_money_only(self):
+        self.pay('10.00')
+        with self.assertRaises(InsufficientFunds):
+            transfer_funds(self.merchant, '8030000901', INTERNAL_BANK_NAME, '10.00')
+        roll_up(self.merchant_profile.pk)
+        transfer_funds(self.merchant, '8030000901', INTERNAL_BANK_NAME, '10.00')
+        self.assertEqual(self.merchant_balance(), Decimal('0.00'))
+
+    def test_fewer_slots_keep_every_credit(self):
+        self.pay('10.00')
+        set_balance_slots(self.merchant_profile, 1)
+        self.assertEqual(self.merchant_balance(), Decimal('10.00'))
+        self.assertEqual(self.merchant_profile.slots.count(), 1)
+
+        # A transfer that read the old slot count credits the balance when its slot is gone
+        with mock.patch('api.hot_accounts.random.randrange', return_value=3):
+            self.pay('5.00')
+        self.assertEqual(self.merchant_balance(), Decimal('15.00'))
+
+        set_balance_slots(self.merchant_profile, 0)
+        self.pay('1.00')
+        self.assertEqual(self.merchant_balance(), Decimal('16.00'))
+        self.assertFalse(self.merchant_profile.slots.exists())
+
+    def test_stopping_slots_folds_credits_that_land_during_the_roll_up(self):
+        self.pay('10.00')
+        real_roll_up = roll_up
+
+        def credit_after_first_roll_up(profile_id, using=None):
+            count = real_roll_up(profile_id, using=using)
+            if credit_after_first_roll_up.late_credit:
+                credit_after_first_roll_up.late_credit = False
+                BalanceSlot.objects.filter(profile_id=profile_id, slot=3).update(amount=Decimal('5.00'), credits=1)
+            return count
+        credit_after_first_roll_up.late_credit = True
+
+        with mock.patch('api.hot_accounts.roll_up', side_effect=credit_after_first_roll_up):
+            set_balance_slots(self.merchant_profile, 0)
+        self.assertFalse(self.merchant_profile.slots.exists())
+        profile = UserProfile.objects.get(pk=self.merchant_profile.pk)
+        self.assertEqual((profile.account_balance, profile.balance), (Decimal('15.00'), Decimal('15.00')))
+
+    def test_batch_credits_hot_accounts_through_slots(self):
+        results = batch_transfer(self.payer, [
+            {'recipient_account': '8030000900', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '10.00'},
+            {'recipient_account': '8030000900', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '5.00'},
+        ], mode=BATCH_MODE_ATOMIC)
+
+        self.assertEqual([r['balance_after'] for r in results], ['90.00', '85.00'])
+        self.assertEqual(self.merchant_balance(), Decimal('0.00'))
+        credits = Transaction.objects.filter(user=self.merchant).order_by('id')
+        self.assertEqual([t.balance_after for t in credits], [Decimal('10.00'), Decimal('15.00')])
+        roll_up(self.merchant_profile.pk)
+        self.assertEqual(self.merchant_balance(), Decimal('15.00'))
+        self.assertEqual(DailyBalanceSnapshot.objects.get(user=self.merchant).transaction_count, 2)
+
+
+class SecureGatewayTests(TestCase):
+    path = '/api/secure/gateway/'
+
+    def setUp(self):
+        key_ring.reset()
+        session_cache.clear()
+        self.user, _ = create_customer('gateway', '8030000400')
+        self.token = Token.objects.create(user=self.user)
+        create_customer('gateway-payee', '8030000401')
+
+    def handshake_key(self, ecdh_public_pem=None):
+        """Return (ephemeral public key b64, AESGCM) the way the client derives them"""
+        if ecdh_public_pem is None:
+            ecdh_public_pem = self.client.get('/api/middleware/public-key/').json()['ecdh_public_key']
+        server_key = serialization.load_pem_public_key(ecdh_public_pem.encode('ascii'))
+        ephemeral = ec.generate_private_key(ec.SECP384R1())
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=HKDF_INFO).derive(
+            ephemeral.exchange(ec.ECDH(), server_key)
+        )
+        public_der = ephemeral.public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return base64.b64encode(public_der).decode('ascii'), AESGCM(key)
+
+    def send(self, cipher, inner, **envelope):
+        iv = b'\x01' * 12
+        envelope['iv'] = base64.b64encode(iv).decode('ascii')
+        envelope['ciphertext'] = base64.b64encode(
+            cipher.encrypt(iv, json.dumps(inner).encode('utf-8'), None)
+        ).decode('ascii')
+        response = self.client.post(self.path, envelope, content_type='application/json')
+        if response.status_code != 200:
+            return response, None
+        reply = response.json()
+        signature = base64.b64decode(reply['signature'])
+        iv, ciphertext = base64.b64decode(reply['iv']), base64.b64decode(reply['ciphertext'])
+        key_ring.get(reply['key_id']).ecdsa_private_key.public_key().verify(
+            signature, iv + ciphertext, ec.ECDSA(hashes.SHA384())
+        )
+        return response, json.loads(cipher.decrypt(iv, ciphertext, None))
+
+    def verify_account(self):
+        return {
+            'method': 'GET',
+            'path': '/api/transactions/verify-account/8030000401/',
+            'headers': {'Authorization': f'Token {self.token.key}'},
+        }
+
+    def test_session_key_is_reused(self):
+        ephemeral, cipher = self.handshake_key()
+        response, reply = self.send(cipher, self.verify_account(), ephemeral_public_key=ephemeral)
+        self.assertEqual(reply['status'], 200)
+        self.assertTrue(reply['body']['exists'])
+
+        session_id = response.json()['session_id']
+        with mock.patch('api.gateway.derive_session_key') as derive:
+            response, reply = self.send(cipher, self.verify_account(), session_id=session_id)
+        derive.assert_not_called()
+        self.assertEqual(reply['status'], 200)
+        self.assertEqual(response.json()['session_id'], session_id)
+
+    def test_expired_session_needs_new_handshake(self):
+        ephemeral, cipher = self.handshake_key()
+        response, _ = self.send(cipher, self.verify_account(), ephemeral_public_key=ephemeral)
+        session_id = response.json()['session_id']
+
+        with mock.patch('api.lru.time.monotonic', return_value=10 ** 9):
+            response, _ = self.send(cipher, self.verify_account(), session_id=session_id)
+        self.assertEqual(response.status_code, 401)
+
+    def test_middleware_key_is_loaded_once(self):
+        key_ring.current()
+        with self.assertNumQueries(0):
+            keys = key_ring.current()
+        self.assertEqual(MiddlewareKey.objects.get().key_id, keys.key_id)
+
+    def test_retiring_key_still_accepted_after_rotation(self):
+        old = self.client.get('/api/middleware/public-key/').json()
+        call_command('rotate_middleware_keys', stdout=io.StringIO())
+        key_ring.refresh(force=True)
+
+        keys = self.client.get('/api/middleware/public-key/').json()
+        self.assertNotEqual(keys['key_id'], old['key_id'])
+        self.assertEqual(len(keys['keys']), 2)
+
+        ephemeral, cipher = self.handshake_key(old['ecdh_public_key'])
+        response, reply = self.send(cipher, self.verify_account(),
+                                    ephemeral_public_key=ephemeral, key_id=old['key_id'])
+        self.assertEqual(reply['status'], 200)
+        self.assertEqual(response.json()['key_id'], old['key_id'])
+
+        now = timezone.now()
+        MiddlewareKey.objects.filter(key_id=old['key_id']).update(expires_at=now, updated_at=now)
+        key_ring.refresh(force=True)
+        ephemeral, cipher = self.handshake_key(old['ecdh_public_key'])
+        response, _ = self.send(cipher, self.verify_account(),
+                                ephemeral_public_key=ephemeral, key_id=old['key_id'])
+        self.assertEqual(response.status_code, 400)
+
+    def test_forwarded_requests_still_need_signatures(self):
+        ephemeral, cipher = self.handshake_key()
+        _, reply = self.send(cipher, {
+            'method': 'POST',
+            'path': '/api/transactions/transfer/',
+            'data': {'recipient_account': '8030000401', 'amount': '10.00'},
+            'headers': {'Authorization': f'Token {self.token.key}'},
+        }, ephemeral_public_key=ephemeral)
+        self.assertIn(reply['status'], (400, 401))
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_forwarding_does_not_finish_the_outer_request(self):
+        ephemeral, cipher = self.handshake_key()
+        finished = []
+
+        def count(**kwargs):
+            finished.append(kwargs)
+
+        # request_finished closes the database connections the outer view is using
+        request_finished.connect(count)
+        self.addCleanup(request_finished.disconnect, count)
+        _, reply = self.send(cipher, self.verify_account(), ephemeral_public_key=ephemeral)
+        self.assertEqual(reply['status'], 200)
+        self.assertEqual(len(finished), 1)
+
+    def test_tampered_ciphertext_is_rejected(self):
+        ephemeral, _ = self.handshake_key()
+        _, wrong_cipher = self.handshake_key()
+        response, _ = self.send(wrong_cipher, self.verify_account(), ephemeral_public_key=ephemeral)
+        self.assertEqual(response.status_code, 400)
+
+
+class MiddlewareKeyRingTests(TestCase):
+    def test_polls_version_stamp_instead_of_reloading(self):
+        ring = MiddlewareKeyRing(poll_interval=60)
+        first = ring.current()
+
+        call_command('rotate_middleware_keys', stdout=io.StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(ring.current().key_id, first.key_id)
+
+        with mock.patch('api.key_ring.parse_key', wraps=parse_key) as parse:
+            ring.refresh(force=True)
+        self.assertEqual(parse.call_count, 2)  # the new key and the retired one, not all rows
+        self.assertNotEqual(ring.current().key_id, first.key_id)
+        self.assertIsNotNone(ring.get(first.key_id))
+
+        # Unchanged table: one stamp query, nothing parsed
+        with self.assertNumQueries(1), mock.patch('api.key_ring.parse_key') as parse:
+            ring.refresh(force=True)
+        parse.assert_not_called()
+
+    def test_only_changed_keys_are_parsed(self):
+        ring = MiddlewareKeyRing(poll_interval=60)
+        ring.current()
+        call_command('rotate_middleware_keys', stdout=io.StringIO())
+        ring.refresh(force=True)
+        call_command('rotate_middleware_keys', stdout=io.StringIO())
+
+        with mock.patch('api.key_ring.parse_key', wraps=parse_key) as parse:
+            ring.refresh(force=True)
+        parsed = {call.args[0].key_id for call in parse.call_args_list}
+        self.assertEqual(len(parsed), 2)
+        self.assertEqual(len(ring.valid_keys()), 3)
+
+
+class EndpointQueryCountTests(TestCase):
+    """With a warm token cache, authentication and profile lookups cost no queries"""
+
+    def setUp(self):
+        token_cache.clear()
+        public_key_cache.clear()
+        self.private_key, public_key = make_key_pair()
+        self.user, self.profile = create_customer('counted', '8030000500', public_key=public_key)
+        create_customer('counted-payee', '8030000501')
+        transfer_funds(self.user, '8030000501', INTERNAL_BANK_NAME, '1.00')
+        self.transaction = Transaction.objects.filter(user=self.user).first()
+        self.message = Message.objects.create(user=self.user, title='Hi', content='Hello', type='notification')
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def get(self, path, params=None):
+        return self.client.get(path, params, **self.auth)
+
+    def post(self, path, data=None, signed=False):
+        headers = dict(self.auth)
+        if signed:
+            headers.update(sign_request(self.private_key, self.user, 'POST', path, data))
+        return self.client.post(path, data, content_type='application/json', **headers)
+
+    def assertQueries(self, count, call, status=200):
+        self.get('/api/cards/')  # warm the token cache
+        with self.assertNumQueries(count):
+            response = call()
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status)
+
+    def test_cold_token_costs_one_query(self):
+        with self.assertNumQueries(2):  # token + user + profile join, then the cards
+            self.get('/api/cards/')
+        with self.assertNumQueries(1):
+            self.get('/api/cards/')
+
+    def test_read_endpoints(self):
+        for count, call in (
+            # Lists add the conditional GET aggregate
+            (2, lambda: self.get('/api/profiles/')),
+            (2, lambda: self.get('/api/transactions/')),
+            (1, lambda: self.get(f'/api/transactions/{self.transaction.pk}/')),
+            (1, lambda: self.get('/api/transactions/verify-account/8030000501/')),
+            (3, lambda: self.get('/api/transactions/statement/', {'start': '2020-01-01', 'end': '2099-01-01'})),
+            (1, lambda: self.get('/api/transactions/balance/', {'at': '2099-01-01'})),
+            (1, lambda: self.get('/api/transactions/export/')),
+            (2, lambda: self.get('/api/messages/')),
+            (1, lambda: self.get('/api/cards/')),
+        ):
+            with self.subTest(call=call):
+                self.assertQueries(count, call)
+
+    def test_write_endpoints(self):
+        _, new_public_key = make_key_pair()
+        transfer = {'recipient_account': '8030000501', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '1.00'}
+        self.assertQueries(2, lambda: self.post(f'/api/messages/{self.message.pk}/read/'))
+        # update + fresh balance and public key for the response
+        self.assertQueries(3, lambda: self.post('/api/auth/set-pin/'))
+        # signing key, recipient lookup, lock, debit, credit, balances, 2 inserts, 2 snapshots, outbox,
+        # savepoint pair
+        self.assertQueries(13, lambda: self.post('/api/transactions/transfer/', transfer, signed=True), status=201)
+        self.assertQueries(13, lambda: self.post('/api/transactions/transfer/batch/',
+                                                 {'transfers': [transfer, transfer]}, signed=True), status=201)
+        # signing key, update, fresh balance for the response
+        self.assertQueries(3, lambda: self.post('/api/auth/update-public-key/',
+                                                {'public_key': new_public_key}, signed=True))
+        self.assertQueries(1, lambda: self.post('/api/auth/logout/'))
+
+    def test_logout_purges_cached_token(self):
+        self.assertEqual(self.get('/api/cards/').status_code, 200)
+        self.assertEqual(self.post('/api/auth/logout/').status_code, 200)
+        self.assertEqual(self.get('/api/cards/').status_code, 401)
+
+    def test_logout_in_another_worker_revokes_the_cached_token(self):
+        self.assertEqual(self.get('/api/cards/').status_code, 200)
+        other_worker = TokenCache()
+        with mock.patch('api.views.token_cache', other_worker), mock.patch('api.authentication.token_cache', other_worker):
+            self.assertEqual(self.post('/api/auth/logout/').status_code, 200)
+        # This worker's entry is still warm, but the shared generation moved on
+        self.assertEqual(token_cache.stats()['size'], 1)
+        self.assertEqual(self.get('/api/cards/').status_code, 401)
+
+    def test_deactivating_the_user_elsewhere_revokes_the_cached_token(self):
+        self.assertEqual(self.get('/api/cards/').status_code, 200)
+        with mock.patch('api.authentication.token_cache', TokenCache()):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.get('/api/cards/').status_code, 401)
+
+    async def test_async_lookup_honours_a_revocation_from_another_worker(self):
+        await aresolve_token(self.token.key)
+        with mock.patch('api.authentication.token_cache', TokenCache()):
+            await self.token.adelete()
+        with self.assertRaises(AuthenticationFailed):
+            await aresolve_token(self.token.key)
+
+    def test_cached_profile_never_serves_a_stale_balance(self):
+        self.get('/api/cards/')
+        UserProfile.objects.filter(pk=self.profile.pk).update(account_balance='12.34')
+        # set-pin answers with the cached profile
+        response = self.post('/api/auth/set-pin/')
+        self.assertEqual(response.json()['profile']['account_balance'], '12.34')
+
+
+class RegistrationTests(TestCase):
+    url = '/api/auth/register/'
+
+    def setUp(self):
+        self.existing, _ = create_customer('taken', '8011111111', phone='08011111111')
+        self.existing.email = 'taken@example.com'
+        self.existing.save()
+
+    def register(self, **overrides):
+        data = {
+            'username': 'newcomer',
+            'email': 'newcomer@example.com',
+            'password': 'password123',
+            'phone': '08022222222',
+            'bvn': 'bvn-new',
+            'nin': 'nin-new',
+        }
+        data.update(overrides)
+        return self.client.post(self.url, data, content_type='application/json')
+
+    def test_registers_customer_with_profile_and_token(self):
+        response = self.register()
+        self.assertEqual(response.status_code, 201, response.content)
+        user = User.objects.get(username='newcomer')
+        self.assertEqual(user.profile.account_number, '8022222222')
+        self.assertEqual(response.json()['token'], Token.objects.get(user=user).key)
+
+    def test_reports_every_conflict_from_one_query_before_hashing(self):
+        with mock.patch('django.contrib.auth.models.make_password') as make_password, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.register(
+                username='taken', email='TAKEN@example.com', phone='08011111111',
+                bvn='bvn-8011111111', nin='nin-other',
+            )
+        self.assertEqual(response.status_code, 400)
+        body = response.json()
+        self.assertEqual(list(body['conflicts']), ['username', 'email', 'phone', 'bvn', 'account_number'])
+        self.assertEqual(body['field'], 'username')
+        self.assertEqual(body['error'], body['conflicts']['username'])
+        self.assertEqual(len(queries), 1)
+        make_password.assert_not_called()
+        self.assertFalse(User.objects.filter(email='TAKEN@example.com').exists())
+
+    def test_race_past_the_check_is_mapped_from_the_constraint_and_rolled_back(self):
+        with mock.patch('api.views.find_conflicts', return_value={}):
+            response = self.register(bvn='bvn-8011111111')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['field'], 'bvn')
+        self.assertEqual(response.json()['error'], conflict_message('bvn'))
+        self.assertFalse(User.objects.filter(username='newcomer').exists())
+
+    def test_random_account_number_is_redrawn_on_clash(self):
+        with mock.patch('api.views.derive_account_number', side_effect=['8011111111', '5555555555']):
+            response = self.register(phone='')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(User.objects.get(username='newcomer').profile.account_number, '5555555555')
+
+    def test_conflict_field_reads_constraint_names(self):
+        other = User.objects.create_user(username='other')
+        for field, create in (
+            ('username', lambda: User.objects.create(username='taken')),
+            ('nin', lambda: UserProfile.objects.create(
+                user=other, account_number='8099999999', bvn='bvn-other', nin='nin-8011111111',
+            )),
+        ):
+            with self.subTest(field=field):
+                with self.assertRaises(IntegrityError) as raised, transaction.atomic():
+                    create()
+                self.assertEqual(conflict_field(raised.exception), field)
+        self.assertEqual(conflict_field(IntegrityError('CHECK constraint failed')), 'unknown')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user, self.profile = create_customer('poller', '8030000600')
+        self.payer, _ = create_customer('payer', '8030000601')
+        transfer_funds(self.payer, '8030000600', INTERNAL_BANK_NAME, '1.00')
+        self.message = Message.objects.create(user=self.user, title='Hi', content='Hello', type='notification')
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def get(self, path, **headers):
+        return self.client.get(path, **self.auth, **headers)
+
+    def test_unchanged_lists_are_not_modified(self):
+        for path in ('/api/profiles/', '/api/transactions/', '/api/messages/'):
+            with self.subTest(path=path):
+                first = self.get(path)
+                self.assertEqual(first.status_code, 200)
+                with mock.patch('rest_framework.serializers.Serializer.to_representation') as serialize, \
+                        mock.patch('api.row_serializers.RowSerializer.serialize') as serialize_rows, \
+                        self.assertNumQueries(1):
+                    repeat = self.get(path, HTTP_IF_NONE_MATCH=first['ETag'])
+                self.assertEqual(repeat.status_code, 304)
+                self.assertEqual(repeat.content, b'')
+                self.assertEqual(repeat['ETag'], first['ETag'])
+                serialize.assert_not_called()
+                serialize_rows.assert_not_called()
+
+    def test_last_modified_only_on_the_profile(self):
+        self.assertIn('Last-Modified', self.get('/api/profiles/'))
+        self.assertNotIn('Last-Modified', self.get('/api/transactions/'))
+
+    def test_changes_invalidate_the_etag(self):
+        def etag(path):
+            return self.get(path)['ETag']
+
+        profile, transactions, messages = etag('/api/profiles/'), etag('/api/transactions/'), etag('/api/messages/')
+        transfer_funds(self.payer, '8030000600', INTERNAL_BANK_NAME, '2.00')
+        self.assertNotEqual(etag('/api/profiles/'), profile)
+        self.assertNotEqual(etag('/api/transactions/'), transactions)
+        self.assertEqual(etag('/api/messages/'), messages)
+
+        self.client.post(f'/api/messages/{self.message.pk}/read/', **self.auth)
+        read = etag('/api/messages/')
+        self.assertNotEqual(read, messages)
+        Message.objects.create(user=self.user, title='Spare', content='-', type='alert').delete()
+        self.assertEqual(etag('/api/messages/'), read)
+        self.message.delete()
+        self.assertNotEqual(etag('/api/messages/'), read)
+
+    def test_user_edits_invalidate_the_profile_etag(self):
+        etags = {self.get('/api/profiles/')['ETag']}
+        for field, value in (('first_name', 'Polly'), ('last_name', 'Er'), ('email', 'poller@example.com')):
+            User.objects.filter(pk=self.user.pk).update(**{field: value})
+            response = self.get('/api/profiles/')
+            self.assertEqual(response.json()[0]['user'][field], value)
+            etags.add(response['ETag'])
+        self.assertEqual(len(etags), 4)
+
+    def test_etag_depends_on_the_page_requested(self):
+        self.assertNotEqual(
+            self.get('/api/transactions/')['ETag'],
+            self.client.get('/api/transactions/', {'page_size': 1}, **self.auth)['ETag'],
+        )
+
+    async def test_async_list_is_conditional(self):
+        factory = AsyncRequestFactory()
+        headers = {'Authorization': f'Token {self.token.key}'}
+        first = await async_views.message_list(factory.get('/api/messages/', headers=headers))
+        self.assertEqual(first['ETag'], (await self.async_client.get('/api/messages/', headers=headers))['ETag'])
+        repeat = await async_views.message_list(
+            factory.get('/api/messages/', headers={**headers, 'If-None-Match': first['ETag']}))
+        self.assertEqual(repeat.status_code, 304)
+
+
+@skipUnless('replica' in settings.DATABASES, "needs a second database aliased 'replica'")
+@override_settings(
+    DATABASE_ROUTERS=['api.routers.ReplicaRouter'],
+    DATABASE_REPLICAS=['replica'],
+    REPLICA_STICKY_SECONDS=5,
+    REPLICA_MAX_LAG=2,
+)
+@modify_settings(MIDDLEWARE={'prepend': 'api.routers.ReplicaRoutingMiddleware'})
+class ReplicaRouterTests(TransactionTestCase):
+    """Two databases that don't replicate, so each read shows where it went"""
+    # Only aliases that exist: Django sets up the databases of skipped classes too
+    databases = {'default'} | ({'replica'} & set(settings.DATABASES))
+
+    def setUp(self):
+        token_cache.clear()
+        replica_health.clear()
+        cache.clear()
+        # Seed outside this thread's context so the writes don't pin the test's reads
+        copy_context().run(self.seed)
+
+    def seed(self):
+        self.reader, _ = create_customer('reader', '8030000700')
+        self.token = Token.objects.create(user=self.reader)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+        self.message = Message.objects.create(user=self.reader, title='Hi', content='Hello', type='notification')
+        for alias, name in (('default', 'Primary'), ('replica', 'Replica')):
+            payee = User.objects.db_manager(alias).create_user(username='payee', first_name=name)
+            UserProfile.objects.using(alias).create(
+                user=payee, account_number='8030000701', bvn='bvn-payee', nin='nin-payee'
+            )
+
+    def payee_name(self):
+        return self.client.get('/api/transactions/verify-account/8030000701/', **self.auth).json()['name']
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.payee_name(), 'Replica')
+
+    def test_user_sticks_to_the_primary_after_writing(self):
+        response = self.client.post(f'/api/messages/{self.message.pk}/read/', **self.auth)
+        self.assertEqual(response.status_code, 200)  # the write request read from the primary
+        self.assertEqual(self.payee_name(), 'Primary')
+        with mock.patch('api.routers.time.time', return_value=time.time() + 6):
+            self.assertEqual(self.payee_name(), 'Replica')
+
+    def test_lagging_or_unreachable_replica_falls_back_to_the_primary(self):
+        with mock.patch('api.routers.replica_lag', return_value=10.0):
+            self.assertEqual(self.payee_name(), 'Primary')
+        replica_health.clear()
+        with mock.patch('api.routers.replica_lag', side_effect=OperationalError('down')), \
+                self.assertLogs('api.routers', 'WARNING'):
+            self.assertEqual(self.payee_name(), 'Primary')
+        replica_health.clear()
+        self.assertEqual(self.payee_name(), 'Replica')
+
+    def test_lag_is_measured_at_most_once_per_interval(self):
+        with mock.patch('api.routers.replica_lag', return_value=0.0) as lag:
+            for _ in range(3):
+                self.payee_name()
+        self.assertEqual(lag.call_count, 1)
+
+    def test_transactions_and_own_writes_read_from_the_primary(self):
+        router = ReplicaRouter()
+
+        def check():
+            self.assertEqual(router.db_for_read(UserProfile), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(UserProfile), 'default')
+            Message.objects.create(user=self.reader, title='New', content='-', type='alert')
+            self.assertEqual(router.db_for_read(UserProfile), 'default')
+
+        copy_context().run(check)
+
+    def test_registration_pins_the_new_user(self):
+        response = self.client.post('/api/auth/register/', {
+            'username': 'newcomer', 'email': 'newcomer@example.com', 'password': 'password123',
+            'phone': '08030000702', 'bvn': 'bvn-new', 'nin': 'nin-new',
+        }, content_type='application/json')
+        token = response.json()['token']
+        profiles = self.client.get('/api/profiles/', HTTP_AUTHORIZATION=f'Token {token}').json()
+        self.assertEqual(profiles[0]['account_number'], '8030000702')
+
+
+@skipUnless('shard1' in settings.DATABASES, "needs a second database aliased 'shard1'")
+@override_settings(ACCOUNT_SHARDS=['default', 'shard1'], DATABASE_ROUTERS=['api.shards.ShardRouter'])
+class ShardingTests(TransactionTestCase):
+    databases = {'default'} | ({'shard1'} & set(settings.DATABASES))
+
+    def setUp(self):
+        token_cache.clear()
+        self.local, self.local_profile = self.customer_on('default', 'local', '8030000800', '100.00')
+        self.remote, self.remote_profile = self.customer_on('shard1', 'remote', '8030000801', '0.00')
+
+    def customer_on(self, alias, prefix, account_number, balance):
+        """A customer whose user id hashes to ``alias``"""
+        for n in range(100):
+            user = User.objects.create_user(username=f'{prefix}{n}', password='password123', first_name=prefix)
+            if shard_for_user(user.pk) == alias:
+                break
+            user.delete()
+        mirror_users([user])
+        profile = UserProfile.objects.create(
+            user=user, account_number=account_number, account_balance=balance,
+            bvn=f'bvn-{account_number}', nin=f'nin-{account_number}',
+        )
+        return user, profile
+
+    def balances(self):
+        return (
+            UserProfile.objects.using('default').get(pk=self.local_profile.pk).account_balance,
+            UserProfile.objects.using('shard1').get(pk=self.remote_profile.pk).account_balance,
+        )
+
+    def transfer(self, amount='25.00', account='8030000801'):
+        return transfer_funds(self.local, account, INTERNAL_BANK_NAME, amount)
+
+    def test_rows_live_on_the_owners_shard(self):
+        self.assertEqual(self.remote_profile._state.db, 'shard1')
+        self.assertFalse(UserProfile.objects.using('default').filter(user=self.remote).exists())
+        self.assertEqual(User.objects.get(pk=self.remote.pk).profile.account_number, '8030000801')
+        self.assertEqual(UserProfile.objects.find(account_number='8030000801').pk, self.remote_profile.pk)
+        self.assertEqual(len(UserProfile.objects.scatter(account_balance__gte=0)), 2)
+
+        token = Token.objects.create(user=self.remote)
+        auth = {'HTTP_AUTHORIZATION': f'Token {token.key}'}
+        self.assertEqual(self.client.get('/api/profiles/', **auth).json()[0]['account_number'], '8030000801')
+        verified = self.client.get('/api/transactions/verify-account/8030000801/', **auth).json()
+        self.assertEqual(verified['name'], 'remote')
+
+    def test_transfer_on_one_shard_needs_no_saga(self):
+        payee, _ = self.customer_on('default', 'payee', '8030000802', '0.00')
+        self.transfer('10.00', account='8030000802')
+        self.assertEqual(Transaction.objects.for_user(payee).get().balance_after, Decimal('10.00'))
+        self.assertFalse(TransferSaga.objects.using('default').exists())
+
+    def test_cross_shard_transfer(self):
+        sender_transaction = self.transfer()
+
+        self.assertEqual(self.balances(), (Decimal('75.00'), Decimal('25.00')))
+        self.assertEqual(sender_transaction.balance_after, Decimal('75.00'))
+        self.assertEqual(TransferSaga.objects.using('default').get().state, 'completed')
+        self.assertEqual(TransferSaga.objects.using('shard1').get().state, 'credited')
+        credit_leg = Transaction.objects.for_user(self.remote).get()
+        self.assertEqual(credit_leg.reference, credit_reference(sender_transaction.reference))
+        self.assertEqual(credit_leg.balance_after, Decimal('25.00'))
+        self.assertEqual(statement(self.remote, date.today(), date.today())['closing_balance'], Decimal('25.00'))
+
+        # The event is queued on the sender's shard; the recipient's alert lands on theirs
+        self.assertEqual(outbox.drain(using='default'), (1, 0))
+        self.assertIn('Balance: NGN 25.00', Message.objects.for_user(self.remote).get().content)
+        self.assertTrue(Message.objects.for_user(self.local).exists())
+
+    def test_failed_credit_is_compensated(self):
+        with mock.patch('api.transfers._credit_leg', side_effect=OperationalError('shard down')), \
+                self.assertLogs('api.transfers', 'WARNING'):
+            with self.assertRaises(TransferNotCompleted) as raised:
+                self.transfer()
+        self.assertEqual(raised.exception.status_code, 503)
+
+        self.assertEqual(self.balances(), (Decimal('100.00'), Decimal('0.00')))
+        self.assertEqual(TransferSaga.objects.using('default').get().state, 'compensated')
+        self.assertEqual(TransferSaga.objects.using('shard1').get().state, 'aborted')
+        reversal = Transaction.objects.for_user(self.local).get(category='Reversal')
+        self.assertEqual(reversal.balance_after, Decimal('100.00'))
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_recovery_refunds_a_transfer_that_was_never_credited(self):
+        with mock.patch('api.transfers._credit_leg', side_effect=OperationalError('shard down')), \
+                mock.patch('api.transfers.settle_saga', return_value='pending'), \
+                self.assertLogs('api.transfers', 'WARNING'):
+            with self.assertRaises(TransferPending):
+                self.transfer()
+        self.assertEqual(self.balances(), (Decimal('75.00'), Decimal('0.00')))
+
+        call_command('recover_transfers', older_than=0, stdout=io.StringIO())
+        self.assertEqual(self.balances(), (Decimal('100.00'), Decimal('0.00')))
+        self.assertEqual(TransferSaga.objects.using('default').get().state, 'compensated')
+
+        # Settling is idempotent and the credit leg is fenced off
+        call_command('recover_transfers', older_than=0, stdout=io.StringIO())
+        saga = TransferSaga.objects.using('default').get()
+        with self.assertRaises(IntegrityError):
+            transfers._credit_leg(saga, self.remote_profile, Transaction(user_id=self.remote.pk, amount=saga.amount))
+        self.assertEqual(self.balances(), (Decimal('100.00'), Decimal('0.00')))
+
+    @modify_settings(MIDDLEWARE={
+        'remove': 'api.signature_middleware.CryptographicSignatureMiddleware',
+        'append': ['api.idempotency.IdempotencyMiddleware', 'api.signature_middleware.CryptographicSignatureMiddleware'],
+    })
+    def test_pending_transfer_is_replayed_under_its_idempotency_key(self):
+        response_cache.clear()
+        private_key, public_key = make_key_pair()
+        UserProfile.objects.filter(pk=self.local_profile.pk).update(public_key=public_key)
+        token = Token.objects.create(user=self.local)
+        path = '/api/transactions/transfer/'
+        data = {'recipient_account': '8030000801', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '25.00'}
+
+        def post():
+            return self.client.post(
+                path, data, content_type='application/json', HTTP_AUTHORIZATION=f'Token {token.key}',
+                HTTP_IDEMPOTENCY_KEY='pending-1', **sign_request(private_key, self.local, 'POST', path, data),
+            )
+
+        with mock.patch('api.transfers._credit_leg', side_effect=OperationalError('shard down')), \
+                mock.patch('api.transfers.settle_saga', return_value='pending'), \
+                self.assertLogs('api.transfers', 'WARNING'):
+            first = post()
+        self.assertEqual(first.status_code, 202)
+        saga = TransferSaga.objects.using('default').get()
+        self.assertEqual(first.json()['reference'], saga.reference)
+
+        response_cache.clear()
+        repeat = post()
+        self.assertEqual(repeat.status_code, 202)
+        self.assertEqual(repeat['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.balances(), (Decimal('75.00'), Decimal('0.00')))
+        self.assertEqual(Transaction.objects.for_user(self.local).count(), 1)
+
+    def test_saga_refuses_to_run_inside_an_atomic_block(self):
+        with self.assertRaises(TransactionManagementError), transaction.atomic():
+            self.transfer()
+        with self.assertRaises(TransactionManagementError), transaction.atomic(using='shard1'):
+            self.transfer()
+        self.assertEqual(self.balances(), (Decimal('100.00'), Decimal('0.00')))
+        self.assertFalse(TransferSaga.objects.using('default').exists())
+        self.assertFalse(TransferSaga.objects.using('shard1').exists())
+
+    def test_recovery_completes_a_credited_transfer(self):
+        with mock.patch('api.transfers._complete_saga', side_effect=OperationalError('connection lost')), \
+                self.assertLogs('api.transfers', 'WARNING'):
+            self.transfer()
+        self.assertEqual(TransferSaga.objects.using('default').get().state, 'pending')
+
+        call_command('recover_transfers', older_than=0, stdout=io.StringIO())
+        self.assertEqual(self.balances(), (Decimal('75.00'), Decimal('25.00')))
+        self.assertEqual(TransferSaga.objects.using('default').get().state, 'completed')
+        self.assertEqual(OutboxEvent.objects.get().payload['recipient_balance'], '25.00')
+
+    def test_batches_and_cross_shard_recipients(self):
+        remote = {'recipient_account': '8030000801', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '10.00'}
+        external = {'recipient_account': '0123456789', 'recipient_bank': 'Other Bank', 'amount': '5.00'}
+        with self.assertRaises(BatchRejected):
+            batch_transfer(self.local, [external, remote], mode=BATCH_MODE_ATOMIC)
+        self.assertEqual(self.balances(), (Decimal('100.00'), Decimal('0.00')))
+
+        results = batch_transfer(self.local, [remote, external], mode=BATCH_MODE_BEST_EFFORT)
+        self.assertEqual([r['status'] for r in results], ['completed', 'completed'])
+        self.assertEqual(self.balances(), (Decimal('85.00'), Decimal('10.00')))
+
+    def test_registration_writes_the_profile_to_the_users_shard(self):
+        response = self.client.post('/api/auth/register/', {
+            'username': 'newcomer', 'email': 'newcomer@example.com', 'password': 'password123',
+            'phone': '08030000802', 'bvn': 'bvn-new', 'nin': 'nin-new',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        user = User.objects.get(username='newcomer')
+        self.assertEqual(UserProfile.objects.for_user(user).get().account_number, '8030000802')
+
+        # Profile fields already registered on another shard are conflicts
+        response = self.client.post('/api/auth/register/', {
+            'username': 'copycat', 'email': 'copycat@example.com', 'password': 'password123',
+            'phone': '08030000801',
+            'bvn': 'bvn-8030000801', 'nin': 'nin-other',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['conflicts']), {'bvn', 'account_number'})
+
+
+@modify_settings(MIDDLEWARE={
+    'remove': 'api.signature_middleware.CryptographicSignatureMiddleware',
+    'append': ['api.idempotency.IdempotencyMiddleware', 'api.signature_middleware.CryptographicSignatureMiddleware'],
+})
+class IdempotencyTests(TestCase):
+    path = '/api/transactions/transfer/'
+
+    def setUp(self):
+        token_cache.clear()
+        response_cache.clear()
+        self.private_key, public_key = make_key_pair()
+        self.sender, self.sender_profile = create_customer('payer', '8030000600', balance='100.00', public_key=public_key)
+        create_customer('payee', '8030000601', balance='0.00')
+        self.token = Token.objects.create(user=self.sender)
+        self.data = {'recipient_account': '8030000601', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '10.00'}
+
+    def post(self, data=None, key='key-1', signed=True):
+        data = data or self.data
+        headers = {'HTTP_AUTHORIZATION': f'Token {self.token.key}', 'HTTP_IDEMPOTENCY_KEY': key}
+        if signed:
+            headers.update(sign_request(self.private_key, self.sender, 'POST', self.path, data))
+        return self.client.post(self.path, data, content_type='application/json', **headers)
+
+    def assertBalance(self, balance):
+        self.sender_profile.refresh_from_db()
+        self.assertEqual(self.sender_profile.account_balance, Decimal(balance))
+
+    def test_repeat_replays_without_verifying_or_transferring(self):
+        first = self.post()
+        self.assertEqual(first.status_code, 201)
+
+        with self.assertNumQueries(0):
+            repeat = self.post(signed=False)
+        self.assertEqual(repeat.status_code, 201)
+        self.assertEqual(repeat.content, first.content)
+        self.assertEqual(repeat['Idempotent-Replayed'], 'true')
+        self.assertBalance('90.00')
+        self.assertEqual(Transaction.objects.filter(user=self.sender).count(), 1)
+
+    def test_other_worker_replays_from_the_table(self):
+        first = self.post()
+        response_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            repeat = self.post()
+        statements = [q['sql'].split()[0] for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(statements, ['INSERT', 'SELECT'])  # the failed claim, then the record
+        self.assertEqual(repeat.content, first.content)
+        self.assertBalance('90.00')
+
+    def test_key_reused_for_another_request(self):
+        self.post()
+        response = self.post(dict(self.data, amount='20.00'))
+        self.assertEqual(response.status_code, 422)
+        self.assertBalance('90.00')
+
+    def test_rejected_before_the_view_is_not_stored(self):
+        self.assertEqual(self.post(signed=False).status_code, 400)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+        self.assertEqual(self.post().status_code, 201)
+        self.assertBalance('90.00')
+
+    def test_business_errors_are_stored(self):
+        self.assertEqual(self.post(dict(self.data, amount='500.00')).status_code, 400)
+        self.assertEqual(self.post(dict(self.data, amount='500.00')).status_code, 400)
+        self.assertEqual(IdempotencyRecord.objects.get().response_status, 400)
+
+    def test_concurrent_duplicate_waits_for_the_first(self):
+        entered, release = threading.Event(), threading.Event()
+        calls = []
+
+        def view(request):
+            calls.append(request)
+            entered.set()
+            release.wait(5)
+            request.idempotency_view_called = True
+            return HttpResponse(b'{"ok": true}', status=201, content_type='application/json')
+
+        middleware = IdempotencyMiddleware(view)
+        factory = RequestFactory()
+
+        def request():
+            r = factory.post(self.path, self.data, content_type='application/json', HTTP_IDEMPOTENCY_KEY='same')
+            r.user = self.sender
+            return r
+
+        duplicate = {}
+
+        def send_duplicate():
+            entered.wait(5)
+            duplicate['response'] = middleware(request())
+
+        # Only the first attempt touches the database, so it runs on the test's connection
+        waiter = threading.Thread(target=send_duplicate)
+        waiter.start()
+        threading.Timer(0.2, release.set).start()
+        first = middleware(request())
+        waiter.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(duplicate['response'].status_code, 201)
+        self.assertEqual(duplicate['response']['Idempotent-Replayed'], 'true')
+
+
+class ImportCustomersTests(TestCase):
+    def write_csv(self, directory, rows):
+        path = os.path.join(directory, 'customers.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['username', 'password', 'phone', 'bvn', 'nin', 'date_of_birth', 'account_balance'])
+            writer.writerows(rows)
+        return path
+
+    def test_imports_in_bulk_and_reports_rejects(self):
+        create_customer('existing', '8030000900')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self.write_csv(tmp, [
+                ['ada', 'pw-1', '08031110001', 'bvn-a', 'nin-a', '1990-05-01', '250.00'],
+                ['bola', 'pw-2', '', 'bvn-b', 'nin-b', '', ''],
+                ['existing', 'pw-3', '08031110003', 'bvn-c', 'nin-c', '', ''],
+                ['chidi', 'pw-4', '08031110004', 'bvn-a', 'nin-d', '', ''],
+                ['dayo', 'pw-5', '08031110005', 'bvn-e', 'nin-e', '05/01/1990', ''],
+                ['emeka', 'pw-6', '08030000900', 'bvn-f', 'nin-f', '', ''],
+                ['', 'pw-7', '', 'bvn-g', 'nin-g', '', ''],
+            ])
+            rejects = os.path.join(tmp, 'rejects.csv')
+            out = io.StringIO()
+            call_command('import_customers', path, chunk_size=3, workers=2, opening_balance='10.00',
+                         rejects=rejects, stdout=out)
+            with open(rejects) as f:
+                rejected = {row['line']: row['reason'] for row in csv.DictReader(f)}
+                f.seek(0)
+                self.assertNotIn('pw-', f.read())
+
+        self.assertIn('Imported 2 customer(s), rejected 5', out.getvalue())
+        self.assertEqual(rejected, {
+            '4': 'Username is already registered',
+            '5': 'Duplicate bvn in file',
+            '6': 'Invalid date_of_birth (expected YYYY-MM-DD)',
+            '7': 'Account number is already registered',
+            '8': 'Missing username',
+        })
+
+        ada = User.objects.select_related('profile', 'auth_token').get(username='ada')
+        self.assertTrue(ada.check_password('pw-1'))
+        self.assertEqual(ada.profile.account_number, '8031110001')
+        self.assertEqual(ada.profile.account_balance, Decimal('250.00'))
+        self.assertEqual(ada.profile.date_of_birth, date(1990, 5, 1))
+        self.assertTrue(ada.auth_token.key)
+
+        bola = UserProfile.objects.get(user__username='bola')
+        self.assertEqual(len(bola.account_number), 10)
+        self.assertEqual(bola.account_balance, Decimal('10.00'))
+
+    def test_rejects_values_the_columns_cannot_hold(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self.write_csv(tmp, [
+                ['bob', 'pw-1', '', 'bvn-a', 'nin-a', '', '1e20'],
+                ['carol', 'pw-2', '', 'bvn-b', 'nin-b', '', '12.345'],
+                ['dan', 'pw-3', '', 'bvn-c', 'nin-c', '', '-50'],
+                ['bad name!', 'pw-4', '', 'bvn-d', 'nin-d', '', ''],
+                ['x' * 151, 'pw-5', '', 'bvn-e', 'nin-e', '', ''],
+                ['eve', 'pw-6', '0' * 21, 'bvn-f', 'nin-f', '', ''],
+                ['fola', 'pw-7', '', 'b' * 51, 'nin-g', '', ''],
+                ['gbenga', 'pw-8', '', 'bvn-h', 'nin-h', '', '9999999999.99'],
+            ])
+            rejects = os.path.join(tmp, 'rejects.csv')
+            out = io.StringIO()
+            call_command('import_customers', path, workers=1, rejects=rejects, stdout=out)
+            with open(rejects) as f:
+                rejected = {row['line']: row['reason'] for row in csv.DictReader(f)}
+
+        self.assertIn('Imported 1 customer(s), rejected 7', out.getvalue())
+        self.assertEqual(rejected, {
+            '2': 'Invalid account_balance',
+            '3': 'Invalid account_balance',
+            '4': 'Invalid account_balance',
+            '5': 'Invalid username',
+            '6': 'username is longer than 150 characters',
+            '7': 'phone is longer than 20 characters',
+            '8': 'bvn is longer than 50 characters',
+        })
+        self.assertEqual(list(UserProfile.objects.values_list('account_balance', flat=True)),
+                         [Decimal('9999999999.99')])
+
+    def test_rejects_a_row_the_database_refuses(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self.write_csv(tmp, [
+                ['ada', 'pw-1', '', 'bvn-a', 'nin-a', '', ''],
+                ['bola', 'pw-2', '', 'bvn-b', 'nin-b', '', ''],
+            ])
+            out = io.StringIO()
+            bulk_create = UserProfile.objects.bulk_create
+
+            def strict_bulk_create(profiles, *args, **kwargs):
+                # A backend enforcing lengths would refuse bola's row
+                if any(profile.bvn == 'bvn-b' for profile in profiles):
+                    raise DataError('value too long')
+                return bulk_create(profiles, *args, **kwargs)
+
+            with mock.patch.object(UserProfile.objects, 'bulk_create', side_effect=strict_bulk_create):
+                call_command('import_customers', path, workers=1, stdout=out, stderr=io.StringIO())
+
+        self.assertIn('Imported 1 customer(s), rejected 1', out.getvalue())
+        self.assertEqual(list(User.objects.values_list('username', flat=True)), ['ada'])
+
+    def test_missing_required_column(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'customers.csv')
+            with open(path, 'w') as f:
+                f.write('username,password\nada,pw\n')
+            with self.assertRaisesMessage(CommandError, 'Missing column(s): bvn, nin'):
+                call_command('import_customers', path, stdout=io.StringIO())
+
+
+class ApiBenchmarkTests(TestCase):
+    def test_reports_and_detects_regressions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench.json')
+            call_command('bench_api', requests=3, warmup=1, users=2, output=output, stdout=io.StringIO())
+            with open(output) as f:
+                report = json.load(f)
+            transfer = report['scenarios']['transfer']
+            self.assertEqual((transfer['requests'], transfer['errors']), (3, 0))
+            self.assertEqual(report['scenarios']['cards']['queries_per_request'], 1)
+            self.assertLessEqual(transfer['p50_ms'], transfer['p99_ms'])
+            self.assertFalse(User.objects.filter(username__startswith='bench-api-').exists())
+
+            for result in report['scenarios'].values():
+                result['p95_ms'] /= 100
+            with open(output, 'w') as f:
+                json.dump(report, f)
+            with self.assertRaisesMessage(CommandError, 'Regression against baseline'):
+                call_command('bench_api', scenarios='cards', requests=3, users=1, baseline=output, stdout=io.StringIO())
+
+
+@override_settings(REQUEST_TIMING_ENABLED=True, METRICS_TOKEN='scrape-me')
+@modify_settings(MIDDLEWARE={'prepend': 'api.timing.RequestTimingMiddleware'})
+class RequestTimingTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        request_duration.clear()
+        phase_duration.clear()
+        self.private_key, public_key = make_key_pair()
+        self.user, _ = create_customer('timed', '8030000800', public_key=public_key)
+        create_customer('timed-payee', '8030000801')
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {Token.objects.create(user=self.user).key}'}
+
+    def test_signed_transfer_reports_its_phases(self):
+        path = '/api/transactions/transfer/'
+        data = {'recipient_account': '8030000801', 'recipient_bank': INTERNAL_BANK_NAME, 'amount': '1.00'}
+        response = self.client.post(path, data, content_type='application/json', **self.auth,
+                                    **sign_request(self.private_key, self.user, 'POST', path, data))
+        self.assertEqual(response.status_code, 201)
+
+        phases = {entry.split(';')[0] for entry in response['Server-Timing'].split(', ')}
+        self.assertLessEqual({'auth', 'replay', 'profile', 'key', 'verify', 'db', 'transaction', 'render', 'total'}, phases)
+
+        metrics = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me').content.decode()
+        self.assertIn('api_request_phase_seconds_count{route="api/transactions/transfer/",phase="verify"} 1', metrics)
+        self.assertIn(
+            'api_request_duration_seconds_count{method="POST",route="api/transactions/transfer/",status="201"} 1',
+            metrics,
+        )
+
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    def test_metrics_are_not_served_without_a_token(self):
+        for token in (None, ''):
+            with self.settings(METRICS_TOKEN=token):
+                self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    def test_disabled_timing_removes_the_middleware(self):
+        with self.settings(REQUEST_TIMING_ENABLED=False):
+            response = self.client.get('/api/cards/', **self.auth)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'Test', ('phase',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(('db',), value)
+        lines = histogram.render().splitlines()
+        self.assertIn('test_seconds_bucket{phase="db",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{phase="db",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{phase="db",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{phase="db"} 4', lines)
 
-# Create your tests here.
@@ -0,0 +1,198 @@
+"""
+Per-request timing breakdown.
+
+With ``REQUEST_TIMING_ENABLED = True`` and ``api.timing.RequestTimingMiddleware``
+installed first in ``MIDDLEWARE``, every request records how long it spent in:
+
+- ``auth``, ``replay``, ``profile``, ``key`` and ``verify``: the phases of
+  ``CryptographicSignatureMiddleware`` (token lookup, replay cache, profile
+  query, public key loading and the ECDSA verify)
+- ``db``: every SQL statement, through ``connection.execute_wrapper``
+- ``render``: serializing the response
+- ``total``: the whole request
+
+The phases are sent back in a ``Server-Timing`` header, which browser dev
+tools display, and aggregated into in-process histograms served in the
+Prometheus text format at ``/api/metrics/``, which is only served once
+``METRICS_TOKEN`` is set and then requires ``Authorization: Bearer <token>``.
+Histograms are per worker process, so
+scrape every worker or run one per container.
+
+When disabled the middleware removes itself at startup and the hooks in the
+signature middleware cost one attribute lookup each.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+
+# Upper bounds in seconds; phases are mostly sub-millisecond, requests not
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_no_timer = nullcontext()
+
+
+class RequestTimer:
+    """Accumulated seconds and call counts per phase for one request"""
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, seconds):
+        total, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (total + seconds, count + 1)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def server_timing(self):
+        """The ``Server-Timing`` header value, durations in milliseconds"""
+        entries = []
+        for name, (seconds, count) in self.phases.items():
+            entry = f'{name};dur={seconds * 1000:.2f}'
+            if count > 1:
+                entry += f';desc="{count}"'
+            entries.append(entry)
+        return ', '.join(entries)
+
+
+class _Phase:
+    __slots__ = ('timer', 'name', 'started')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+
+def phase(request, name):
+    """Context manager timing ``name`` for ``request``; a no-op unless timing is on"""
+    timer = getattr(request, 'timer', None)
+    return _no_timer if timer is None else timer.phase(name)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values"""
+
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+            lines.append(f'{self.name}_count{{{label_text}}} {count}')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = Histogram(
+    'api_request_duration_seconds', 'Time to handle a request', ('method', 'route', 'status'),
+)
+phase_duration = Histogram(
+    'api_request_phase_seconds', 'Time a request spent in each phase', ('route', 'phase'),
+)
+
+
+def render_metrics():
+    """All histograms in the Prometheus text exposition format"""
+    return '\n'.join(histogram.render() for histogram in (request_duration, phase_duration)) + '\n'
+
+
+def _route(request):
+    match = getattr(request, 'resolver_match', None)
+    # The URL pattern rather than the path, so ids don't multiply the series
+    return match.route if match is not None else 'unmatched'
+
+
+class RequestTimingMiddleware(MiddlewareMixin):
+    """Times each request's phases; install first in MIDDLEWARE"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_TIMING_ENABLED', False):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timer = request.timer = RequestTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(self._time_query(timer)):
+            response = self.get_response(request)
+        return self._finish(request, response, timer, started)
+
+    async def __acall__(self, request):
+        # Async ORM queries run on other threads' connections, so there's no db phase here
+        timer = request.timer = RequestTimer()
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        return self._finish(request, response, timer, started)
+
+    def _time_query(self, timer):
+        def wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                timer.add('db', time.perf_counter() - started)
+        return wrapper
+
+    def process_template_response(self, request, response):
+        # Rendering (DRF's serialization to JSON) happens after this hook returns
+        timer = getattr(request, 'timer', None)
+        if timer is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(lambda r: timer.add('render', time.perf_counter() - started))
+        return response
+
+    def _finish(self, request, response, timer, started):
+        total = time.perf_counter() - started
+        route = _route(request)
+        for name, (seconds, _) in timer.phases.items():
+            phase_duration.observe((route, name), seconds)
+        request_duration.observe((request.method, route, str(response.status_code)), total)
+        timer.add('total', total)
+        response['Server-Timing'] = timer.server_timing()
+        return response
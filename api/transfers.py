@@ -0,0 +1,733 @@
+import logging
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.transaction import TransactionManagementError
+from django.db.models import F, Case, When, Value, DecimalField
+from django.utils import timezone
+
+from .models import UserProfile, Transaction, TransferSaga
+from .notifications import TRANSFER_COMPLETED, transfer_completed_payload
+from .outbox import emit, emit_many
+from .references import new_reference, credit_reference, reversal_reference
+from .shards import account_db, is_sharded
+from .hot_accounts import credit_slot, pending_credits
+from .snapshots import record_transactions
+
+logger = logging.getLogger(__name__)
+
+INTERNAL_BANK_NAME = 'Secure Cipher Bank'
+CENTS = Decimal('0.01')
+
+BATCH_MODE_ATOMIC = 'atomic'
+BATCH_MODE_BEST_EFFORT = 'best_effort'
+BATCH_MODES = (BATCH_MODE_ATOMIC, BATCH_MODE_BEST_EFFORT)
+
+
+class TransferError(Exception):
+    """Base error for a transfer that was rejected before anything was committed"""
+    status_code = 400
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+
+
+class InvalidAmount(TransferError):
+    pass
+
+
+class InsufficientFunds(TransferError):
+    def __init__(self, message='Insufficient funds'):
+        super().__init__(message)
+
+
+class AccountNotFound(TransferError):
+    status_code = 404
+
+
+class TransferNotCompleted(TransferError):
+    """A transfer between shards that failed; the sender's debit was reversed"""
+    status_code = 503
+
+
+class TransferPending(TransferError):
+    """
+    A transfer between shards that was debited but not (yet) credited;
+    ``recover_transfers`` completes or reverses it. The debit stands, so this
+    is an accepted transfer (202) and not one to retry.
+    """
+    status_code = 202
+
+    def __init__(self, message, reference):
+        super().__init__(message)
+        self.reference = reference
+
+
+class BatchRejected(TransferError):
+    """An all-or-nothing batch failed; ``results`` says which items were at fault"""
+
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+
+def parse_amount(value):
+    """Convert a request amount to a positive two-decimal ``Decimal``"""
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, ValueError, TypeError):
+        raise InvalidAmount('Amount must be a number')
+
+    if not amount.is_finite():
+        raise InvalidAmount('Amount must be a number')
+    if amount <= 0:
+        raise InvalidAmount('Amount must be greater than zero')
+    if amount != amount.quantize(CENTS):
+        raise InvalidAmount('Amount cannot have more than two decimal places')
+
+    return amount.quantize(CENTS)
+
+
+def display_name(user):
+    return f"{user.first_name} {user.last_name}".strip() or user.username
+
+
+def is_internal_bank(bank_name):
+    return bool(bank_name) and bank_name.lower() == INTERNAL_BANK_NAME.lower()
+
+
+def lock_profiles(profile_ids, using=None):
+    """
+    Lock the given profile rows in ascending id order.
+
+    Every transfer takes its row locks in the same global order, so an A->B
+    transfer and a concurrent B->A transfer queue behind each other instead of
+    deadlocking. Must be called inside ``transaction.atomic()``.
+
+    ``using`` is the accounts' shard (see ``api.shards.account_db``); these
+    helpers leave it to the routers when it is None.
+    """
+    return list(
+        UserProfile.objects.db_manager(using).select_for_update()
+        .filter(pk__in=set(profile_ids))
+        .order_by('pk')
+        .values_list('pk', flat=True)
+    )
+
+
+def debit(profile_id, amount, using=None):
+    """Conditionally subtract ``amount``; returns False if the balance is too low"""
+    return UserProfile.objects.db_manager(using).filter(
+        pk=profile_id, account_balance__gte=amount
+    ).update(account_balance=F('account_balance') - amount, updated_at=timezone.now()) == 1
+
+
+def credit(profile_id, amount, using=None):
+    UserProfile.objects.db_manager(using).filter(pk=profile_id).update(
+        account_balance=F('account_balance') + amount, updated_at=timezone.now()
+    )
+
+
+def credit_many(amounts_by_profile, using=None):
+    """Apply several credits with a single ``UPDATE ... CASE`` statement"""
+    if not amounts_by_profile:
+        return
+    UserProfile.objects.db_manager(using).filter(pk__in=amounts_by_profile.keys()).update(
+        account_balance=F('account_balance') + Case(
+            *[When(pk=pk, then=Value(amount)) for pk, amount in amounts_by_profile.items()],
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        # update() skips auto_now; conditional GETs rely on this changing
+        updated_at=timezone.now(),
+    )
+
+
+def credit_account(profile, amount, using=None, count=1):
+    """
+    Credit ``profile`` (loaded with ``balance_slots``). A hot account's
+    credit goes to one of its slots and needs no lock on the account; returns
+    whether it did, in which case the roll-up records it in the snapshots.
+    """
+    if profile.balance_slots and credit_slot(profile.pk, profile.balance_slots, amount, using=using, count=count):
+        return True
+    credit(profile.pk, amount, using=using)
+    return False
+
+
+def current_balances(profile_ids, using=None, spendable=False):
+    """
+    The balances shown to the customers, including credits waiting in hot
+    accounts' slots; with ``spendable``, only what a debit can take.
+    """
+    rows = list(
+        UserProfile.objects.db_manager(using).filter(pk__in=set(profile_ids))
+        .values_list('pk', 'account_balance', 'balance_slots')
+    )
+    balances = {pk: balance for pk, balance, _ in rows}
+    hot = [pk for pk, _, slots in rows if slots]
+    if hot and not spendable:
+        for pk, pending in pending_credits(hot, using).items():
+            balances[pk] += pending
+    return balances
+
+
+def is_hot(profile):
+    return profile is not None and profile.balance_slots > 0
+
+
+def transfer_funds(sender, recipient_account, recipient_bank, amount,
+                   description='', recipient_name=None):
+    """
+    Move ``amount`` from ``sender`` to ``recipient_account`` and record both legs.
+
+    Balances are only ever changed with ``UPDATE ... SET balance = balance +/- X``
+    so concurrent transfers can't lose each other's updates, and the debit is
+    guarded by ``balance >= X`` so an account can never go negative. Returns the
+    sender's ``Transaction``.
+
+    When the recipient's account is on another shard the transfer runs as a
+    saga instead of one database transaction; see ``transfer_across_shards``.
+    """
+    amount = parse_amount(amount)
+
+    try:
+        # Memoized on the user, so the request's authentication may already have it
+        sender_profile = sender.profile
+    except UserProfile.DoesNotExist:
+        raise AccountNotFound('User profile not found')
+
+    recipient_profile = None
+    recipient_name = recipient_name or 'External Account'
+
+    if is_internal_bank(recipient_bank):
+        try:
+            recipient_profile = (
+                UserProfile.objects.select_related('user')
+                .only('id', 'balance_slots', 'user__username', 'user__first_name', 'user__last_name')
+                .find(account_number=recipient_account)
+            )
+        except UserProfile.DoesNotExist:
+            raise AccountNotFound('Recipient account not found')
+        recipient_name = display_name(recipient_profile.user)
+
+    db = account_db(sender.pk)
+    if recipient_profile and is_sharded() and recipient_profile._state.db != db:
+        return transfer_across_shards(
+            sender, sender_profile, recipient_profile, amount, description,
+        )
+
+    profile_ids = [sender_profile.pk]
+    if recipient_profile:
+        profile_ids.append(recipient_profile.pk)
+
+    reference = new_reference()
+    with transaction.atomic(using=db):
+        # A hot account isn't locked; its credit goes to a slot
+        lock_profiles(profile_ids if not is_hot(recipient_profile) else profile_ids[:1], using=db)
+
+        if not debit(sender_profile.pk, amount, using=db):
+            raise InsufficientFunds()
+        slotted = recipient_profile is not None and credit_account(recipient_profile, amount, using=db)
+
+        balances = current_balances(profile_ids, using=db)
+
+        sender_transaction = Transaction.objects.db_manager(db).create(
+            user=sender,
+            type='transfer',
+            amount=amount,
+            currency='NGN',
+            description=description,
+            recipient_name=recipient_name,
+            recipient_account=recipient_account,
+            recipient_bank=recipient_bank,
+            status='completed',
+            reference=reference,
+            balance_after=balances[sender_profile.pk],
+            category='Transfer'
+        )
+
+        ledger = [sender_transaction]
+        if recipient_profile:
+            ledger.append(Transaction.objects.db_manager(db).create(
+                user_id=recipient_profile.user_id,
+                type='credit',
+                amount=amount,
+                currency='NGN',
+                description=description or f"Transfer from {sender.username}",
+                recipient_name=display_name(sender),
+                recipient_account=sender_profile.account_number,
+                recipient_bank=INTERNAL_BANK_NAME,
+                status='completed',
+                reference=credit_reference(reference),
+                balance_after=balances[recipient_profile.pk],
+                category='Credit'
+            ))
+
+        record_transactions(ledger[:1] if slotted else ledger, using=db)
+        # Notifications go out from the outbox worker once this commits
+        emit(TRANSFER_COMPLETED, transfer_completed_payload(
+            sender_transaction,
+            recipient_profile.user_id if recipient_profile else None,
+            balances[recipient_profile.pk] if recipient_profile else None,
+        ), using=db)
+
+    return sender_transaction
+
+
+def transfer_across_shards(sender, sender_profile, recipient_profile, amount, description=''):
+    """
+    Transfer between accounts on different shards as a saga of local transactions.
+
+    1. On the sender's shard: debit the sender, book their leg and record a
+       pending ``TransferSaga``.
+    2. On the recipient's shard: insert the credit leg's saga row, which is
+       unique per transfer, credit the recipient and book their leg.
+    3. On the sender's shard: mark the saga completed and queue the
+       notifications.
+
+    If step 2 fails the sender is refunded with a reversal entry (see
+    ``settle_saga``) and ``TransferNotCompleted`` is raised, or, if the
+    recipient's shard can't tell yet, ``TransferPending``. A saga whose
+    process dies midway stays pending until ``recover_transfers`` settles it.
+    Returns the sender's ``Transaction``.
+
+    Each step must commit on its own, so neither shard may be inside an
+    atomic block: an outer rollback would undo a step the others rely on.
+    """
+    sender_db = account_db(sender.pk)
+    recipient_db = recipient_profile._state.db
+    if connections[sender_db].in_atomic_block or connections[recipient_db].in_atomic_block:
+        raise TransactionManagementError(
+            'A transfer between shards cannot run inside an atomic block on either shard'
+        )
+    reference = new_reference()
+
+    with transaction.atomic(using=sender_db):
+        lock_profiles([sender_profile.pk], using=sender_db)
+        if not debit(sender_profile.pk, amount, using=sender_db):
+            raise InsufficientFunds()
+        balance = current_balances([sender_profile.pk], using=sender_db)[sender_profile.pk]
+        sender_transaction = Transaction.objects.db_manager(sender_db).create(
+            user=sender,
+            type='transfer',
+            amount=amount,
+            currency='NGN',
+            description=description,
+            recipient_name=display_name(recipient_profile.user),
+            recipient_account=recipient_profile.account_number,
+            recipient_bank=INTERNAL_BANK_NAME,
+            status='completed',
+            reference=reference,
+            balance_after=balance,
+            category='Transfer'
+        )
+        record_transactions([sender_transaction], using=sender_db)
+        saga = TransferSaga.objects.using(sender_db).create(
+            reference=reference,
+            leg='debit',
+            state='pending',
+            amount=amount,
+            sender_id=sender.pk,
+            sender_profile_id=sender_profile.pk,
+            sender_transaction_id=sender_transaction.pk,
+            recipient_shard=recipient_db,
+            recipient_id=recipient_profile.user_id,
+            recipient_profile_id=recipient_profile.pk,
+        )
+
+    try:
+        recipient_balance = _credit_leg(saga, recipient_profile, Transaction(
+            user_id=recipient_profile.user_id,
+            type='credit',
+            amount=amount,
+            currency='NGN',
+            description=description or f"Transfer from {sender.username}",
+            recipient_name=display_name(sender),
+            recipient_account=sender_profile.account_number,
+            recipient_bank=INTERNAL_BANK_NAME,
+            status='completed',
+            reference=credit_reference(reference),
+            category='Credit'
+        ))
+    except DatabaseError as e:
+        logger.warning(f"Credit leg of transfer {reference} failed on {recipient_db}: {e}")
+        state = settle_saga(saga)
+        if state == 'completed':
+            return sender_transaction
+        if state == 'compensated':
+            raise TransferNotCompleted(
+                'The transfer could not be completed and the amount was returned to your account'
+            )
+        raise TransferPending(
+            f'The transfer is pending and will be completed or reversed shortly. Ref: {reference}', reference
+        )
+
+    try:
+        _complete_saga(saga, sender_transaction, recipient_balance)
+    except DatabaseError as e:
+        # The money has moved; recover_transfers marks the saga and notifies
+        logger.warning(f"Transfer {reference} was credited but not marked completed: {e}")
+    return sender_transaction
+
+
+def _credit_leg(saga, recipient_profile, credit_transaction):
+    """
+    Step 2: credit the recipient unless the transfer was aborted. Returns the
+    recipient's new balance; raises IntegrityError if the leg already exists.
+    """
+    db = saga.recipient_shard
+    with transaction.atomic(using=db):
+        TransferSaga.objects.using(db).create(
+            reference=credit_reference(saga.reference),
+            leg='credit',
+            state='credited',
+            amount=saga.amount,
+            sender_id=saga.sender_id,
+            sender_profile_id=saga.sender_profile_id,
+            recipient_shard=db,
+            recipient_id=saga.recipient_id,
+            recipient_profile_id=saga.recipient_profile_id,
+        )
+        if not is_hot(recipient_profile):
+            lock_profiles([recipient_profile.pk], using=db)
+        slotted = credit_account(recipient_profile, saga.amount, using=db)
+        credit_transaction.balance_after = current_balances([recipient_profile.pk], using=db)[recipient_profile.pk]
+        credit_transaction.save(using=db)
+        if not slotted:
+            record_transactions([credit_transaction], using=db)
+    return credit_transaction.balance_after
+
+
+def _complete_saga(saga, sender_transaction, recipient_balance):
+    """Step 3: mark the saga completed and queue the notifications, once"""
+    db = saga._state.db
+    with transaction.atomic(using=db):
+        if not TransferSaga.objects.using(db).filter(pk=saga.pk, state='pending').update(
+            state='completed', updated_at=timezone.now()
+        ):
+            return
+        emit(TRANSFER_COMPLETED, transfer_completed_payload(
+            sender_transaction, saga.recipient_id, recipient_balance,
+        ), using=db)
+    saga.state = 'completed'
+
+
+def settle_saga(saga):
+    """
+    Finish a pending saga whose credit leg failed or never ran.
+
+    The credit leg's saga row decides: an ``aborted`` row is inserted on the
+    recipient's shard unless a ``credited`` one is already there, so a late
+    credit and a compensation can't both happen. A credited transfer is
+    completed; an aborted one is compensated by crediting the sender a
+    reversal entry. Returns the saga's new state, ``pending`` if the
+    recipient's shard can't be reached (try again later).
+    """
+    db = saga._state.db
+    fence = credit_reference(saga.reference)
+    try:
+        try:
+            with transaction.atomic(using=saga.recipient_shard):
+                TransferSaga.objects.using(saga.recipient_shard).create(
+                    reference=fence,
+                    leg='credit',
+                    state='aborted',
+                    amount=saga.amount,
+                    sender_id=saga.sender_id,
+                    sender_profile_id=saga.sender_profile_id,
+                    recipient_shard=saga.recipient_shard,
+                    recipient_id=saga.recipient_id,
+                    recipient_profile_id=saga.recipient_profile_id,
+                )
+            credited = False
+        except IntegrityError:
+            credited = TransferSaga.objects.using(saga.recipient_shard).get(reference=fence).state == 'credited'
+        if credited:
+            recipient_balance = (
+                Transaction.objects.using(saga.recipient_shard)
+                .values_list('balance_after', flat=True)
+                .get(reference=fence)
+            )
+    except DatabaseError as e:
+        TransferSaga.objects.using(db).filter(pk=saga.pk).update(
+            attempts=F('attempts') + 1, last_error=repr(e), updated_at=timezone.now()
+        )
+        return 'pending'
+
+    sender_transaction = Transaction.objects.using(db).get(pk=saga.sender_transaction_id)
+    if credited:
+        _complete_saga(saga, sender_transaction, recipient_balance)
+        return 'completed'
+
+    with transaction.atomic(using=db):
+        lock_profiles([saga.sender_profile_id], using=db)
+        if not TransferSaga.objects.using(db).filter(pk=saga.pk, state='pending').update(
+            state='compensated', updated_at=timezone.now()
+        ):
+            return TransferSaga.objects.using(db).values_list('state', flat=True).get(pk=saga.pk)
+        credit(saga.sender_profile_id, saga.amount, using=db)
+        reversal = Transaction.objects.using(db).create(
+            user_id=saga.sender_id,
+            type='credit',
+            amount=saga.amount,
+            currency='NGN',
+            description=f"Reversal of {saga.reference}",
+            recipient_name=sender_transaction.recipient_name,
+            recipient_account=sender_transaction.recipient_account,
+            recipient_bank=sender_transaction.recipient_bank,
+            status='completed',
+            reference=reversal_reference(saga.reference),
+            balance_after=current_balances([saga.sender_profile_id], using=db)[saga.sender_profile_id],
+            category='Reversal'
+        )
+        record_transactions([reversal], using=db)
+    saga.state = 'compensated'
+    return 'compensated'
+
+
+def batch_settings():
+    return (
+        getattr(settings, 'BATCH_TRANSFER_DEFAULT_MODE', BATCH_MODE_ATOMIC),
+        getattr(settings, 'BATCH_TRANSFER_MAX_ITEMS', 500),
+    )
+
+
+def _batch_result(index, item, status, error=None):
+    return {
+        'index': index,
+        'recipient_account': item.get('recipient_account') if isinstance(item, dict) else None,
+        'amount': None,
+        'status': status,
+        'reference': None,
+        'balance_after': None,
+        'error': error,
+    }
+
+
+def _reject_batch(message, results):
+    for result in results:
+        if result['status'] == 'pending':
+            result['status'] = 'skipped'
+    return BatchRejected(message, results)
+
+
+def batch_transfer(sender, items, mode=None):
+    """
+    Apply a list of transfers from ``sender`` in a single database transaction.
+
+    All internal recipients are resolved with one ``account_number__in`` query,
+    the sender is debited once for the accepted total, recipients are credited
+    with one ``UPDATE ... CASE`` and every ledger row goes in with
+    ``bulk_create``.
+
+    In ``atomic`` mode any bad item (or insufficient funds for the whole batch)
+    raises ``BatchRejected`` and nothing is committed. In ``best_effort`` mode
+    bad items are skipped and the rest are applied in order for as long as the
+    balance covers them. Returns one result dict per input item.
+
+    Recipients on another shard can't share the batch's transaction: an
+    ``atomic`` batch containing one is rejected, and ``best_effort`` applies
+    them one by one after the rest of the batch (see ``transfer_across_shards``).
+    """
+    default_mode, max_items = batch_settings()
+    mode = mode or default_mode
+    if mode not in BATCH_MODES:
+        raise TransferError(f"Mode must be one of: {', '.join(BATCH_MODES)}")
+    if not isinstance(items, list) or not items:
+        raise TransferError('Transfers must be a non-empty list')
+    if len(items) > max_items:
+        raise TransferError(f'A batch may contain at most {max_items} transfers')
+
+    try:
+        # Memoized on the user, so the request's authentication may already have it
+        sender_profile = sender.profile
+    except UserProfile.DoesNotExist:
+        raise AccountNotFound('User profile not found')
+
+    # Validate every item before touching the database
+    results = []
+    valid = []
+    internal_accounts = set()
+    for index, item in enumerate(items):
+        result = _batch_result(index, item, 'pending')
+        results.append(result)
+
+        if not isinstance(item, dict) or not all(
+            item.get(field) for field in ('recipient_account', 'recipient_bank', 'amount')
+        ):
+            result.update(status='failed', error='Recipient account, bank, and amount are required')
+            continue
+        try:
+            amount = parse_amount(item['amount'])
+        except InvalidAmount as e:
+            result.update(status='failed', error=e.message)
+            continue
+
+        result['amount'] = str(amount)
+        valid.append((index, item, amount))
+        if is_internal_bank(item['recipient_bank']):
+            internal_accounts.add(item['recipient_account'])
+
+    recipients = {
+        profile.account_number: profile
+        for profile in UserProfile.objects.select_related('user')
+        .only('id', 'account_number', 'balance_slots', 'user__username', 'user__first_name', 'user__last_name')
+        .scatter(account_number__in=internal_accounts)
+    }
+
+    db = account_db(sender.pk)
+    transfers = []
+    remote = []
+    for index, item, amount in valid:
+        recipient_profile = None
+        if is_internal_bank(item['recipient_bank']):
+            recipient_profile = recipients.get(item['recipient_account'])
+            if recipient_profile is None:
+                results[index].update(status='failed', error='Recipient account not found')
+                continue
+            if is_sharded() and recipient_profile._state.db != db:
+                remote.append((index, item, amount, recipient_profile))
+                continue
+        transfers.append((index, item, amount, recipient_profile))
+
+    if mode == BATCH_MODE_ATOMIC and remote:
+        for index, _, _, _ in remote:
+            results[index].update(status='failed', error='This recipient cannot be paid in an atomic batch')
+        raise _reject_batch('Batch rejected: use best_effort mode for these recipients', results)
+    if mode == BATCH_MODE_ATOMIC and len(transfers) != len(items):
+        raise _reject_batch('Batch rejected: one or more transfers are invalid', results)
+
+    with transaction.atomic(using=db):
+        _apply_batch(sender, sender_profile, transfers, results, mode, using=db)
+
+    for index, item, amount, recipient_profile in remote:
+        try:
+            sender_transaction = transfer_across_shards(
+                sender, sender_profile, recipient_profile, amount, item.get('description', ''),
+            )
+        except TransferPending as e:
+            results[index].update(status='pending', reference=e.reference, error=e.message)
+            continue
+        except TransferError as e:
+            results[index].update(status='failed', error=e.message)
+            continue
+        results[index].update(
+            status='completed',
+            reference=sender_transaction.reference,
+            balance_after=str(sender_transaction.balance_after),
+        )
+
+    return results
+
+
+def _apply_batch(sender, sender_profile, transfers, results, mode, using=None):
+    recipients = {p.pk: p for _, _, _, p in transfers if p is not None}
+    profile_ids = {sender_profile.pk, *recipients}
+    lock_profiles(
+        [pk for pk in profile_ids if pk == sender_profile.pk or not is_hot(recipients[pk])], using=using
+    )
+
+    # Decide which transfers the (locked) balance can cover
+    available = current_balances([sender_profile.pk], using=using, spendable=True)[sender_profile.pk]
+    accepted = []
+    for transfer in transfers:
+        index, _, amount, _ = transfer
+        if amount <= available:
+            available -= amount
+            accepted.append(transfer)
+        elif mode == BATCH_MODE_ATOMIC:
+            raise _reject_batch('Insufficient funds for the whole batch', results)
+        else:
+            results[index].update(status='failed', error='Insufficient funds')
+
+    if not accepted:
+        return
+
+    total = sum(amount for _, _, amount, _ in accepted)
+    credits = {}
+    counts = {}
+    for _, _, amount, recipient_profile in accepted:
+        if recipient_profile is not None:
+            credits[recipient_profile.pk] = credits.get(recipient_profile.pk, Decimal('0.00')) + amount
+            counts[recipient_profile.pk] = counts.get(recipient_profile.pk, 0) + 1
+
+    if not debit(sender_profile.pk, total, using=using):
+        raise InsufficientFunds()
+    slotted = {
+        recipients[pk].user_id for pk, amount in credits.items()
+        if is_hot(recipients[pk]) and credit_slot(
+            pk, recipients[pk].balance_slots, amount, using=using, count=counts[pk]
+        )
+    }
+    credit_many({pk: amount for pk, amount in credits.items() if recipients[pk].user_id not in slotted}, using=using)
+
+    # Rebuild each leg's balance_after by replaying the batch from the
+    # opening balances implied by the committed totals.
+    running = current_balances(profile_ids, using=using)
+    running[sender_profile.pk] += total
+    for pk, amount in credits.items():
+        running[pk] -= amount
+
+    sender_name = display_name(sender)
+    ledger = []
+    events = []
+    for index, item, amount, recipient_profile in accepted:
+        reference = new_reference()
+        description = item.get('description', '')
+
+        running[sender_profile.pk] -= amount
+        ledger.append(Transaction(
+            user=sender,
+            type='transfer',
+            amount=amount,
+            currency='NGN',
+            description=description,
+            recipient_name=(
+                display_name(recipient_profile.user) if recipient_profile
+                else item.get('recipient_name') or 'External Account'
+            ),
+            recipient_account=item['recipient_account'],
+            recipient_bank=item['recipient_bank'],
+            status='completed',
+            reference=reference,
+            balance_after=running[sender_profile.pk],
+            category='Transfer'
+        ))
+        results[index].update(
+            status='completed',
+            reference=reference,
+            balance_after=str(running[sender_profile.pk]),
+        )
+        sender_leg = ledger[-1]
+
+        if recipient_profile is not None:
+            running[recipient_profile.pk] += amount
+            ledger.append(Transaction(
+                user_id=recipient_profile.user_id,
+                type='credit',
+                amount=amount,
+                currency='NGN',
+                description=description or f"Transfer from {sender.username}",
+                recipient_name=sender_name,
+                recipient_account=sender_profile.account_number,
+                recipient_bank=INTERNAL_BANK_NAME,
+                status='completed',
+                reference=credit_reference(reference),
+                balance_after=running[recipient_profile.pk],
+                category='Credit'
+            ))
+        events.append((TRANSFER_COMPLETED, transfer_completed_payload(
+            sender_leg,
+            recipient_profile.user_id if recipient_profile else None,
+            running[recipient_profile.pk] if recipient_profile else None,
+        )))
+
+    Transaction.objects.db_manager(using).bulk_create(ledger)
+    record_transactions(
+        [txn for txn in ledger if txn.type != 'credit' or txn.user_id not in slotted], using=using
+    )
+    emit_many(events, using=using)
@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import views, async_views
 
 # Create a router for ViewSets
 router = DefaultRouter()
@@ -9,11 +10,23 @@ router.register(r'transactions', views.TransactionViewSet, basename='transaction
 router.register(r'cards', views.CardViewSet, basename='card')
 router.register(r'messages', views.MessageViewSet, basename='message')
 
+# Under ASGI, serve the read-only endpoints from native async views
+if getattr(settings, 'ASYNC_READ_VIEWS', False):
+    verify_account_view = async_views.verify_account
+    async_read_patterns = [
+        path('transactions/', async_views.transaction_list, name='transaction-list'),
+        path('transactions/<str:pk>/', async_views.transaction_detail, name='transaction-detail'),
+        path('messages/', async_views.message_list, name='message-list'),
+        path('messages/<str:pk>/', async_views.message_detail, name='message-detail'),
+    ]
+else:
+    verify_account_view = views.verify_account
+    async_read_patterns = []
+
 # Define URL patterns
+# Explicit routes come before the router so that e.g. transactions/transfer/
+# isn't swallowed by the transactions/<pk>/ detail route.
 urlpatterns = [
-    # Include router URLs
-    path('', include(router.urls)),
-    
     # Authentication endpoints
     path('auth/register/', views.register_user, name='register'),
     path('auth/login/', views.login_user, name='login'),
@@ -23,7 +36,11 @@ urlpatterns = [
     
     # Transaction endpoints
     path('transactions/transfer/', views.create_transfer, name='transfer'),
-    path('transactions/verify-account/<str:account_number>/', views.verify_account, name='verify-account'),
+    path('transactions/transfer/batch/', views.create_batch_transfer, name='batch-transfer'),
+    path('transactions/export/', views.export_transactions, name='export-transactions'),
+    path('transactions/statement/', views.account_statement, name='account-statement'),
+    path('transactions/balance/', views.balance_at_date, name='balance-at-date'),
+    path('transactions/verify-account/<str:account_number>/', verify_account_view, name='verify-account'),
     
     # Message endpoints
     path('messages/<int:pk>/read/', views.mark_message_read, name='mark-message-read'),
@@ -31,4 +48,12 @@ urlpatterns = [
     # Middleware endpoints
     path('middleware/public-key/', views.middleware_public_key, name='middleware-public-key'),
     path('secure/gateway/', views.secure_gateway, name='secure-gateway'),
+    
+    # Monitoring
+    path('metrics/', views.metrics, name='metrics'),
+    
+    *async_read_patterns,
+    
+    # Include router URLs
+    path('', include(router.urls)),
 ]
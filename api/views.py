@@ -1,71 +1,62 @@
 from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, parser_classes, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.db import transaction, IntegrityError
+from .accounts import conflict_field, conflict_message, derive_account_number, find_conflicts
+from .authentication import API_AUTHENTICATION_CLASSES, token_cache
+from .conditional import conditional_response, list_validators, set_validators
 from .models import UserProfile, Transaction, Card, Message, MiddlewareKey
 from .serializers import (
     UserSerializer, 
+    RegistrationSerializer, 
     UserProfileSerializer, 
     TransactionSerializer, 
     CardSerializer, 
-    MessageSerializer
+    MessageSerializer,
+    transaction_rows,
+    message_rows
 )
-import random
-import string
-import uuid
-import re
-import time
+from .key_cache import public_key_cache
+from .pagination import KeysetPagination
+from .routers import pin_user
+from .shards import account_db, mirror_users
+from .parsers import API_PARSER_CLASSES
+from .gateway import GatewayError, handle_envelope
+from .key_ring import key_ring
+from .exports import EXPORT_FORMATS, export_queryset, parse_date_range
+from .snapshots import balance_at, statement
+from .timing import phase, render_metrics
+from .transfers import (
+    transfer_funds, batch_transfer, batch_settings, TransferError, TransferPending, BatchRejected
+)
+from datetime import datetime
+from decimal import Decimal
 import json
 import base64
+import hmac
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
 
-# Utility functions for handling unique constraint violations
-def parse_unique_constraint_error(error_string):
-    """Parse database error and return user-friendly message"""
-    error_mapping = {
-        'bvn': 'This BVN is already registered with another account',
-        'nin': 'This NIN is already registered with another account', 
-        'account_number': 'Account number already exists',
-        'email': 'This email address is already registered',
-        'username': 'This username is already taken',
-        'phone': 'This phone number is already registered',
-        'reference': 'Transaction reference already exists',
-        'card_number': 'This card number is already registered'
-    }
-    
-    # Check which field caused the constraint violation
-    for field, message in error_mapping.items():
-        if field in error_string.lower():
-            return message
-    
-    return 'This information is already registered. Please use different details.'
-
-def get_violated_field(error_string):
-    """Extract the field name that violated the unique constraint"""
-    field_patterns = {
-        'bvn': r'bvn|BVN',
-        'nin': r'nin|NIN', 
-        'account_number': r'account_number|account',
-        'email': r'email',
-        'username': r'username',
-        'phone': r'phone',
-        'reference': r'reference',
-        'card_number': r'card_number'
-    }
-    
-    for field, pattern in field_patterns.items():
-        if re.search(pattern, error_string, re.IGNORECASE):
-            return field
-    
-    return 'unknown'
+def conflict_response(conflicts):
+    """400 naming every field in ``{field: message}``; ``field``/``error`` give the first"""
+    field, message = next(iter(conflicts.items()))
+    return Response({
+        'error': message,
+        'field': field,
+        'conflicts': conflicts,
+        'details': 'Please use different information for these fields.'
+    }, status=status.HTTP_400_BAD_REQUEST)
 
 # Authentication Views
 @api_view(['POST', 'OPTIONS'])
@@ -77,35 +68,44 @@ def register_user(request):
         return Response(status=status.HTTP_200_OK)
     
     try:
-        serializer = UserSerializer(data=request.data)
+        serializer = RegistrationSerializer(data=request.data)
+        
+        if not serializer.is_valid():
+            return Response({
+                'error': 'Invalid data provided',
+                'details': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        if serializer.is_valid():
-            try:
-                # Create user with the provided data
+        username = serializer.validated_data['username']
+        email = serializer.validated_data['email']
+        phone = request.data.get('phone', '')
+        bvn = request.data.get('bvn', '')
+        nin = request.data.get('nin', '')
+        
+        # The phone number without its leading zero, or random digits
+        account_number = derive_account_number(phone)
+        
+        # Every conflicting field in one query, before paying for the password hash
+        conflicts = find_conflicts(username, email, phone, bvn, nin, account_number)
+        while not phone and 'account_number' in conflicts:
+            # A random account number clashed; draw another
+            account_number = derive_account_number(phone)
+            conflicts = find_conflicts(username, email, phone, bvn, nin, account_number)
+        if conflicts:
+            return conflict_response(conflicts)
+        
+        try:
+            with transaction.atomic():
                 user = User.objects.create_user(
-                    username=serializer.validated_data['username'],
-                    email=serializer.validated_data['email'],
+                    username=username,
+                    email=email,
                     password=request.data.get('password'),
                     first_name=serializer.validated_data.get('first_name', ''),
                     last_name=serializer.validated_data.get('last_name', '')
                 )
-                
-                # Get additional profile data from request
-                phone = request.data.get('phone', '')
-                bvn = request.data.get('bvn', '')
-                nin = request.data.get('nin', '')
-                
-                # Generate account number by stripping the leading zero from phone number
-                if phone and phone.startswith('0'):
-                    account_number = phone[1:]  # Remove leading zero
-                elif phone:
-                    account_number = phone  # Use as is if no leading zero
-                else:
-                    # Fallback to random number if no phone provided
-                    account_number = ''.join(random.choices(string.digits, k=10))
-                
-                try:
-                    # Create user profile
+                # Sharded: the profile commits on the user's shard just before the user
+                with transaction.atomic(using=account_db(user.pk), savepoint=False):
+                    mirror_users([user])
                     profile = UserProfile.objects.create(
                         user=user,
                         phone=phone,
@@ -115,46 +115,20 @@ def register_user(request):
                         # Initial balance for testing
                         account_balance=50000.00
                     )
-                    
-                    # Generate authentication token
-                    token, _ = Token.objects.get_or_create(user=user)
-                    
-                    return Response({
-                        'user': UserSerializer(user).data,
-                        'profile': UserProfileSerializer(profile).data,
-                        'token': token.key
-                    }, status=status.HTTP_201_CREATED)
-                    
-                except IntegrityError as e:
-                    # Delete the user if profile creation fails
-                    user.delete()
-                    
-                    # Parse the specific unique constraint violation
-                    error_message = parse_unique_constraint_error(str(e))
-                    violated_field = get_violated_field(str(e))
-                    
-                    return Response({
-                        'error': error_message,
-                        'field': violated_field,
-                        'details': 'Please use different information for this field.'
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                    
-            except IntegrityError as e:
-                # Handle user creation unique constraint violations (username, email)
-                error_message = parse_unique_constraint_error(str(e))
-                violated_field = get_violated_field(str(e))
-                
-                return Response({
-                    'error': error_message,
-                    'field': violated_field,
-                    'details': 'Please choose a different value for this field.'
-                }, status=status.HTTP_400_BAD_REQUEST)
-                
-        else:
-            return Response({
-                'error': 'Invalid data provided',
-                'details': serializer.errors
-            }, status=status.HTTP_400_BAD_REQUEST)
+                token = Token.objects.create(user=user)
+        except IntegrityError as e:
+            # A concurrent registration took a value after the pre-check
+            field = conflict_field(e)
+            return conflict_response({field: conflict_message(field)})
+        
+        # The client reads its new account next; keep it off replicas that may lag
+        pin_user(user.pk)
+        
+        return Response({
+            'user': UserSerializer(user).data,
+            'profile': UserProfileSerializer(profile).data,
+            'token': token.key
+        }, status=status.HTTP_201_CREATED)
             
     except Exception as e:
         return Response({
@@ -177,7 +151,7 @@ def login_user(request):
     
     if user:
         token, _ = Token.objects.get_or_create(user=user)
-        profile = UserProfile.objects.get(user=user)
+        profile = UserProfile.objects.for_user(user).get()
         
         return Response({
             'user': UserSerializer(user).data,
@@ -188,6 +162,7 @@ def login_user(request):
     return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
 
 @api_view(['POST', 'OPTIONS'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def logout_user(request):
     """Logout a user by deleting their token"""
@@ -195,10 +170,13 @@ def logout_user(request):
     if request.method == 'OPTIONS':
         return Response(status=status.HTTP_200_OK)
         
+    token_cache.invalidate_user(request.user.id)
     request.user.auth_token.delete()
     return Response({'message': 'Successfully logged out'}, status=status.HTTP_200_OK)
 
 @api_view(['POST'])
+@parser_classes(API_PARSER_CLASSES)
+@authentication_classes(API_AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def update_public_key(request):
     """Update the user's public key"""
@@ -208,9 +186,11 @@ def update_public_key(request):
         return Response({'error': 'Public key is required'}, status=status.HTTP_400_BAD_REQUEST)
     
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = request.user.profile
         profile.public_key = public_key
-        profile.save()
+        profile.save(update_fields=['public_key', 'updated_at'])
+        public_key_cache.invalidate(request.user.id)
+        token_cache.invalidate_user(request.user.id)
         
         return Response({
             'message': 'Public key updated successfully',
@@ -220,13 +200,15 @@ def update_public_key(request):
         return Response({'error': 'User profile not found'}, status=status.HTTP_404_NOT_FOUND)
 
 @api_view(['POST'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def set_pin(request):
     """Mark that the user has set their PIN (the PIN itself is stored client-side)"""
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = request.user.profile
         profile.pin_set = True
-        profile.save()
+        profile.save(update_fields=['pin_set', 'updated_at'])
+        token_cache.invalidate_user(request.user.id)
         
         return Response({
             'message': 'PIN set successfully',
@@ -236,22 +218,71 @@ def set_pin(request):
         return Response({'error': 'User profile not found'}, status=status.HTTP_404_NOT_FOUND)
 
 # User Profile ViewSet
-class UserProfileViewSet(viewsets.ModelViewSet):
+class ConditionalListMixin:
+    """
+    list() with an ETag (and, if ``list_last_modified``, Last-Modified) from one
+    aggregate query; a matching conditional GET gets a 304 without serializing.
+    ``list_related_latest`` adds a related timestamp that also changes the list,
+    and ``list_related_values`` related columns it renders that have none.
+    """
+    list_last_modified = False
+    list_related_latest = None
+    list_related_values = ()
+    
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = list_validators(
+            self.get_queryset(), request, self.list_last_modified, self.list_related_latest,
+            self.list_related_values
+        )
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+        return set_validators(super().list(request, *args, **kwargs), etag, last_modified)
+
+class UserProfileViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = UserProfileSerializer
+    # One row per user, so max(updated_at) moves on every change
+    list_last_modified = True
+    # Credits to a hot account update its balance slots, not the profile
+    list_related_latest = 'slots__updated_at'
+    # Rendered by UserSerializer; editing them leaves every timestamp alone
+    list_related_values = ('user__username', 'user__email', 'user__first_name', 'user__last_name')
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = [IsAuthenticated]
+    parser_classes = API_PARSER_CLASSES
     
     def get_queryset(self):
-        return UserProfile.objects.filter(user=self.request.user)
+        return UserProfile.objects.for_user(self.request.user).select_related('user')
+    
+    def perform_update(self, serializer):
+        serializer.save()
+        # The profile payload may carry a new public key
+        public_key_cache.invalidate(self.request.user.id)
+        token_cache.invalidate_user(self.request.user.id)
 
 # Transaction ViewSet and Views
-class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
+class RowListMixin:
+    """list() from .values() rows through ``row_serializer`` instead of model instances"""
+    row_serializer = None
+    
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).values(*self.row_serializer.columns)
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.row_serializer.serialize(page))
+
+class TransactionViewSet(ConditionalListMixin, RowListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = TransactionSerializer
+    row_serializer = transaction_rows
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        return Transaction.objects.filter(user=self.request.user).order_by('-created_at')
+        return Transaction.objects.for_user(self.request.user).order_by('-created_at', '-id')
 
 @api_view(['POST'])
+@parser_classes(API_PARSER_CLASSES)
+@authentication_classes(API_AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def create_transfer(request):
     """Create a new transfer transaction"""
@@ -268,138 +299,195 @@ def create_transfer(request):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            amount = float(amount)
-        except ValueError:
-            return Response({'error': 'Amount must be a number'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Get sender profile
-        try:
-            sender_profile = UserProfile.objects.get(user=request.user)
-        except UserProfile.DoesNotExist:
-            return Response({'error': 'User profile not found'}, status=status.HTTP_404_NOT_FOUND)
+            with phase(request, 'transaction'):
+                sender_transaction = transfer_funds(
+                    request.user,
+                    recipient_account=recipient_account,
+                    recipient_bank=recipient_bank,
+                    amount=amount,
+                    description=description,
+                    recipient_name=request.data.get('recipient_name'),
+                )
+        except TransferPending as e:
+            # The sender was debited; the transfer completes or is reversed later
+            return Response({
+                'message': e.message,
+                'status': 'pending',
+                'reference': e.reference
+            }, status=e.status_code)
+        except TransferError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        except IntegrityError as e:
+            field = conflict_field(e)
+            return Response({
+                'error': conflict_message(field),
+                'field': field,
+                'details': 'Please try the transaction again.'
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Check if sender has enough balance
-        if sender_profile.account_balance < amount:
-            return Response({'error': 'Insufficient funds'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'message': 'Transfer completed successfully',
+            'transaction': TransactionSerializer(sender_transaction).data
+        }, status=status.HTTP_201_CREATED)
         
-        # Find recipient if it's within our system
-        recipient_profile = None
-        recipient_name = request.data.get('recipient_name', 'External Account')
+    except Exception as e:
+        return Response({
+            'error': 'Transaction failed. Please try again.',
+            'details': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['POST'])
+@parser_classes(API_PARSER_CLASSES)
+@authentication_classes(API_AUTHENTICATION_CLASSES)
+@permission_classes([IsAuthenticated])
+def create_batch_transfer(request):
+    """Apply a list of transfers under a single signature and database transaction"""
+    try:
+        transfers = request.data.get('transfers')
+        mode = request.data.get('mode') or batch_settings()[0]
         
-        if recipient_bank.lower() == 'secure cipher bank':
-            try:
-                recipient_profile = UserProfile.objects.get(account_number=recipient_account)
-                recipient_name = f"{recipient_profile.user.first_name} {recipient_profile.user.last_name}".strip()
-                if not recipient_name:
-                    recipient_name = recipient_profile.user.username
-            except UserProfile.DoesNotExist:
-                return Response({'error': 'Recipient account not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            with phase(request, 'transaction'):
+                results = batch_transfer(request.user, transfers, mode=mode)
+        except BatchRejected as e:
+            return Response({
+                'error': e.message,
+                'results': e.results
+            }, status=e.status_code)
+        except TransferError as e:
+            return Response({'error': e.message}, status=e.status_code)
         
-        # Generate unique reference with retry mechanism
-        max_retries = 3
-        for attempt in range(max_retries):
-            reference = f"TRF-{str(uuid.uuid4())[:8].upper()}-{int(time.time())}"
-            
-            try:
-                with transaction.atomic():
-                    # Deduct from sender
-                    sender_profile.account_balance -= amount
-                    sender_profile.save()
-                    
-                    # Create sender's transaction record
-                    sender_transaction = Transaction.objects.create(
-                        user=request.user,
-                        type='transfer',
-                        amount=amount,
-                        currency='NGN',
-                        description=description,
-                        recipient_name=recipient_name,
-                        recipient_account=recipient_account,
-                        recipient_bank=recipient_bank,
-                        status='completed',
-                        reference=reference,
-                        balance_after=sender_profile.account_balance,
-                        category='Transfer'
-                    )
-                    
-                    # If recipient is within our system, credit their account
-                    if recipient_profile:
-                        recipient_profile.account_balance += amount
-                        recipient_profile.save()
-                        
-                        # Create recipient's transaction record
-                        Transaction.objects.create(
-                            user=recipient_profile.user,
-                            type='credit',
-                            amount=amount,
-                            currency='NGN',
-                            description=description or f"Transfer from {request.user.username}",
-                            recipient_name=f"{request.user.first_name} {request.user.last_name}".strip() or request.user.username,
-                            recipient_account=sender_profile.account_number,
-                            recipient_bank='Secure Cipher Bank',
-                            status='completed',
-                            reference=f"CR-{reference[4:]}",
-                            balance_after=recipient_profile.account_balance,
-                            category='Credit'
-                        )
-                
-                return Response({
-                    'message': 'Transfer completed successfully',
-                    'transaction': TransactionSerializer(sender_transaction).data
-                }, status=status.HTTP_201_CREATED)
-                
-            except IntegrityError as e:
-                if 'reference' in str(e).lower() and attempt < max_retries - 1:
-                    # Reference collision, try again with new reference
-                    continue
-                else:
-                    # Other integrity error or max retries reached
-                    error_message = parse_unique_constraint_error(str(e))
-                    violated_field = get_violated_field(str(e))
-                    
-                    return Response({
-                        'error': error_message,
-                        'field': violated_field,
-                        'details': 'Please try the transaction again.'
-                    }, status=status.HTTP_400_BAD_REQUEST)
+        completed = [r for r in results if r['status'] == 'completed']
+        pending = [r for r in results if r['status'] == 'pending']
         
-        # If we reach here, all retries failed
+        if completed:
+            response_status = status.HTTP_201_CREATED
+        elif pending:
+            response_status = status.HTTP_202_ACCEPTED
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
         return Response({
-            'error': 'Transaction failed after multiple attempts. Please try again.',
-            'details': 'Unable to generate unique transaction reference'
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            'message': f"{len(completed)} of {len(results)} transfers completed",
+            'mode': mode,
+            'completed': len(completed),
+            'pending': len(pending),
+            'failed': len(results) - len(completed) - len(pending),
+            'total_amount': str(sum((Decimal(r['amount']) for r in completed), Decimal('0.00'))),
+            'results': results
+        }, status=response_status)
         
     except Exception as e:
         return Response({
-            'error': 'Transaction failed. Please try again.',
+            'error': 'Batch transfer failed. Please try again.',
             'details': str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
+@permission_classes([IsAuthenticated])
+def export_transactions(request):
+    """Stream the user's transaction history as CSV or NDJSON"""
+    output = request.query_params.get('output', 'csv').lower()
+    if output not in EXPORT_FORMATS:
+        return Response({
+            'error': f"Output must be one of: {', '.join(EXPORT_FORMATS)}"
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        start, end = parse_date_range(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    content_type, stream = EXPORT_FORMATS[output]
+    response = StreamingHttpResponse(
+        stream(export_queryset(request.user, start, end)),
+        content_type=content_type
+    )
+    response['Content-Disposition'] = f'attachment; filename="transactions.{output}"'
+    return response
+
+@api_view(['GET'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
+@permission_classes([IsAuthenticated])
+def account_statement(request):
+    """Opening/closing balance and daily activity between two dates"""
+    start = parse_date(request.query_params.get('start') or '')
+    end = parse_date(request.query_params.get('end') or '')
+    
+    if not start or not end or start > end:
+        return Response({
+            'error': 'start and end dates (YYYY-MM-DD) are required, with start <= end'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    summary = statement(request.user, start, end)
+    return Response({
+        'start': summary['start'],
+        'end': summary['end'],
+        'opening_balance': str(summary['opening_balance']),
+        'closing_balance': str(summary['closing_balance']),
+        'transaction_count': summary['transaction_count'],
+        'days': [{
+            'date': day['date'],
+            'opening_balance': str(day['opening_balance']),
+            'closing_balance': str(day['closing_balance']),
+            'transaction_count': day['transaction_count'],
+        } for day in summary['days']]
+    })
+
+@api_view(['GET'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
+@permission_classes([IsAuthenticated])
+def balance_at_date(request):
+    """Balance at the end of a date, or at an exact ISO datetime"""
+    value = request.query_params.get('at') or ''
+    try:
+        moment = parse_date(value) or parse_datetime(value)
+    except ValueError:
+        moment = None
+    
+    if moment is None:
+        return Response({
+            'error': "'at' must be a date (YYYY-MM-DD) or an ISO datetime"
+        }, status=status.HTTP_400_BAD_REQUEST)
+    if isinstance(moment, datetime) and settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    
+    return Response({
+        'at': moment,
+        'balance': str(balance_at(request.user, moment))
+    })
+
 # Card ViewSet
 class CardViewSet(viewsets.ModelViewSet):
     serializer_class = CardSerializer
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = [IsAuthenticated]
+    parser_classes = API_PARSER_CLASSES
     
     def get_queryset(self):
-        return Card.objects.filter(user=self.request.user)
+        return Card.objects.for_user(self.request.user)
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
 # Message ViewSet
-class MessageViewSet(viewsets.ReadOnlyModelViewSet):
+class MessageViewSet(ConditionalListMixin, RowListMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = MessageSerializer
+    row_serializer = message_rows
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        return Message.objects.filter(user=self.request.user).order_by('-created_at')
+        return Message.objects.for_user(self.request.user).order_by('-created_at', '-id')
 
 @api_view(['POST'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def mark_message_read(request, pk):
     """Mark a message as read"""
     try:
-        message = Message.objects.get(pk=pk, user=request.user)
+        message = Message.objects.for_user(request.user).get(pk=pk)
         message.read = True
         message.save()
         return Response(MessageSerializer(message).data)
@@ -407,12 +495,13 @@ def mark_message_read(request, pk):
         return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
 
 @api_view(['GET'])
+@authentication_classes(API_AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def verify_account(request, account_number):
     """Verify if an account number exists and return the account holder's name"""
     try:
         # Find the user profile with the given account number
-        profile = UserProfile.objects.get(account_number=account_number)
+        profile = UserProfile.objects.select_related('user').find(account_number=account_number)
         
         # Return the account holder's name
         return Response({
@@ -425,3 +514,54 @@ def verify_account(request, account_number):
             'exists': False,
             'message': 'Account not found'
         }, status=status.HTTP_404_NOT_FOUND)
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def middleware_public_key(request):
+    """
+    Return the middleware's current public keys for the secure gateway
+    handshake, plus every key still accepted during a rotation
+    """
+    current = key_ring.current()
+    return Response({
+        'key_id': current.key_id,
+        'ecdh_public_key': current.ecdh_public_pem,
+        'ecdsa_public_key': current.ecdsa_public_pem,
+        'keys': [
+            {
+                'key_id': key.key_id,
+                'ecdh_public_key': key.ecdh_public_pem,
+                'ecdsa_public_key': key.ecdsa_public_pem,
+                'active': key.is_active,
+                'expires_at': key.expires_at,
+            }
+            for key in key_ring.valid_keys()
+        ],
+    })
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def secure_gateway(request):
+    """
+    Decrypt an end-to-end encrypted request, forward it through the API and
+    return the encrypted response. Authentication travels inside the envelope.
+    """
+    try:
+        return Response(handle_envelope(request, request.data))
+    except GatewayError as e:
+        return Response({'error': e.message}, status=e.status_code)
+
+def metrics(request):
+    """
+    Request timing histograms in the Prometheus text format. A plain Django
+    view, so scrapes skip DRF's authentication and content negotiation. Not
+    served at all until ``METRICS_TOKEN`` is set.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        return HttpResponse(status=404)
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+